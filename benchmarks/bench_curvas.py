@@ -0,0 +1,123 @@
+import numpy as np
+from scipy.integrate import quad
+
+from transitos_dha1001 import fotometria_diferencial, matriz_regresores, ajustar_tendencias, busqueda_bls, modelo_transito, ajustar_transito
+
+class CurvasDeLuz:
+    """
+    Análisis de las curvas de luz de todas las fuentes a la vez, sobre magnitudes sintéticas de (imagenes x fuentes) con extinción, ruido y un tránsito en la primera fuente.
+
+    """
+
+    params = [1000, 2000, 4000]
+    param_names = ["n_fuentes"]
+    n_imagenes = 500
+
+    def setup(self, n_fuentes):
+        rng = np.random.default_rng(1)
+        self.tiempo = np.linspace(0., 0.3, self.n_imagenes)
+        self.airmass = 1.05 + 2.*(self.tiempo - 0.06)**2
+        brillo = rng.uniform(10., 16., n_fuentes)
+        ruido = 0.002*10**(0.2*(brillo - 10.))
+        self.mag = brillo[None] + 0.15*self.airmass[:,None] + ruido[None]*rng.standard_normal((self.n_imagenes, n_fuentes))
+        self.mag[(self.tiempo > 0.1) & (self.tiempo < 0.18), 0] += 0.01
+        self.mag_err = np.broadcast_to(ruido, self.mag.shape)
+        self.regresores = matriz_regresores(self.tiempo, self.airmass, grado_tiempo=2)[0]
+
+    def time_fotometria_diferencial(self, n_fuentes):
+        fotometria_diferencial(self.mag, self.mag_err)
+
+    def peakmem_fotometria_diferencial(self, n_fuentes):
+        fotometria_diferencial(self.mag, self.mag_err)
+
+    def time_ajustar_tendencias(self, n_fuentes):
+        ajustar_tendencias(self.mag, self.regresores)
+
+    def time_ajustar_tendencias_pesos(self, n_fuentes):
+        ajustar_tendencias(self.mag, self.regresores, self.mag_err)
+
+    def time_busqueda_bls(self, n_fuentes):
+        busqueda_bls(self.tiempo, self.mag, self.mag_err)
+
+    def peakmem_busqueda_bls(self, n_fuentes):
+        busqueda_bls(self.tiempo, self.mag, self.mag_err)
+
+class ModeloTransito:
+    """
+    Evaluación del modelo de tránsito para muchos conjuntos de parámetros a la vez, y su error respecto a una integración adaptativa del mismo oscurecimiento al limbo.
+
+    """
+
+    params = [1000, 2000, 4000]
+    param_names = ["n_modelos"]
+    limites = {"track_error_modelo": 1e-8, "track_error_modelo_grilla": 1e-6}
+
+    def setup(self, n_modelos):
+        rng = np.random.default_rng(2)
+        self.tiempo = np.linspace(-0.1, 0.1, 300)
+        self.parametros = np.column_stack([rng.normal(0., 0.005, n_modelos), rng.uniform(0.05, 0.2, n_modelos),
+                                           rng.uniform(2., 5., n_modelos), rng.uniform(0., 0.8, n_modelos)])
+
+    def time_modelo_transito(self, n_modelos):
+        t0, rp, a, b = self.parametros.T
+        modelo_transito(self.tiempo, t0, rp, a, b, 0.925)
+
+    def track_error_modelo(self, n_modelos):
+        return _error_modelo(16)
+
+    def track_error_modelo_grilla(self, n_modelos):
+        return _error_modelo(8)
+
+def _intensidad(r, u1, u2):
+    mu = np.sqrt(max(1. - r**2, 0.))
+    return 1. - u1*(1. - mu) - u2*(1. - mu)**2
+
+def _arco_tapado(r, z, rp, u1, u2):
+
+    #Intensidad por el largo del arco del círculo de radio r que cae dentro del planeta.
+    coseno = (r**2 + z**2 - rp**2)/(2.*r*z) if r*z > 0 else (1. if r >= rp - z else -1.)
+    return _intensidad(r, u1, u2)*r*2.*np.arccos(np.clip(coseno, -1., 1.))
+
+def _disco(r, u1, u2):
+    return 2.*np.pi*r*_intensidad(r, u1, u2)
+
+def _flujo_referencia(z, rp, u1, u2):
+    r_min, r_max = abs(z - rp), min(z + rp, 1.)
+    puntos = [x for x in (rp - z, 1.) if r_min < x < r_max]
+    tapado = quad(_disco, 0., min(max(rp - z, 0.), 1.), args=(u1, u2), epsabs=1e-13)[0]
+    if r_max > r_min:
+        tapado += quad(_arco_tapado, r_min, r_max, args=(z, rp, u1, u2), points=puntos or None, epsabs=1e-13, epsrel=1e-13, limit=500)[0]
+    return 1. - tapado/quad(_disco, 0., 1., args=(u1, u2), epsabs=1e-14)[0]
+
+def _error_modelo(n_anillos, u1=0.4, u2=0.25):
+
+    #Error máximo del modelo en el centro del tránsito (donde z = b) para planetas chicos y grandes, desde el centro de la estrella hasta el último contacto.
+    casos = [(z, rp) for rp in (0.03, 0.1, 0.2, 0.4) for z in np.linspace(0., 1. + rp, 40)]
+    z, rp = np.array(casos).T
+    modelo = modelo_transito(np.zeros(1), 0., rp, 10., z, 1., u1, u2, n_anillos)[:,0]
+    referencia = np.array([_flujo_referencia(zi, rpi, u1, u2) for zi, rpi in casos])
+    return np.max(np.abs(modelo - referencia))
+
+class AjusteTransito:
+    """
+    Ajuste de una curva de luz sintética de 300 puntos con un tránsito de rp = 0.12.
+
+    """
+
+    rp = 0.12
+    limites = {"track_error_rp": 0.05}
+
+    def setup(self):
+        rng = np.random.default_rng(3)
+        self.tiempo = np.linspace(-0.1, 0.1, 300)
+        self.periodo = 0.925
+        flujo = modelo_transito(self.tiempo, 0., self.rp, 3.0, 0.2, self.periodo)
+        self.mag = -2.5*np.log10(flujo) + 0.002*rng.standard_normal(len(self.tiempo))
+        self.mag_err = np.full(len(self.tiempo), 0.002)
+
+    def time_ajustar_transito(self):
+        ajustar_transito(self.tiempo, self.mag, self.mag_err, self.periodo, mcmc=False)
+
+    def track_error_rp(self):
+        resultado = ajustar_transito(self.tiempo, self.mag, self.mag_err, self.periodo, mcmc=False)
+        return abs(resultado["rp"] - self.rp)/self.rp
@@ -0,0 +1,83 @@
+import shutil
+import tempfile
+
+from transitos_dha1001 import crear_masterbias, crear_masterdark, crear_masterflat, reducir_imagenes_ciencia, alinear_imagenes_ciencia
+from transitos_dha1001 import dao_busqueda, dao_recentrar, medir_fotometria, calcular_fondos, OperadorAperturas
+from transitos_dha1001.reduccion.cubo import abrir_imagenes
+from transitos_dha1001.fotometria.fondo import cielo_anillos
+from transitos_dha1001.fotometria.phot import pix_scale
+
+from .comunes import tamanos, noche_sintetica
+
+class Fotometria:
+    """
+    Búsqueda, recentrado y fotometría de las fuentes en imagenes reducidas y alineadas.
+
+    """
+
+    params = tamanos
+    param_names = ["tamano"]
+    timeout = 3600
+
+    def setup(self, tamano):
+        self.raw, self.noche = noche_sintetica(tamano)
+        self.red = tempfile.mkdtemp(prefix="red_")
+        self.fot = tempfile.mkdtemp(prefix="fot_")
+        directorios = dict(directorio_imagenes_originales=self.raw, directorio_imagenes_reducidas=self.red)
+        crear_masterbias(self.noche["bias"], **directorios)
+        crear_masterdark(self.noche["darks"], **directorios)
+        crear_masterflat(self.noche["flats"], **directorios)
+        reducir_imagenes_ciencia(self.noche["ciencia"], **directorios)
+        reducidas = ["ciencia_{}".format(im) for im in self.noche["ciencia"]]
+        alinear_imagenes_ciencia(reducidas, directorio_imagenes_reducidas=self.red, metodo="fft")
+        self.alineadas = ["ali_{}".format(im) for im in reducidas]
+
+        #Posiciones de referencia y recentradas en todas las imagenes, para la fotometría.
+        self.posiciones = dao_busqueda(self.alineadas[0], self.red, self.fot, region=None)
+        for imagen in self.alineadas[1:]:
+            dao_recentrar(imagen, self.posiciones, self.red, self.fot)
+        self.datos = abrir_imagenes(self.red).datos(self.alineadas[0])
+
+    def teardown(self, tamano):
+        shutil.rmtree(self.red, ignore_errors=True)
+        shutil.rmtree(self.fot, ignore_errors=True)
+
+    def time_dao_busqueda(self, tamano):
+        dao_busqueda(self.alineadas[0], self.red, self.fot, region=None)
+
+    def peakmem_dao_busqueda(self, tamano):
+        dao_busqueda(self.alineadas[0], self.red, self.fot, region=None)
+
+    def time_dao_recentrar(self, tamano):
+        dao_recentrar(self.alineadas[1], self.posiciones, self.red, self.fot)
+
+    def peakmem_dao_recentrar(self, tamano):
+        dao_recentrar(self.alineadas[1], self.posiciones, self.red, self.fot)
+
+    def time_medir_fotometria_local(self, tamano):
+        medir_fotometria(self.alineadas[1], 6.0, 9.0, 12.0, self.red, self.fot, bkg_type="local")
+
+    def peakmem_medir_fotometria_local(self, tamano):
+        medir_fotometria(self.alineadas[1], 6.0, 9.0, 12.0, self.red, self.fot, bkg_type="local")
+
+    def time_medir_fotometria_global(self, tamano):
+        medir_fotometria(self.alineadas[1], 6.0, directorio_imagenes_reducidas=self.red, directorio_fotometria=self.fot, bkg_type="global")
+
+    def time_medir_fotometria_radios(self, tamano):
+        medir_fotometria(self.alineadas[1], [4.0, 6.0, 8.0, 10.0], 12.0, 15.0, self.red, self.fot, bkg_type="local")
+
+    def time_calcular_fondos(self, tamano):
+        calcular_fondos(self.alineadas, self.red, recalcular=True)
+
+    def peakmem_calcular_fondos(self, tamano):
+        calcular_fondos(self.alineadas, self.red, recalcular=True)
+
+    def time_cielo_anillos(self, tamano):
+        cielo_anillos(self.datos, self.posiciones, 9.0/pix_scale, 12.0/pix_scale)
+
+    def time_operador_aperturas(self, tamano):
+        operador = OperadorAperturas(self.posiciones, [4.0/pix_scale, 6.0/pix_scale, 8.0/pix_scale], self.datos.shape)
+        operador.sumar(self.datos)
+
+    def track_n_fuentes(self, tamano):
+        return len(self.posiciones)
@@ -0,0 +1,90 @@
+import shutil
+import tempfile
+
+from transitos_dha1001 import crear_masterbias, crear_masterdark, crear_masterflat, reducir_imagenes_ciencia, alinear_imagenes_ciencia, combinar_imagenes
+
+from .comunes import tamanos, noche_sintetica
+
+class Calibracion:
+    """
+    Cuadros maestros de calibración y combinación de imagenes.
+
+    """
+
+    params = tamanos
+    param_names = ["tamano"]
+    timeout = 1800
+
+    def setup(self, tamano):
+        self.raw, self.noche = noche_sintetica(tamano)
+        self.red = tempfile.mkdtemp(prefix="red_")
+        self.directorios = dict(directorio_imagenes_originales=self.raw, directorio_imagenes_reducidas=self.red)
+
+        #Los maestros que usan las etapas siguientes.
+        crear_masterbias(self.noche["bias"], **self.directorios)
+        crear_masterdark(self.noche["darks"], **self.directorios)
+
+    def teardown(self, tamano):
+        shutil.rmtree(self.red, ignore_errors=True)
+
+    def time_crear_masterbias(self, tamano):
+        crear_masterbias(self.noche["bias"], **self.directorios)
+
+    def peakmem_crear_masterbias(self, tamano):
+        crear_masterbias(self.noche["bias"], **self.directorios)
+
+    def time_crear_masterdark(self, tamano):
+        crear_masterdark(self.noche["darks"], **self.directorios)
+
+    def peakmem_crear_masterdark(self, tamano):
+        crear_masterdark(self.noche["darks"], **self.directorios)
+
+    def time_crear_masterflat(self, tamano):
+        crear_masterflat(self.noche["flats"], **self.directorios)
+
+    def peakmem_crear_masterflat(self, tamano):
+        crear_masterflat(self.noche["flats"], **self.directorios)
+
+    def time_combinar_imagenes_sigma(self, tamano):
+        combinar_imagenes(["{}/{}".format(self.raw, im) for im in self.noche["flats"]], rechazo="sigma", normalizar=True)
+
+    def peakmem_combinar_imagenes_sigma(self, tamano):
+        combinar_imagenes(["{}/{}".format(self.raw, im) for im in self.noche["flats"]], rechazo="sigma", normalizar=True)
+
+class Ciencia:
+    """
+    Reducción y alineamiento de las imagenes de ciencia.
+
+    """
+
+    params = tamanos
+    param_names = ["tamano"]
+    timeout = 3600
+
+    def setup(self, tamano):
+        self.raw, self.noche = noche_sintetica(tamano)
+        self.red = tempfile.mkdtemp(prefix="red_")
+        self.directorios = dict(directorio_imagenes_originales=self.raw, directorio_imagenes_reducidas=self.red)
+        crear_masterbias(self.noche["bias"], **self.directorios)
+        crear_masterdark(self.noche["darks"], **self.directorios)
+        crear_masterflat(self.noche["flats"], **self.directorios)
+        reducir_imagenes_ciencia(self.noche["ciencia"], **self.directorios)
+        self.reducidas = ["ciencia_{}".format(im) for im in self.noche["ciencia"]]
+
+    def teardown(self, tamano):
+        shutil.rmtree(self.red, ignore_errors=True)
+
+    def time_reducir_imagenes_ciencia(self, tamano):
+        reducir_imagenes_ciencia(self.noche["ciencia"], **self.directorios)
+
+    def peakmem_reducir_imagenes_ciencia(self, tamano):
+        reducir_imagenes_ciencia(self.noche["ciencia"], **self.directorios)
+
+    def time_reducir_sin_rayos_cosmicos(self, tamano):
+        reducir_imagenes_ciencia(self.noche["ciencia"], reyeccion_rayos_cosmicos=False, **self.directorios)
+
+    def time_alinear_imagenes_ciencia(self, tamano):
+        alinear_imagenes_ciencia(self.reducidas, directorio_imagenes_reducidas=self.red, metodo="fft")
+
+    def peakmem_alinear_imagenes_ciencia(self, tamano):
+        alinear_imagenes_ciencia(self.reducidas, directorio_imagenes_reducidas=self.red, metodo="fft")
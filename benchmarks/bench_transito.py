@@ -0,0 +1,56 @@
+import numpy as np
+import shutil
+import tempfile
+
+from transitos_dha1001 import crear_masterbias, crear_masterdark, crear_masterflat, reducir_imagenes_ciencia, alinear_imagenes_ciencia
+from transitos_dha1001 import dao_busqueda, dao_recentrar, medir_fotometria, curvas_de_luz
+
+from .comunes import tamanos, noche_sintetica
+
+class Transito:
+    """
+    Noche sintética completa, desde las imagenes originales hasta la curva de luz, para revisar que la profundidad del tránsito inyectado se recupera. Todo el pipeline se ejecuta en setup; la profundidad se mide con curvas_de_luz en las imagenes completamente dentro y completamente fuera del tránsito. Con 60 imagenes el error estadístico de la profundidad es cerca de 1% de un tránsito de 5%, así que el límite de 4% detecta sesgos de unos pocos por ciento.
+
+    """
+
+    params = tamanos
+    param_names = ["tamano"]
+    timeout = 7200
+    n_ciencia = 60
+    profundidad = 0.05
+    limites = {"track_error_profundidad": 0.04}
+
+    def setup(self, tamano):
+        self.raw, self.noche = noche_sintetica(tamano, n_ciencia=self.n_ciencia, profundidad=self.profundidad)
+        self.red = tempfile.mkdtemp(prefix="red_")
+        self.fot = tempfile.mkdtemp(prefix="fot_")
+        directorios = dict(directorio_imagenes_originales=self.raw, directorio_imagenes_reducidas=self.red)
+        crear_masterbias(self.noche["bias"], **directorios)
+        crear_masterdark(self.noche["darks"], **directorios)
+        crear_masterflat(self.noche["flats"], **directorios)
+        reducir_imagenes_ciencia(self.noche["ciencia"], **directorios)
+        reducidas = ["ciencia_{}".format(im) for im in self.noche["ciencia"]]
+        alinear_imagenes_ciencia(reducidas, directorio_imagenes_reducidas=self.red, metodo="fft")
+        alineadas = ["ali_{}".format(im) for im in reducidas]
+
+        posiciones = dao_busqueda(alineadas[0], self.red, self.fot, region=None)
+        for imagen in alineadas[1:]:
+            dao_recentrar(imagen, posiciones, self.red, self.fot)
+        for imagen in alineadas:
+            medir_fotometria(imagen, 6.0, 9.0, 12.0, self.red, self.fot, bkg_type="local")
+        self.mag = curvas_de_luz(alineadas, self.red, self.fot)[1]
+        self.objetivo = np.argmin(np.hypot(*(posiciones - self.noche["posiciones"][self.noche["objetivo"]]).T))
+
+    def teardown(self, tamano):
+        shutil.rmtree(self.red, ignore_errors=True)
+        shutil.rmtree(self.fot, ignore_errors=True)
+
+    def track_profundidad(self, tamano):
+        curva = self.noche["curva"]
+        mag = self.mag[:, self.objetivo]
+        dentro = curva <= 1. - 0.999*self.noche["profundidad"]
+        fuera = curva == 1.
+        return 1. - 10**(-0.4*(np.nanmean(mag[dentro]) - np.nanmean(mag[fuera])))
+
+    def track_error_profundidad(self, tamano):
+        return abs(self.track_profundidad(tamano) - self.noche["profundidad"])/self.noche["profundidad"]
@@ -0,0 +1,34 @@
+import numpy as np
+import json
+import os
+import tempfile
+
+from transitos_dha1001.sintetico import generar_noche
+
+#Tamaños de las imagenes en los que se mide cada etapa.
+tamanos = [1024, 2048, 4096]
+
+#Las noches sintéticas se guardan aquí y se reutilizan entre ejecuciones, pues generarlas a 4096 pixeles toma un rato.
+directorio_datos = os.environ.get("TRANSITOS_BENCHMARKS", os.path.join(tempfile.gettempdir(), "transitos_benchmarks"))
+
+def noche_sintetica(tamano, n_ciencia=4, n_calibracion=5, n_estrellas=None, profundidad=0.01, semilla=1):
+    """
+    Devuelve el directorio de imagenes originales y los datos (ver generar_noche) de una noche sintética del tamaño pedido, generándola solo si no existe todavía.
+
+    """
+
+    n_estrellas = int(150*(tamano/1024)**2) if n_estrellas is None else n_estrellas
+    raw = os.path.join(directorio_datos, "noche_{}_{}_{}_{}_{}_{}".format(tamano, n_ciencia, n_calibracion, n_estrellas, profundidad, semilla))
+    archivo = os.path.join(raw, "noche.json")
+    if not os.path.exists(archivo):
+        datos = generar_noche(raw, tamano=tamano, n_bias=n_calibracion, n_darks=n_calibracion, n_flats=n_calibracion,
+                              n_ciencia=n_ciencia, n_estrellas=n_estrellas, profundidad=profundidad, semilla=semilla)
+        with open(archivo + ".tmp", "w") as f:
+            json.dump({clave: valor.tolist() if isinstance(valor, np.ndarray) else valor for clave, valor in datos.items()}, f)
+        os.replace(archivo + ".tmp", archivo)
+
+    with open(archivo) as f:
+        datos = json.load(f)
+    for clave in ("posiciones", "flujos", "desplazamientos", "curva", "airmass", "mjd"):
+        datos[clave] = np.asarray(datos[clave])
+    return raw, datos
@@ -0,0 +1,134 @@
+"""
+Ejecuta los benchmarks de este directorio, escritos con las convenciones de asv: clases con params y param_names, setup y teardown, y métodos time_ (tiempo), peakmem_ (memoria máxima) y track_ (un valor que se registra). Si una clase tiene el atributo limites, un diccionario con el valor máximo de algunos métodos track_, los valores que lo superan se marcan como fallas.
+
+Uso, desde la raíz del repositorio:
+
+    python -m benchmarks.correr [filtro] [--tamanos 1024 2048] [--repeticiones 3] [--salida resultados.json]
+
+El tiempo es el mínimo de las repeticiones. La memoria máxima se mide con tracemalloc, así que incluye los arreglos de numpy pero no la memoria que no pasa por el asignador de Python.
+
+"""
+
+import numpy as np
+import argparse
+import functools
+import importlib
+import inspect
+import itertools
+import json
+import pkgutil
+import re
+import sys
+import time
+import tracemalloc
+
+import benchmarks
+
+def buscar_benchmarks(filtro=None):
+    """
+    Devuelve las clases de los módulos bench_*, y sus métodos time_, peakmem_ y track_ cuyo nombre completo (modulo.Clase.metodo) coincide con filtro.
+
+    """
+
+    encontrados = []
+    for modulo in pkgutil.iter_modules(benchmarks.__path__):
+        if not modulo.name.startswith("bench_"):
+            continue
+        modulo = importlib.import_module("benchmarks.{}".format(modulo.name))
+        for nombre, clase in inspect.getmembers(modulo, inspect.isclass):
+            if clase.__module__ != modulo.__name__:
+                continue
+            metodos = [m for m in dir(clase) if re.match("(time|peakmem|track)_", m)]
+            metodos = [m for m in metodos if filtro is None or re.search(filtro, "{}.{}.{}".format(modulo.__name__, nombre, m))]
+            if len(metodos) > 0:
+                encontrados.append((clase, metodos))
+    return encontrados
+
+def combinaciones(clase, tamanos=None):
+    """
+    Devuelve las combinaciones de parámetros de una clase, como tuplas. Si se entregan tamanos, las clases con el parámetro tamano solo se ejecutan con esos valores.
+
+    """
+
+    params = getattr(clase, "params", [])
+    nombres = getattr(clase, "param_names", [])
+    if len(nombres) == 0:
+        return [()]
+    listas = params if len(nombres) > 1 else [params]
+    listas = [[v for v in lista if tamanos is None or nombre != "tamano" or v in tamanos] for nombre, lista in zip(nombres, listas)]
+    return list(itertools.product(*listas))
+
+def medir(funcion, tipo, repeticiones):
+
+    #Tiempo mínimo, memoria máxima en MB, o el valor devuelto.
+    if tipo == "time":
+        tiempos = []
+        for k in range(repeticiones):
+            inicio = time.perf_counter()
+            funcion()
+            tiempos.append(time.perf_counter() - inicio)
+        return min(tiempos)
+    if tipo == "peakmem":
+        tracemalloc.start()
+        try:
+            funcion()
+            return tracemalloc.get_traced_memory()[1]/2**20
+        finally:
+            tracemalloc.stop()
+    return float(funcion())
+
+def correr(filtro=None, tamanos=None, repeticiones=3, salida=None):
+    """
+    Ejecuta los benchmarks y devuelve la lista de resultados, cada uno con el nombre, los parámetros, el tipo, el valor y si quedó dentro de su límite. Si se entrega salida, los resultados se guardan en ese archivo JSON.
+
+    """
+
+    unidades = {"time": "s", "peakmem": "MB", "track": ""}
+    resultados = []
+    for clase, metodos in buscar_benchmarks(filtro):
+        limites = getattr(clase, "limites", {})
+        for parametros in combinaciones(clase, tamanos):
+            instancia = clase()
+            nombre_clase = "{}.{}".format(clase.__module__.split(".")[-1], clase.__name__)
+            try:
+                if hasattr(instancia, "setup"):
+                    instancia.setup(*parametros)
+            except Exception as e:
+                print("{}{}: falló setup: {!r}".format(nombre_clase, list(parametros), e))
+                resultados.append({"nombre": nombre_clase, "parametros": list(parametros), "error": repr(e), "dentro_del_limite": False})
+                continue
+
+            for metodo in metodos:
+                tipo = metodo.split("_")[0]
+                funcion = getattr(instancia, metodo)
+                resultado = {"nombre": "{}.{}".format(nombre_clase, metodo), "parametros": list(parametros), "tipo": tipo}
+                try:
+                    valor = medir(functools.partial(funcion, *parametros), tipo, repeticiones)
+                    resultado["valor"] = valor
+                    resultado["dentro_del_limite"] = metodo not in limites or bool(np.isfinite(valor) and valor <= limites[metodo])
+                    marca = "" if resultado["dentro_del_limite"] else "  FUERA DEL LÍMITE ({})".format(limites[metodo])
+                    print("{:60s} {:20s} {:12.4g} {}{}".format(resultado["nombre"], str(list(parametros)), valor, unidades[tipo], marca))
+                except Exception as e:
+                    resultado["error"] = repr(e)
+                    resultado["dentro_del_limite"] = False
+                    print("{:60s} {:20s} falló: {!r}".format(resultado["nombre"], str(list(parametros)), e))
+                resultados.append(resultado)
+
+            if hasattr(instancia, "teardown"):
+                instancia.teardown(*parametros)
+
+    if salida is not None:
+        with open(salida, "w") as f:
+            json.dump(resultados, f, indent=1)
+    return resultados
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ejecuta los benchmarks de transitos_dha1001.")
+    parser.add_argument("filtro", nargs="?", default=None, help="Expresión regular para elegir los benchmarks (modulo.Clase.metodo).")
+    parser.add_argument("--tamanos", nargs="+", type=int, default=None, help="Tamaños de las imagenes que se miden.")
+    parser.add_argument("--repeticiones", type=int, default=3, help="Repeticiones de cada medición de tiempo.")
+    parser.add_argument("--salida", default=None, help="Archivo JSON donde se guardan los resultados.")
+    argumentos = parser.parse_args()
+
+    resultados = correr(argumentos.filtro, argumentos.tamanos, argumentos.repeticiones, argumentos.salida)
+    sys.exit(0 if all(r["dentro_del_limite"] for r in resultados) else 1)
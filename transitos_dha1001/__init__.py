@@ -4,10 +4,28 @@ name = "transitos_dha1001"
 from .reduccion.master_bias import crear_masterbias
 from .reduccion.master_dark import crear_masterdark
 from .reduccion.master_flat import crear_masterflat
-from .reduccion.science import reducir_imagenes_ciencia
+from .reduccion.science import reducir_imagenes_ciencia, reducir_imagen
 from .reduccion.desplegar_imagenes import desplegar_imagen
-from .reduccion.alinear import alinear_imagenes_ciencia
+from .reduccion.alinear import alinear_imagenes_ciencia, AlineadorFFT, leer_transformaciones, transformar_posiciones
+from .reduccion.combinar import combinar_imagenes
+from .reduccion.calibracion import NucleoCalibracion
+from .reduccion.cubo import AccesoImagenes, escribir_cubo
+from .reduccion.indice import indice_imagenes
 
-from .fotometria.dao import dao_busqueda, dao_recentrar, filtrar_posiciones
-from .fotometria.phot import medir_fotometria
-from .fotometria.curva_de_luz import curva_de_luz, graficar_curva_de_luz
+from .fotometria.dao import dao_busqueda, dao_recentrar, dao_recentrar_lote, filtrar_posiciones
+from .fotometria.phot import medir_fotometria, leer_fotometria
+from .fotometria.aperturas import OperadorAperturas
+from .fotometria.fondo import ModeloFondo, calcular_fondos
+from .fotometria.catalogo import CatalogoFuentes
+from .fotometria.almacen import AlmacenFotometria
+from .fotometria.tiempos import tiempos_imagenes
+from .fotometria.ensamble import fotometria_diferencial
+from .fotometria.tendencias import matriz_regresores, mascara_transito, ajustar_tendencias
+from .fotometria.curva_de_luz import curva_de_luz, curvas_de_luz, graficar_curva_de_luz, elegir_apertura, CurvaDeLuzIncremental
+
+from .ajuste import modelo_transito, magnitud_modelo, busqueda_grilla, mcmc_ensamble, ajustar_transito
+from .busqueda import busqueda_bls
+from .pipeline import Pipeline, pipeline_noche
+from .lote import leer_manifiesto, procesar_noche, ejecutar_lote
+from .sintetico import generar_noche
+from .en_vivo import curva_de_luz_en_vivo
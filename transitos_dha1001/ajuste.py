@@ -0,0 +1,327 @@
+import numpy as np
+
+from scipy.optimize import least_squares
+from concurrent.futures import ProcessPoolExecutor
+
+nombres_parametros = ("t0", "rp", "a", "b", "m0")
+
+def modelo_transito(t, t0, rp, a, b, periodo, u1=0.4, u2=0.25, n_anillos=16):
+    """
+    Flujo relativo de una estrella con oscurecimiento al limbo cuadrático durante el tránsito de un planeta, para muchos conjuntos de parámetros a la vez. El flujo tapado es la integral sobre el radio r de la intensidad I(r) por el largo del arco del círculo de radio r que cae dentro del planeta. La parte de la estrella que el planeta tapa completa (r < rp - z, con z la distancia entre los centros) se integra exactamente, y el resto, entre |z-rp| y z+rp, con una cuadratura de Gauss-Legendre de n_anillos radios, después de un cambio de variable que suaviza las raíces cuadradas de los extremos. El modelo de Mandel y Agol es la forma analítica de esta misma integral: comparado con una integración adaptativa de alta precisión, el error máximo es del orden de 1e-9 con 16 radios y de 5e-7 con 8. Como todo son operaciones sobre arreglos, evaluar miles de modelos es una sola llamada.
+
+    Los parámetros pueden ser escalares o arreglos de N valores. Devuelve un arreglo de (N x tiempos), o de una dimensión si todos los parámetros son escalares.
+
+    Parametros
+    ----------
+
+    t: numpy array
+        Tiempos, en días.
+
+    t0: float o numpy array
+        Tiempo del centro del tránsito.
+
+    rp: float o numpy array
+        Radio del planeta en unidades del radio de la estrella.
+
+    a: float o numpy array
+        Semieje mayor de la órbita en unidades del radio de la estrella.
+
+    b: float o numpy array
+        Parámetro de impacto, en unidades del radio de la estrella.
+
+    periodo: float
+        Periodo de la órbita, en días.
+
+    u1, u2: float, opcional
+        Coeficientes del oscurecimiento al limbo cuadrático.
+
+    n_anillos: int, opcional
+        Número de radios (anillos delgados) de la cuadratura sobre la parte de la estrella que el planeta tapa solo en parte.
+
+    """
+
+    t = np.asarray(t, dtype=np.float64)
+    escalar = all(np.ndim(p) == 0 for p in (t0, rp, a, b))
+    t0, rp, a, b = [np.atleast_1d(np.asarray(p, dtype=np.float64))[:,None] for p in (t0, rp, a, b)]
+
+    #Distancia proyectada entre los centros, en radios de la estrella. Solo hay tránsito cuando el planeta está delante de la estrella.
+    fase = 2.*np.pi*(t[None] - t0)/periodo
+    z = np.hypot(a*np.sin(fase), b*np.cos(fase))
+    z = np.where(np.cos(fase) > 0, z, np.inf)
+    rp = np.broadcast_to(rp, z.shape)
+
+    #Solo se calcula el flujo tapado en los puntos donde el planeta está sobre la estrella.
+    flujo = np.ones(z.shape)
+    en_transito = z < 1. + rp
+    if np.any(en_transito):
+        p = rp[en_transito][:,None]
+        d = z[en_transito][:,None]
+
+        #Radios de la cuadratura entre |z-rp| y z+rp (recortados al borde de la estrella), con r = c - h*cos(phi) y los nodos de Gauss-Legendre en phi.
+        x, w = np.polynomial.legendre.leggauss(n_anillos)
+        phi, w = 0.5*np.pi*(x + 1.), 0.5*np.pi*w
+        r_min = np.minimum(np.abs(d - p), 1.)
+        r_max = np.maximum(np.minimum(d + p, 1.), r_min)
+        r = 0.5*(r_min + r_max) - 0.5*(r_max - r_min)*np.cos(phi)[None]
+        dr = 0.5*(r_max - r_min)*np.sin(phi)[None]*w[None]
+
+        #Ángulo del arco de cada círculo que cae dentro del planeta, y la intensidad en ese radio.
+        arco = 2.*np.arccos(np.clip((r**2 + d**2 - p**2) / np.maximum(2.*r*d, 1e-300), -1., 1.))
+        mu = np.sqrt(np.maximum(1. - r**2, 0.))
+        intensidad = 1. - u1*(1. - mu) - u2*(1. - mu)**2
+
+        #Flujo tapado: el disco que el planeta cubre completo más la integral sobre los arcos.
+        tapado = _flujo_disco(np.maximum(p - d, 0.)[:,0], u1, u2) + np.sum(intensidad*r*arco*dr, axis=1)
+        flujo[en_transito] = 1. - tapado / _flujo_disco(1., u1, u2)
+
+    return flujo[0] if escalar else flujo
+
+def _flujo_disco(r, u1, u2):
+
+    #Flujo dentro del radio r de una estrella con oscurecimiento cuadrático, integrando 2*pi*r*I(r) con mu = sqrt(1 - r^2).
+    return np.pi*(_primitiva_flujo(1., u1, u2) - _primitiva_flujo(np.sqrt(np.maximum(1. - np.asarray(r)**2, 0.)), u1, u2))
+
+def _primitiva_flujo(mu, u1, u2):
+    return (1. - u1 - u2)*mu**2 + (2./3.)*(u1 + 2.*u2)*mu**3 - 0.5*u2*mu**4
+
+def magnitud_modelo(t, parametros, periodo, u1=0.4, u2=0.25, n_anillos=16):
+    """
+    Magnitud del modelo para uno o varios conjuntos de parámetros (t0, rp, a, b, m0), donde m0 es la magnitud fuera del tránsito. parametros puede ser un arreglo de 5 valores o de (N x 5).
+
+    """
+
+    parametros = np.asarray(parametros, dtype=np.float64)
+    p = np.atleast_2d(parametros)
+    flujo = modelo_transito(t, p[:,0], p[:,1], p[:,2], p[:,3], periodo, u1, u2, n_anillos)
+    mag = p[:,4:5] - 2.5*np.log10(flujo)
+    return mag[0] if parametros.ndim == 1 else mag
+
+def busqueda_grilla(t, mag, mag_err, periodo, t0=None, rp=None, a=None, b=None, u1=0.4, u2=0.25, n_anillos=8, modelos_bloque=2000):
+    """
+    Busca el mejor modelo en una grilla de (t0, rp, a, b). Para cada punto de la grilla, la magnitud fuera del tránsito m0 se calcula directamente como el promedio pesado de la diferencia entre los datos y el modelo. Los modelos se evalúan de a modelos_bloque a la vez.
+
+    Devuelve los mejores parámetros (t0, rp, a, b, m0) y su chi cuadrado.
+
+    Parametros
+    ----------
+
+    t, mag, mag_err: numpy array
+        Curva de luz, como la que entrega curva_de_luz.
+
+    periodo: float
+        Periodo de la órbita, en días.
+
+    t0, rp, a, b: numpy array, opcional
+        Valores de cada parámetro en la grilla. Si son None, se usan valores que cubren los datos y los tránsitos típicos.
+
+    u1, u2, n_anillos: opcionales
+        Igual que en modelo_transito. Para la grilla bastan pocos anillos.
+
+    modelos_bloque: int, opcional
+        Número de modelos que se evalúan a la vez.
+
+    """
+
+    t, mag, mag_err = [np.asarray(v, dtype=np.float64) for v in (t, mag, mag_err)]
+    if t0 is None:
+        t0 = np.linspace(t.min(), t.max(), 40)
+    if rp is None:
+        rp = np.linspace(0.03, 0.3, 20)
+    if a is None:
+        a = np.geomspace(3., 30., 12)
+    if b is None:
+        b = np.array([0., 0.3, 0.5, 0.7, 0.85])
+    grilla = np.stack([g.ravel() for g in np.meshgrid(t0, rp, a, b, indexing='ij')], axis=1)
+
+    pesos = 1./mag_err**2
+    chi2 = np.empty(len(grilla))
+    m0 = np.empty(len(grilla))
+    for ini in range(0, len(grilla), modelos_bloque):
+        g = grilla[ini:ini+modelos_bloque]
+        delta = -2.5*np.log10(modelo_transito(t, g[:,0], g[:,1], g[:,2], g[:,3], periodo, u1, u2, n_anillos))
+        m0[ini:ini+modelos_bloque] = np.sum(pesos*(mag - delta), axis=1) / np.sum(pesos)
+        chi2[ini:ini+modelos_bloque] = np.sum(pesos*(mag - delta - m0[ini:ini+modelos_bloque,None])**2, axis=1)
+
+    k = np.argmin(chi2)
+    return np.append(grilla[k], m0[k]), chi2[k]
+
+class LogProbTransito:
+    """
+    Logaritmo de la probabilidad posterior de los parámetros (t0, rp, a, b, m0) dada una curva de luz, con priors uniformes dentro de límites. Se llama con un arreglo de (N x 5) y devuelve N valores, evaluando todos los modelos a la vez. Como es una clase y no una función local, se puede enviar a otros procesos.
+
+    """
+
+    def __init__(self, t, mag, mag_err, periodo, u1=0.4, u2=0.25, n_anillos=16, limites=None):
+        self.t = np.asarray(t, dtype=np.float64)
+        self.mag = np.asarray(mag, dtype=np.float64)
+        self.pesos = 1./np.asarray(mag_err, dtype=np.float64)**2
+        self.periodo = periodo
+        self.u1 = u1
+        self.u2 = u2
+        self.n_anillos = n_anillos
+        self.limites = _limites(self.t) if limites is None else limites
+
+    def __call__(self, parametros):
+        parametros = np.atleast_2d(parametros)
+        log_prob = np.full(len(parametros), -np.inf)
+        inferior, superior = self.limites
+        validos = np.all((parametros >= inferior) & (parametros <= superior), axis=1) & (parametros[:,3] < 1. + parametros[:,1])
+        if np.any(validos):
+            modelo = magnitud_modelo(self.t, parametros[validos], self.periodo, self.u1, self.u2, self.n_anillos)
+            log_prob[validos] = -0.5*np.sum(self.pesos*(self.mag - modelo)**2, axis=1)
+        return log_prob
+
+def _limites(t):
+    inferior = np.array([t.min() - 0.1, 1e-3, 1.5, 0., -np.inf])
+    superior = np.array([t.max() + 0.1, 0.5, 200., 1.2, np.inf])
+    return inferior, superior
+
+def mcmc_ensamble(log_prob, inicial, n_pasos=2000, escala=2.0, n_procesos=1, semilla=None):
+    """
+    Muestreador MCMC por ensamble, invariante ante transformaciones afines (Goodman y Weare 2010, el mismo algoritmo que usa emcee). Los caminantes se dividen en dos mitades, y cada mitad se mueve a la vez con propuestas de estiramiento hacia la otra mitad, así que en cada paso log_prob se llama solo dos veces, con todos los caminantes de una mitad. Si n_procesos es mayor que 1, los caminantes de cada mitad se reparten entre procesos.
+
+    Devuelve la cadena de (pasos x caminantes x parámetros) y el logaritmo de la probabilidad de cada punto.
+
+    Parametros
+    ----------
+
+    log_prob: función
+        Función que recibe un arreglo de (N x parámetros) y devuelve N valores, como LogProbTransito.
+
+    inicial: numpy array
+        Posición inicial de los caminantes, de (caminantes x parámetros). El número de caminantes debe ser par y al menos el doble del número de parámetros.
+
+    n_pasos: int, opcional
+        Número de pasos.
+
+    escala: float, opcional
+        Parámetro de escala de las propuestas de estiramiento.
+
+    n_procesos: int, opcional
+        Número de procesos para evaluar log_prob.
+
+    semilla: int, opcional
+        Semilla de los números aleatorios.
+
+    """
+
+    rng = np.random.default_rng(semilla)
+    posicion = np.array(inicial, dtype=np.float64)
+    n_caminantes, n_dim = posicion.shape
+    mitad = n_caminantes // 2
+
+    ejecutor = ProcessPoolExecutor(max_workers=n_procesos) if n_procesos > 1 else None
+    def evaluar(puntos):
+        if ejecutor is None:
+            return log_prob(puntos)
+        return np.concatenate(list(ejecutor.map(log_prob, np.array_split(puntos, n_procesos))))
+
+    cadena = np.empty((n_pasos, n_caminantes, n_dim))
+    log_probs = np.empty((n_pasos, n_caminantes))
+    try:
+        lp = evaluar(posicion)
+        for paso in range(n_pasos):
+            for activos, complemento in ((slice(0, mitad), slice(mitad, None)), (slice(mitad, None), slice(0, mitad))):
+                x = posicion[activos]
+                otros = posicion[complemento]
+
+                #Propuesta de estiramiento: z distribuido como 1/sqrt(z) entre 1/escala y escala.
+                z = ((escala - 1.)*rng.random(len(x)) + 1.)**2 / escala
+                y = otros[rng.integers(len(otros), size=len(x))]
+                propuesta = y + z[:,None]*(x - y)
+                lp_propuesta = evaluar(propuesta)
+
+                aceptar = np.log(rng.random(len(x))) < (n_dim - 1.)*np.log(z) + lp_propuesta - lp[activos]
+                x[aceptar] = propuesta[aceptar]
+                lp[activos] = np.where(aceptar, lp_propuesta, lp[activos])
+                posicion[activos] = x
+
+            cadena[paso] = posicion
+            log_probs[paso] = lp
+    finally:
+        if ejecutor is not None:
+            ejecutor.shutdown()
+
+    return cadena, log_probs
+
+def _residuos(parametros, t, mag, mag_err, periodo, u1, u2, n_anillos):
+    return (mag - magnitud_modelo(t, parametros, periodo, u1, u2, n_anillos))/mag_err
+
+def ajustar_transito(t, mag, mag_err, periodo, u1=0.4, u2=0.25, mcmc=True, n_caminantes=32, n_pasos=2000, descartar=None, n_procesos=1, semilla=None, n_anillos=16):
+    """
+    Ajusta el modelo de tránsito a una curva de luz, por ejemplo la que entrega curva_de_luz, y entrega el radio del planeta en unidades del radio de la estrella con su incertidumbre. Primero se busca el mejor modelo en una grilla (busqueda_grilla), luego se refina con mínimos cuadrados (least_squares) y, si se pide, se muestrea la probabilidad posterior con mcmc_ensamble partiendo alrededor del mejor ajuste.
+
+    Devuelve un diccionario con los parámetros (t0, rp, a, b, m0) del mejor ajuste, sus errores, y si se usó el MCMC, la mediana y los percentiles 16 y 84 de cada parámetro, la cadena y su logaritmo de la probabilidad. rp y rp_err resumen el resultado para el radio.
+
+    Parametros
+    ----------
+
+    t, mag, mag_err: numpy array o lista
+        Curva de luz: tiempos en días, magnitudes y errores.
+
+    periodo: float
+        Periodo de la órbita, en días.
+
+    u1, u2: float, opcional
+        Coeficientes del oscurecimiento al limbo cuadrático.
+
+    mcmc: bool, opcional
+        Si es True, se estiman las incertidumbres con el MCMC. Si es False, salen de la matriz de covarianza del ajuste por mínimos cuadrados.
+
+    n_caminantes, n_pasos: int, opcional
+        Número de caminantes y de pasos del MCMC.
+
+    descartar: int, opcional
+        Número de pasos iniciales del MCMC que se descartan. Si es None, se descarta la primera mitad.
+
+    n_procesos: int, opcional
+        Número de procesos entre los que se reparten los caminantes.
+
+    semilla: int, opcional
+        Semilla de los números aleatorios.
+
+    n_anillos: int, opcional
+        Número de anillos del modelo. Ver modelo_transito.
+
+    """
+
+    t, mag, mag_err = [np.asarray(v, dtype=np.float64) for v in (t, mag, mag_err)]
+    buenos = np.isfinite(t) & np.isfinite(mag) & np.isfinite(mag_err) & (mag_err > 0)
+    t, mag, mag_err = t[buenos], mag[buenos], mag_err[buenos]
+
+    #Grilla y mínimos cuadrados.
+    inicial, chi2 = busqueda_grilla(t, mag, mag_err, periodo, u1=u1, u2=u2)
+    inferior, superior = _limites(t)
+    inicial = np.clip(inicial, inferior + 1e-9, superior - 1e-9)
+    ajuste = least_squares(_residuos, inicial, bounds=(inferior, superior), x_scale='jac', args=(t, mag, mag_err, periodo, u1, u2, n_anillos))
+
+    resultado = {"parametros": dict(zip(nombres_parametros, ajuste.x)), "chi2": 2.*ajuste.cost, "n_puntos": len(t)}
+    try:
+        covarianza = np.linalg.inv(ajuste.jac.T @ ajuste.jac)
+        errores = np.sqrt(np.diag(covarianza))
+    except np.linalg.LinAlgError:
+        errores = np.full(len(ajuste.x), np.nan)
+    resultado["errores"] = dict(zip(nombres_parametros, errores))
+    resultado["rp"] = ajuste.x[1]
+    resultado["rp_err"] = (errores[1], errores[1])
+
+    if not mcmc:
+        return resultado
+
+    #MCMC partiendo en una pequeña nube alrededor del mejor ajuste.
+    rng = np.random.default_rng(semilla)
+    escala = np.where(np.isfinite(errores) & (errores > 0), errores, 1e-4*np.maximum(np.abs(ajuste.x), 1.))
+    log_prob = LogProbTransito(t, mag, mag_err, periodo, u1, u2, n_anillos, (inferior, superior))
+    inicial = ajuste.x + 0.1*escala*rng.standard_normal((n_caminantes, len(ajuste.x)))
+    inicial = np.clip(inicial, inferior + 1e-9, superior - 1e-9)
+    cadena, log_probs = mcmc_ensamble(log_prob, inicial, n_pasos, n_procesos=n_procesos, semilla=semilla)
+
+    descartar = n_pasos // 2 if descartar is None else descartar
+    muestras = cadena[descartar:].reshape(-1, cadena.shape[2])
+    p16, p50, p84 = np.percentile(muestras, [16, 50, 84], axis=0)
+    resultado["mcmc"] = {n: (p50[k], p50[k] - p16[k], p84[k] - p50[k]) for k, n in enumerate(nombres_parametros)}
+    resultado["cadena"] = cadena
+    resultado["log_prob"] = log_probs
+    resultado["rp"] = p50[1]
+    resultado["rp_err"] = (p50[1] - p16[1], p84[1] - p50[1])
+    return resultado
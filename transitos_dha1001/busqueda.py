@@ -0,0 +1,209 @@
+import numpy as np
+
+from astropy.table import Table
+from scipy import sparse
+from concurrent.futures import ProcessPoolExecutor
+
+def busqueda_bls(tiempo, mag, mag_err=None, periodos=None, duraciones=(0.03, 0.045, 0.06, 0.09, 0.12), periodo_min=0.3, periodo_max=None, sobremuestreo=2, puntos_minimos=3, snr_minimo=0., n_procesos=1, fuentes_bloque=1000):
+    """
+    Busca tránsitos en las curvas de luz de todas las fuentes a la vez con el método Box Least Squares (Kovács et al. 2002), a partir del arreglo de (imagenes x fuentes) con las magnitudes, como el que entrega curvas_de_luz. Para cada periodo las imagenes se ordenan una sola vez por fase y se agrupan en intervalos de fase; las sumas de cada intervalo salen de un solo producto de una matriz dispersa de pertenencia (con un elemento por grupo de imagenes) por los datos de todas las fuentes a la vez, y las de cada caja (para todas las duraciones y fases) de sumas acumuladas sobre los intervalos. Las fuentes se procesan en bloques, que se pueden repartir entre procesos.
+
+    Si las imagenes cubren menos de dos veces periodo_min (por ejemplo una sola noche), y no se entregan periodos, se busca un solo evento en la curva sin doblar, y el periodo de los candidatos es inf.
+
+    Conviene quitar antes las tendencias de las curvas (ver ajustar_tendencias), ya que la caja se compara con un nivel constante fuera del tránsito.
+
+    Devuelve una tabla con el mejor candidato de cada fuente, ordenada de mayor a menor SNR, con las columnas fuente (índice de la columna de mag), snr, profundidad (en magnitudes), periodo, t0 (centro del tránsito), duracion, n_puntos (imagenes dentro del tránsito) y sde (señal sobre el espectro de cada fuente, NaN si hay un solo periodo). También devuelve los periodos probados y el espectro de (fuentes x periodos), con el mejor SNR de cada fuente en cada periodo.
+
+    Parámetros
+    ----------
+
+    tiempo: numpy array
+        Tiempo de cada imagen, en días.
+
+    mag: numpy array
+        Magnitudes de (imagenes x fuentes), o de una sola fuente. Las mediciones que faltan deben ser NaN.
+
+    mag_err: numpy array, opcional
+        Errores de las magnitudes. Si es None, todas las mediciones de una fuente pesan lo mismo, con la dispersión de la fuente como error.
+
+    periodos: numpy array, opcional
+        Periodos a probar, en días. Si es None, se usa una grilla uniforme en el logaritmo del periodo entre periodo_min y periodo_max, con un paso relativo igual al ancho de los intervalos de fase dividido por el tiempo cubierto.
+
+    duraciones: lista, opcional
+        Duraciones de los tránsitos a probar, en días.
+
+    periodo_min, periodo_max: float, opcional
+        Límites de la grilla de periodos. Si periodo_max es None, es la mitad del tiempo cubierto, para que haya al menos dos tránsitos.
+
+    sobremuestreo: float, opcional
+        Número de pasos de la grilla (y de intervalos de fase) por cada duración mínima. Con valores más altos la búsqueda es más fina pero más lenta.
+
+    puntos_minimos: int, opcional
+        Número mínimo de imagenes dentro de la caja.
+
+    snr_minimo: float, opcional
+        Solo se devuelven los candidatos con un SNR mayor o igual a este valor.
+
+    n_procesos: int, opcional
+        Número de procesos entre los que se reparten los bloques de fuentes.
+
+    fuentes_bloque: int, opcional
+        Número de fuentes que se procesan a la vez.
+
+    """
+
+    tiempo = np.asarray(tiempo, dtype=np.float64)
+    mag = np.asarray(mag, dtype=np.float64)
+    if mag.ndim == 1:
+        mag = mag[:,None]
+        mag_err = None if mag_err is None else np.asarray(mag_err)[:,None]
+
+    #Pesos de cada medición (cero si falta) y magnitudes sin el promedio pesado de cada fuente.
+    validos = np.isfinite(mag) & np.isfinite(tiempo)[:,None]
+    if mag_err is None:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            pesos = np.where(validos, 1./np.nanstd(np.where(validos, mag, np.nan), axis=0)**2, 0.)
+    else:
+        mag_err = np.asarray(mag_err, dtype=np.float64)
+        pesos = np.where(validos & np.isfinite(mag_err), 1./np.maximum(np.nan_to_num(mag_err, nan=1.), 1e-6)**2, 0.)
+    pesos = np.nan_to_num(pesos, nan=0., posinf=0.)
+    suma_pesos = np.sum(pesos, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        promedio = np.sum(np.where(pesos > 0, pesos*mag, 0.), axis=0) / suma_pesos
+    y = np.where(pesos > 0, mag - promedio, 0.)
+
+    #Grilla de periodos, uniforme en el logaritmo del periodo: con un paso relativo de ancho/tiempo cubierto, el último tránsito se corre menos que un intervalo de fase entre dos periodos vecinos, sea cual sea el periodo. Si no caben dos tránsitos, un solo evento.
+    tiempo = np.where(np.isfinite(tiempo), tiempo, np.nanmin(tiempo))
+    t_ref = np.min(tiempo)
+    cubierto = np.ptp(tiempo)
+    ancho = np.min(duraciones)/sobremuestreo
+    if periodos is None:
+        periodo_max = cubierto/2. if periodo_max is None else periodo_max
+        if periodo_max < periodo_min:
+            periodos = np.array([np.inf])
+        else:
+            paso = ancho / max(cubierto, periodo_max)
+            periodos = np.geomspace(periodo_min, periodo_max, int(np.ceil(np.log(periodo_max/periodo_min)/np.log1p(paso))) + 1)
+    periodos = np.atleast_1d(np.asarray(periodos, dtype=np.float64))
+
+    #Las imagenes se agrupan primero en intervalos de tiempo de un cuarto del ancho de los intervalos de fase, sumando los pesos y las magnitudes pesadas, así que el costo de cada periodo no depende de la cadencia.
+    grupo = np.unique(np.floor((tiempo - t_ref)/(0.25*ancho)).astype(np.int64), return_inverse=True)[1].ravel()
+    n_grupos = np.max(grupo) + 1
+    cuenta = np.bincount(grupo, minlength=n_grupos).astype(np.float64)
+    tiempo_grupos = np.bincount(grupo, weights=tiempo - t_ref, minlength=n_grupos) / cuenta
+    wy = _sumar_por_indice(pesos*y, grupo, n_grupos)
+    pesos = _sumar_por_indice(pesos, grupo, n_grupos)
+
+    argumentos = (cuenta, tiempo_grupos, periodos, ancho, np.asarray(duraciones, dtype=np.float64), puntos_minimos)
+    bloques = [slice(ini, ini + fuentes_bloque) for ini in range(0, mag.shape[1], fuentes_bloque)]
+    if n_procesos > 1 and len(bloques) > 1:
+        with ProcessPoolExecutor(max_workers=n_procesos) as ejecutor:
+            futuros = [ejecutor.submit(_bls_bloque, wy[:,bloque], pesos[:,bloque], *argumentos) for bloque in bloques]
+            resultados = [futuro.result() for futuro in futuros]
+    else:
+        resultados = [_bls_bloque(wy[:,bloque], pesos[:,bloque], *argumentos) for bloque in bloques]
+    mejor = {clave: np.concatenate([r[clave] for r in resultados]) for clave in resultados[0]}
+
+    #Señal sobre el espectro de cada fuente.
+    potencia = mejor["potencia"]
+    if len(periodos) > 1:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sde = (mejor["snr"] - np.mean(potencia, axis=1)) / np.std(potencia, axis=1)
+    else:
+        sde = np.full(mag.shape[1], np.nan)
+
+    candidatos = Table()
+    candidatos['fuente'] = np.arange(mag.shape[1])
+    candidatos['snr'] = mejor["snr"]
+    candidatos['profundidad'] = mejor["profundidad"]
+    candidatos['periodo'] = mejor["periodo"]
+    candidatos['t0'] = mejor["t0"] + t_ref
+    candidatos['duracion'] = mejor["duracion"]
+    candidatos['n_puntos'] = mejor["n_puntos"].astype(int)
+    candidatos['sde'] = sde
+    candidatos = candidatos[candidatos['snr'] >= snr_minimo]
+    candidatos = candidatos[np.argsort(-candidatos['snr'], kind='stable')]
+    return candidatos, periodos, potencia
+
+def _bls_bloque(wy, pesos, cuenta_grupos, tiempo, periodos, ancho, duraciones, puntos_minimos):
+
+    #Búsqueda BLS de un bloque de fuentes sobre los grupos de imagenes, con los tiempos contados desde la primera imagen. Las sumas pesadas y los pesos van juntos en un solo arreglo de (grupos x 2 fuentes).
+    n_fuentes = wy.shape[1]
+    n_imagenes = np.sum(cuenta_grupos)
+    datos = np.concatenate([wy, pesos], axis=1)
+    suma_pesos = np.sum(pesos, axis=0)
+    columnas = np.arange(n_fuentes)
+    mejor = {"snr": np.zeros(n_fuentes), "profundidad": np.full(n_fuentes, np.nan), "periodo": np.full(n_fuentes, np.nan),
+             "t0": np.full(n_fuentes, np.nan), "duracion": np.full(n_fuentes, np.nan), "n_puntos": np.zeros(n_fuentes)}
+    potencia = np.zeros((n_fuentes, len(periodos)))
+
+    for k, periodo in enumerate(periodos):
+
+        #Intervalos de fase. Con un solo evento la curva no se dobla y las cajas no dan la vuelta.
+        un_evento = not np.isfinite(periodo)
+        if un_evento:
+            n_intervalos = int(np.floor(np.max(tiempo)/ancho)) + 1
+            ancho_periodo = ancho
+            fase = tiempo
+        else:
+            n_intervalos = max(int(np.ceil(periodo/ancho)), 1)
+            ancho_periodo = periodo/n_intervalos
+            fase = np.mod(tiempo, periodo)
+        intervalo = np.minimum((fase/ancho_periodo).astype(np.int64), n_intervalos - 1)
+
+        #Sumas de cada intervalo para todas las fuentes. El costo es proporcional al número de grupos, no al de intervalos por grupos.
+        sumas = _sumar_por_indice(datos, intervalo, n_intervalos)
+        cuenta = np.bincount(intervalo, weights=cuenta_grupos, minlength=n_intervalos)
+
+        #Sumas acumuladas sobre los intervalos, repitiendo los primeros para las cajas que dan la vuelta.
+        largos = np.maximum(np.round(duraciones/ancho_periodo).astype(np.int64), 1)
+        largos = largos[largos <= n_intervalos]
+        extra = 0 if un_evento else int(np.max(largos, initial=0))
+        acumulado = _acumulada(np.concatenate([sumas, sumas[:extra]]))
+        acumulado_n = _acumulada(np.concatenate([cuenta, cuenta[:extra]]))
+
+        for largo in largos:
+            n_cajas = n_intervalos - largo + 1 if un_evento else n_intervalos
+            caja_suma = acumulado[largo:largo+n_cajas] - acumulado[:n_cajas]
+            s, r = caja_suma[:,:n_fuentes], caja_suma[:,n_fuentes:]
+            n = acumulado_n[largo:largo+n_cajas] - acumulado_n[:n_cajas]
+
+            #La mejora del chi cuadrado con la caja es s^2 W / (r (W - r)); W es el mismo para toda la fuente, así que se busca el máximo sin él. Solo cuentan las cajas más débiles (s > 0) con suficientes imagenes dentro y fuera.
+            estadistico = np.maximum(s, 0.)
+            estadistico *= estadistico
+            estadistico /= np.maximum(r*(suma_pesos - r), 1e-300)
+            estadistico *= ((n >= puntos_minimos) & (n_imagenes - n >= puntos_minimos))[:,None]
+
+            caja = np.argmax(estadistico, axis=0)
+            snr = np.sqrt(estadistico[caja, columnas]*suma_pesos)
+            potencia[:,k] = np.maximum(potencia[:,k], snr)
+
+            mejora = snr > mejor["snr"]
+            if not np.any(mejora):
+                continue
+            s_mejor, r_mejor = s[caja, columnas], r[caja, columnas]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                profundidad = s_mejor * suma_pesos / (r_mejor*(suma_pesos - r_mejor))
+            centro = (caja + 0.5*largo)*ancho_periodo
+            if not un_evento:
+                centro = np.mod(centro, periodo)
+            for clave, valor in (("snr", snr), ("profundidad", profundidad), ("periodo", periodo), ("t0", centro), ("duracion", largo*ancho_periodo), ("n_puntos", n[caja])):
+                mejor[clave] = np.where(mejora, valor, mejor[clave])
+
+    mejor["potencia"] = potencia
+    return mejor
+
+def _sumar_por_indice(valores, indice, n):
+
+    #Suma las filas de valores que tienen el mismo índice, en un arreglo de n filas, con una matriz dispersa de pertenencia de (n x filas) que tiene un solo elemento por fila de valores. Se arma directamente en formato CSR ordenando las filas por índice, y el producto cuesta lo mismo sin importar n.
+    orden = np.argsort(indice, kind='stable')
+    inicios = np.concatenate([[0], np.cumsum(np.bincount(indice, minlength=n))])
+    pertenencia = sparse.csr_matrix((np.ones(len(indice)), orden, inicios), shape=(n, len(indice)))
+    return pertenencia @ valores
+
+def _acumulada(valores):
+
+    #Suma acumulada a lo largo del primer eje, con un cero al comienzo.
+    acumulada = np.zeros((len(valores) + 1,) + valores.shape[1:])
+    np.cumsum(valores, axis=0, out=acumulada[1:])
+    return acumulada
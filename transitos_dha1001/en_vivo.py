@@ -0,0 +1,164 @@
+import numpy as np
+import glob
+import os
+import re
+import time
+
+from astropy.io import fits
+
+from .reduccion.science import reducir_imagen
+from .reduccion.calibracion import NucleoCalibracion
+from .reduccion.alinear import AlineadorFFT
+from .fotometria.dao import dao_busqueda, dao_recentrar, filtrar_posiciones
+from .fotometria.phot import medir_fotometria
+from .fotometria.curva_de_luz import CurvaDeLuzIncremental
+from .fotometria.tiempos import tiempos_imagenes
+
+def curva_de_luz_en_vivo(x_fuente, y_fuente,
+                         directorio_imagenes_originales="raw", directorio_imagenes_reducidas="red", directorio_fotometria="fot",
+                         patron="[0-9]*.fit", prefijo="ciencia", reyeccion_rayos_cosmicos=True,
+                         nombre_flat="MasterFlat.fits", nombre_dark="MasterDark.fits", nombre_bias="MasterBias.fits",
+                         precision="float64", escalar_dark=False,
+                         r_ap=7.0, r_an_in=None, r_an_out=None, bkg_type='global', caja_busqueda=21, zonas_a_filtrar=None,
+                         archivo_curva="curva_en_vivo.dat", intervalo=2.0, tiempo_maximo=600., al_agregar=None):
+    """
+    Rutina para obtener la curva de luz durante la noche, a medida que la cámara escribe las imagenes. Revisa el directorio de imagenes originales cada cierto intervalo y, apenas una imagen nueva está completa, la reduce, mide su transformación respecto a la imagen de referencia, recentra las fuentes, mide la fotometría y agrega el punto a la curva de luz.
+
+    La primera imagen es la referencia: en ella se buscan las fuentes con dao_busqueda. Las demás no se alinean; las posiciones de referencia se llevan a cada imagen con la transformación medida por AlineadorFFT y ahí se recentran. Como cada imagen nueva solo se compara con la referencia, el tiempo que toma procesarla no depende de cuántas imagenes haya ya en la curva.
+
+    Los cuadros maestros deben existir en el directorio de imagenes reducidas antes de empezar. Si la rutina se interrumpe y se vuelve a llamar con el mismo archivo_curva, retoma la curva y se salta las imagenes que ya están en ella.
+
+    Parámetros
+    ----------
+
+    x_fuente, y_fuente: float
+        Posición de la fuente en la imagen de referencia.
+
+    directorio_imagenes_originales: str, opcional
+        Directorio donde la cámara escribe las imagenes.
+
+    directorio_imagenes_reducidas: str, opcional
+        Directorio donde están los cuadros maestros y donde se guardan las imagenes reducidas.
+
+    directorio_fotometria: str, opcional
+        Directorio donde se guardan las posiciones, la fotometría y la curva de luz.
+
+    patron: str, opcional
+        Patrón (como en glob) de los nombres de las imagenes de ciencia dentro del directorio de imagenes originales.
+
+    prefijo, reyeccion_rayos_cosmicos, nombre_flat, nombre_dark, nombre_bias, precision, escalar_dark: opcionales
+        Igual que en reducir_imagenes_ciencia.
+
+    r_ap, r_an_in, r_an_out, bkg_type: opcionales
+        Igual que en medir_fotometria.
+
+    caja_busqueda: int, opcional
+        Tamaño de la caja de búsqueda usada al recentrar las fuentes.
+
+    zonas_a_filtrar: lista, opcional
+        Zonas de la imagen de referencia donde se eliminan las fuentes. Ver filtrar_posiciones.
+
+    archivo_curva: str, opcional
+        Nombre del archivo de la curva de luz dentro del directorio de fotometría. Ver CurvaDeLuzIncremental.
+
+    intervalo: float, opcional
+        Segundos entre cada revisión del directorio.
+
+    tiempo_maximo: float, opcional
+        La rutina termina si pasan tiempo_maximo segundos sin imagenes nuevas. Si es None, sigue hasta que se interrumpa con Ctrl-C.
+
+    al_agregar: función, opcional
+        Función que se llama como al_agregar(imagen, mjd, mag, mag_err) cada vez que se agrega un punto, por ejemplo para actualizar un gráfico.
+
+    La rutina devuelve la CurvaDeLuzIncremental.
+
+    """
+
+    os.makedirs(directorio_fotometria, exist_ok=True)
+    curva = CurvaDeLuzIncremental("{}/{}".format(directorio_fotometria, archivo_curva), x_fuente, y_fuente)
+
+    #Precalcular el núcleo de calibración una sola vez para toda la noche.
+    nucleo = NucleoCalibracion.desde_archivos(nombre_bias, nombre_dark, nombre_flat, directorio_imagenes_reducidas,
+                                              escalar_dark=escalar_dark, precision=precision)
+    args_imagen = (prefijo, reyeccion_rayos_cosmicos, directorio_imagenes_originales, directorio_imagenes_reducidas)
+    args_fot = dict(r_an_in=r_an_in, r_an_out=r_an_out, directorio_imagenes_reducidas=directorio_imagenes_reducidas,
+                    directorio_fotometria=directorio_fotometria, bkg_type=bkg_type)
+
+    #Si se está retomando una curva, recuperar la referencia.
+    alineador = None
+    posiciones_referencia = None
+    if curva.referencia is not None:
+        datos = fits.getdata("{}/{}".format(directorio_imagenes_reducidas, curva.referencia))
+        alineador = AlineadorFFT(np.float64(datos))
+        posiciones_referencia = np.loadtxt("{}/{}".format(directorio_fotometria, re.sub(".fits?", ".pos.dat", curva.referencia)))
+
+    procesadas = set(curva.imagenes)
+    tamaños = {}
+    ultima = time.time()
+    try:
+        while tiempo_maximo is None or time.time() - ultima < tiempo_maximo:
+
+            #Buscar imagenes nuevas que ya estén completas, en orden.
+            nuevas = []
+            for fname in sorted(glob.glob("{}/{}".format(directorio_imagenes_originales, patron))):
+                imagen = os.path.basename(fname)
+                if "{}_{}".format(prefijo, imagen) not in procesadas and _imagen_completa(fname, tamaños):
+                    nuevas.append(imagen)
+
+            for imagen in nuevas:
+                reducida = "{}_{}".format(prefijo, imagen)
+                procesadas.add(reducida)
+                ultima = time.time()
+                try:
+                    header = reducir_imagen(imagen, nucleo, *args_imagen)
+                    pos_fname = re.sub(".fits?", ".pos.dat", reducida)
+
+                    #La primera imagen es la referencia.
+                    if alineador is None:
+                        posiciones = dao_busqueda(reducida, directorio_imagenes_reducidas, directorio_fotometria)
+                        if zonas_a_filtrar is not None:
+                            posiciones = filtrar_posiciones(reducida, zonas_a_filtrar, directorio_fotometria=directorio_fotometria)
+                        posiciones_referencia = posiciones
+                        alineador = AlineadorFFT(np.float64(fits.getdata("{}/{}".format(directorio_imagenes_reducidas, reducida))))
+                    else:
+                        datos = fits.getdata("{}/{}".format(directorio_imagenes_reducidas, reducida))
+                        transformaciones = {reducida: alineador.transformacion(np.float64(datos))}
+                        posiciones = dao_recentrar(reducida, posiciones_referencia, directorio_imagenes_reducidas, directorio_fotometria,
+                                                   caja_busqueda=caja_busqueda, transformaciones=transformaciones)
+
+                    flujo, flujo_err = medir_fotometria(reducida, r_ap, **args_fot)
+
+                    #Agregar el punto a la curva de luz.
+                    mjd, bjd_tdb = tiempos_imagenes([header['DATE-OBS']], header['EXPTIME'])
+                    punto = curva.agregar(reducida, mjd[0], flujo, flujo_err, header['EXPTIME'], posiciones)
+                    print("Imagen", imagen, "agregada en {:.1f} s: mjd = {:.5f}, mag = {:.4f} +/- {:.4f}".format(time.time() - ultima, *punto))
+                    if al_agregar is not None:
+                        al_agregar(reducida, *punto)
+
+                except Exception as e:
+                    print("No se pudo procesar la imagen", imagen, ":", repr(e))
+
+            time.sleep(intervalo)
+
+    except KeyboardInterrupt:
+        pass
+
+    return curva
+
+
+def _imagen_completa(fname, tamaños):
+
+    #La imagen está completa si su tamaño no cambió desde la revisión anterior y alcanza para el encabezado y todos los datos.
+    tamaño = os.path.getsize(fname)
+    anterior = tamaños.get(fname)
+    tamaños[fname] = tamaño
+    if anterior != tamaño:
+        return False
+    try:
+        with open(fname, "rb") as f:
+            header = fits.Header.fromfile(f)
+            inicio_datos = f.tell()
+    except Exception:
+        return False
+    n_pixeles = np.prod([header['NAXIS{}'.format(k)] for k in range(1, header['NAXIS']+1)]) if header['NAXIS'] > 0 else 0
+    return tamaño >= inicio_datos + n_pixeles * abs(header['BITPIX']) // 8
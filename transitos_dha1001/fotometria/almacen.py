@@ -0,0 +1,247 @@
+import numpy as np
+import os
+import json
+
+from astropy.table import Table
+
+class AlmacenFotometria:
+    """
+    Almacén binario de la fotometría de una noche. En vez de un archivo de texto por imagen, cada cantidad se guarda en un solo archivo binario, con las imagenes una detrás de otra: el flujo y el error como arreglos de (imagenes x fuentes x radios), y las posiciones x, y y el cielo como arreglos de (imagenes x fuentes). Los archivos se leen con memory mapping, así que la serie de tiempo de una fuente, o todas las fuentes de una imagen, se obtienen con un solo corte sin leer el resto.
+
+    Los archivos del almacén (en directorio_fotometria) son:
+
+    nombre.esquema.json: número de fuentes, radios de apertura y tipo de los datos.
+    nombre.flujo.bin, nombre.error.bin, nombre.x.bin, nombre.y.bin, nombre.cielo.bin: los datos.
+    nombre.imagenes.jsonl: una línea por imagen con su nombre y sus metadatos (por ejemplo DATE-OBS y EXPTIME).
+
+    Cada imagen nueva se agrega al final de los archivos, y la línea de metadatos se escribe al último, así que si el proceso se interrumpe a medio escribir, esa imagen simplemente no queda en el almacén.
+
+    Parametros
+    ----------
+
+    directorio_fotometria: str, opcional
+        Directorio donde se guardan los archivos del almacén.
+
+    nombre: str, opcional
+        Nombre base de los archivos del almacén.
+
+    n_fuentes: int, opcional
+        Número de fuentes. Si es None, se toma del almacén existente o de la primera imagen agregada.
+
+    radios: float o lista, opcional
+        Radio, o radios, de las aperturas en segundos de arco. Si es None, se toma del almacén existente.
+
+    """
+
+    columnas = ("flujo", "error", "x", "y", "cielo")
+    tipo = np.float64
+
+    def __init__(self, directorio_fotometria="fotometria", nombre="fotometria", n_fuentes=None, radios=None):
+        self.directorio = directorio_fotometria
+        self.nombre = nombre
+        self.n_fuentes = n_fuentes
+        self.radios = None if radios is None else np.atleast_1d(np.asarray(radios, dtype=np.float64))
+        self.metadatos = []
+        self._indices = {}
+
+        #Si el almacén ya existe, leer el esquema y los metadatos, y revisar que corresponda a lo pedido.
+        if os.path.exists(self._archivo("esquema.json")):
+            with open(self._archivo("esquema.json")) as f:
+                esquema = json.load(f)
+            if n_fuentes is not None and n_fuentes != esquema["n_fuentes"]:
+                raise ValueError("El almacén {} tiene {} fuentes, no {}.".format(nombre, esquema["n_fuentes"], n_fuentes))
+            if self.radios is not None and (len(self.radios) != len(esquema["radios"]) or not np.allclose(self.radios, esquema["radios"])):
+                raise ValueError("Los radios del almacén {} son {}.".format(nombre, esquema["radios"]))
+            self.n_fuentes = esquema["n_fuentes"]
+            self.radios = np.array(esquema["radios"], dtype=np.float64)
+            if os.path.exists(self._archivo("imagenes.jsonl")):
+                with open(self._archivo("imagenes.jsonl"), "r+b") as f:
+                    contenido = f.read()
+
+                    #Una última línea sin salto de línea quedó a medio escribir: esa imagen no alcanzó a registrarse.
+                    completo = contenido[:contenido.rfind(b"\n") + 1]
+                    if len(completo) < len(contenido):
+                        f.truncate(len(completo))
+                for linea in completo.decode().splitlines():
+                    if linea.strip():
+                        self._registrar(json.loads(linea))
+            self._recortar()
+
+    def _archivo(self, extension):
+        return "{}/{}.{}".format(self.directorio, self.nombre, extension)
+
+    def _registrar(self, metadatos):
+        if metadatos["imagen"] in self._indices:
+            self.metadatos[self._indices[metadatos["imagen"]]] = metadatos
+        else:
+            self._indices[metadatos["imagen"]] = len(self.metadatos)
+            self.metadatos.append(metadatos)
+
+    def _forma(self, columna):
+        if columna in ("flujo", "error"):
+            return (self.n_fuentes, len(self.radios))
+        return (self.n_fuentes,)
+
+    def _recortar(self):
+
+        #Eliminar lo que haya quedado escrito de una imagen que no alcanzó a registrarse.
+        for columna in self.columnas:
+            fname = self._archivo(columna + ".bin")
+            tamaño = len(self) * int(np.prod(self._forma(columna))) * np.dtype(self.tipo).itemsize
+            if os.path.exists(fname) and os.path.getsize(fname) > tamaño:
+                with open(fname, "r+b") as f:
+                    f.truncate(tamaño)
+
+    def __len__(self):
+        return len(self.metadatos)
+
+    def __contains__(self, imagen):
+        return imagen in self._indices
+
+    @property
+    def imagenes(self):
+        """
+        Nombres de las imagenes en el almacén, en el orden en que se agregaron.
+
+        """
+
+        return [m["imagen"] for m in self.metadatos]
+
+    def tabla_imagenes(self):
+        """
+        Devuelve una tabla de astropy con los metadatos de todas las imagenes, una fila por imagen.
+
+        """
+
+        claves = []
+        for m in self.metadatos:
+            claves += [c for c in m if c not in claves]
+        return Table({c: [m.get(c) for m in self.metadatos] for c in claves})
+
+    def indice(self, imagen):
+        """
+        Devuelve la posición de una imagen en el almacén.
+
+        """
+
+        return self._indices[imagen]
+
+    def agregar(self, imagen, flujo, error, x, y, cielo=None, **metadatos):
+        """
+        Agrega la fotometría de una imagen al final del almacén. Si la imagen ya estaba, sus datos se reemplazan en el mismo lugar.
+
+        Parametros
+        ----------
+
+        imagen: str
+            Nombre de la imagen.
+
+        flujo, error: numpy array
+            Flujo y error de cada fuente, con un valor por fuente, o un arreglo de (fuentes x radios).
+
+        x, y: numpy array
+            Posiciones de las fuentes en la imagen.
+
+        cielo: numpy array, opcional
+            Cielo por pixel de cada fuente. Si es None, se guarda NaN.
+
+        metadatos: opcionales
+            Otros datos de la imagen que se guardan en la tabla de imagenes, por ejemplo EXPTIME.
+
+        """
+
+        #Con la primera imagen, crear el esquema.
+        if self.n_fuentes is None:
+            self.n_fuentes = len(x)
+        if self.radios is None:
+            raise ValueError("Se deben indicar los radios del almacén.")
+        if not os.path.exists(self._archivo("esquema.json")):
+            with open(self._archivo("esquema.json"), "w") as f:
+                json.dump({"n_fuentes": self.n_fuentes, "radios": self.radios.tolist(), "tipo": np.dtype(self.tipo).str,
+                           "columnas": {c: ["imagenes"] + (["fuentes", "radios"] if c in ("flujo", "error") else ["fuentes"]) for c in self.columnas}}, f)
+
+        if cielo is None:
+            cielo = np.full(len(x), np.nan)
+        datos = {"flujo": flujo, "error": error, "x": x, "y": y, "cielo": cielo}
+        for columna in self.columnas:
+            datos[columna] = np.asarray(datos[columna], dtype=self.tipo)
+            if datos[columna].size != np.prod(self._forma(columna)):
+                raise ValueError("La imagen {} tiene {} fuentes, pero el almacén {} tiene {}.".format(imagen, len(x), self.nombre, self.n_fuentes))
+            datos[columna] = datos[columna].reshape(self._forma(columna))
+
+        metadatos = dict(imagen=imagen, **metadatos)
+        if imagen in self:
+
+            #Reemplazar los datos en su lugar y volver a escribir la tabla de imagenes.
+            i = self.indice(imagen)
+            for columna in self.columnas:
+                mapa = self.columna(columna, modo="r+")
+                mapa[i] = datos[columna]
+                mapa.flush()
+            self._registrar(metadatos)
+
+            #Escribir primero a un archivo temporal, para no perder la tabla si el proceso se interrumpe.
+            temporal = self._archivo("imagenes.jsonl.tmp")
+            with open(temporal, "w") as f:
+                for m in self.metadatos:
+                    f.write(json.dumps(m) + "\n")
+            os.replace(temporal, self._archivo("imagenes.jsonl"))
+        else:
+
+            #Agregar los datos al final de cada archivo, y al último la línea de metadatos.
+            for columna in self.columnas:
+                with open(self._archivo(columna + ".bin"), "ab") as f:
+                    f.write(datos[columna].tobytes())
+            with open(self._archivo("imagenes.jsonl"), "a") as f:
+                f.write(json.dumps(metadatos) + "\n")
+            self._registrar(metadatos)
+
+    def columna(self, columna, modo="r"):
+        """
+        Devuelve una cantidad ("flujo", "error", "x", "y" o "cielo") de todas las imagenes como un arreglo con memory mapping, de (imagenes x fuentes x radios) o de (imagenes x fuentes).
+
+        """
+
+        forma = (len(self),) + self._forma(columna)
+        if len(self) == 0:
+            return np.empty(forma, dtype=self.tipo)
+        return np.memmap(self._archivo(columna + ".bin"), dtype=self.tipo, mode=modo, shape=forma)
+
+    def fuente(self, indice, r_ap=None):
+        """
+        Devuelve un diccionario con la serie de tiempo de una fuente: flujo, error, x, y y cielo en cada imagen. El flujo y el error son de (imagenes x radios), o de una dimensión si se indica r_ap (en segundos de arco) o si hay un solo radio.
+
+        """
+
+        return self._cortar((slice(None), indice), r_ap)
+
+    def imagen(self, imagen, r_ap=None):
+        """
+        Devuelve un diccionario con flujo, error, x, y y cielo de todas las fuentes en una imagen, dada por su nombre o su posición en el almacén. El flujo y el error son de (fuentes x radios), o de una dimensión si se indica r_ap (en segundos de arco) o si hay un solo radio.
+
+        """
+
+        i = self.indice(imagen) if isinstance(imagen, str) else imagen
+        return self._cortar((i,), r_ap)
+
+    def _cortar(self, corte, r_ap):
+        j = self.indice_radio(r_ap)
+        valores = {}
+        for columna in self.columnas:
+            valores[columna] = np.array(self.columna(columna)[corte])
+            if columna in ("flujo", "error") and j is not None:
+                valores[columna] = valores[columna][..., j]
+        return valores
+
+    def indice_radio(self, r_ap=None):
+        """
+        Devuelve la posición del radio r_ap (en segundos de arco) en el almacén. Si r_ap es None, devuelve 0 si hay un solo radio, o None si hay varios.
+
+        """
+
+        if r_ap is None:
+            return 0 if len(self.radios) == 1 else None
+        j = np.flatnonzero(np.isclose(self.radios, r_ap))
+        if len(j) == 0:
+            raise ValueError("El radio {} no está en el almacén {}.".format(r_ap, self.nombre))
+        return j[0]
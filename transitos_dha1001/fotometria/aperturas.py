@@ -0,0 +1,111 @@
+import numpy as np
+from scipy import sparse
+
+from photutils import CircularAperture
+
+class OperadorAperturas:
+    """
+    Operador que suma los pixeles dentro de un conjunto de aperturas circulares. La fracción de cada pixel que cae dentro de cada apertura (el mismo cálculo exacto que usa aperture_photometry) se calcula una sola vez y se guarda como una matriz dispersa de (fuentes x pixeles en alguna apertura), así que medir la fotometría de una imagen es un solo producto de la matriz por el vector de la imagen. Como las imagenes están alineadas, la misma matriz sirve para toda la noche; solo se vuelve a calcular si las posiciones se mueven más que una tolerancia.
+
+    Si se entregan varios radios, cada fila de la matriz es un anillo entre dos radios consecutivos, y la suma en cada apertura es la suma acumulada de los anillos. Como los anillos no se traslapan, medir todos los radios cuesta casi lo mismo que medir solo el más grande.
+
+    Parametros
+    ----------
+
+    posiciones: numpy array
+        Arreglo de N x 2 con las posiciones (x, y) de las fuentes.
+
+    radio: float o lista
+        Radio de las aperturas, en pixeles, o lista de radios. Los resultados se devuelven en el mismo orden de la lista.
+
+    forma: tupla
+        Tamaño (filas, columnas) de las imagenes.
+
+    tolerancia: float, opcional
+        Desplazamiento máximo, en pixeles, de cualquier fuente antes de volver a calcular la matriz. Con 0 se recalcula cada vez que cambian las posiciones.
+
+    """
+
+    def __init__(self, posiciones, radio, forma, tolerancia=0.05):
+        self.radio = radio
+        self.radios = np.atleast_1d(np.asarray(radio, dtype=np.float64))
+
+        #Los anillos se construyen con los radios de menor a mayor; _orden lleva de ese orden al de la lista.
+        self._ordenados = np.sort(self.radios)
+        self._orden = np.argsort(np.argsort(self.radios, kind='stable'), kind='stable')
+        self.forma = tuple(forma)
+        self.tolerancia = tolerancia
+        self._construir(posiciones)
+
+    def _construir(self, posiciones):
+        self.posiciones = np.array(posiciones, dtype=np.float64).reshape(-1, 2)
+        ny, nx = self.forma
+
+        #Juntar los pesos de cada apertura, recortados a los límites de la imagen. Con varios radios, la fila k*n_radios+j es el anillo entre los radios ordenados j-1 y j de la fuente k: la apertura j con peso positivo y la j-1 con peso negativo.
+        n_fuentes = len(self.posiciones)
+        n_radios = len(self.radios)
+        filas, columnas, pesos = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+        for j, radio in enumerate(self._ordenados):
+            if n_fuentes == 0:
+                break
+            for k, mascara in enumerate(CircularAperture(self.posiciones, r=radio).to_mask(method='exact')):
+                caja = mascara.bbox
+                iy, ix = np.mgrid[caja.iymin:caja.iymax, caja.ixmin:caja.ixmax]
+                dentro = (mascara.data > 0) & (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+                pixeles = iy[dentro] * nx + ix[dentro]
+                filas.append(np.full(len(pixeles), k*n_radios+j))
+                columnas.append(pixeles)
+                pesos.append(mascara.data[dentro])
+                if j < n_radios-1:
+                    filas.append(np.full(len(pixeles), k*n_radios+j+1))
+                    columnas.append(pixeles)
+                    pesos.append(-mascara.data[dentro])
+
+        #La matriz solo tiene columnas para los pixeles que caen en alguna apertura, así que cada imagen se lee solo en esos pixeles. Los pesos repetidos de un mismo pixel se suman al crear la matriz.
+        filas, columnas, pesos = np.concatenate(filas), np.concatenate(columnas), np.concatenate(pesos)
+        self.pixeles, columnas = np.unique(columnas, return_inverse=True)
+        self.matriz = sparse.csr_matrix((pesos, (filas, columnas.ravel())), shape=(n_fuentes*n_radios, len(self.pixeles)))
+        self.matriz.eliminate_zeros()
+
+        #Área efectiva de cada apertura, sin la parte que cae fuera de la imagen.
+        self.area = self._acumular(np.asarray(self.matriz.sum(axis=1)).ravel())
+
+    def _acumular(self, sumas_anillos):
+
+        #Sumar los anillos para obtener la suma en cada apertura, y volver al orden en que se entregaron los radios. Con un solo radio, devolver un valor por fuente.
+        sumas = np.cumsum(sumas_anillos.reshape(sumas_anillos.shape[:-1] + (len(self.posiciones), len(self.radios))), axis=-1)
+        if np.ndim(self.radio) == 0:
+            return sumas[..., 0]
+        return sumas[..., self._orden]
+
+    def actualizar(self, posiciones):
+        """
+        Vuelve a calcular la matriz si alguna fuente se movió más que la tolerancia, o si cambió el número de fuentes. Devuelve True si se recalculó.
+
+        """
+
+        posiciones = np.asarray(posiciones, dtype=np.float64).reshape(-1, 2)
+        if len(posiciones) == len(self.posiciones) and np.all(np.abs(posiciones - self.posiciones) <= self.tolerancia):
+            return False
+        self._construir(posiciones)
+        return True
+
+    def sumar(self, datos):
+        """
+        Devuelve la suma de los pixeles de la imagen dentro de cada apertura. Con varios radios, devuelve un arreglo de (fuentes x radios).
+
+        """
+
+        return self._acumular(self.matriz @ np.asarray(datos).ravel()[self.pixeles].astype(np.float64))
+
+    def sumar_cubo(self, cubo, imagenes_bloque=16):
+        """
+        Devuelve un arreglo de (imagenes x fuentes), o de (imagenes x fuentes x radios), con la suma dentro de cada apertura en cada imagen de un cubo, por ejemplo uno abierto con memory mapping. Las imagenes se leen de a imagenes_bloque a la vez, y cada bloque se mide con un solo producto de la matriz por el bloque.
+
+        """
+
+        sumas = np.empty((len(cubo), self.matriz.shape[0]))
+        for ini in range(0, len(cubo), imagenes_bloque):
+            bloque = np.asarray(cubo[ini:ini+imagenes_bloque]).reshape(-1, self.forma[0]*self.forma[1])[:, self.pixeles]
+            sumas[ini:ini+imagenes_bloque] = (self.matriz @ bloque.T.astype(np.float64)).T
+        return self._acumular(sumas)
@@ -0,0 +1,118 @@
+import numpy as np
+import re
+
+from scipy.spatial import cKDTree
+
+class CatalogoFuentes:
+    """
+    Catálogo de fuentes de una imagen, con un árbol KD (cKDTree) para buscar fuentes por posición. Buscar las fuentes cerca de un punto toma un tiempo proporcional al logaritmo del número de fuentes, en vez de calcular la distancia a todas, así que sirve también para campos con decenas de miles de estrellas.
+
+    Parametros
+    ----------
+
+    posiciones: numpy array
+        Arreglo de N x 2 con las posiciones (x, y) de las fuentes, como el que devuelve dao_busqueda.
+
+    """
+
+    def __init__(self, posiciones):
+        self.posiciones = np.asarray(posiciones, dtype=np.float64).reshape(-1, 2)
+        self.arbol = cKDTree(self.posiciones)
+
+    @classmethod
+    def desde_archivo(cls, imagen, directorio_fotometria="fot"):
+        """
+        Crea el catálogo leyendo el archivo de posiciones (.pos.dat) de una imagen.
+
+        """
+
+        pos_fname = re.sub(".fits?", ".pos.dat", imagen)
+        return cls(np.loadtxt("{}/{}".format(directorio_fotometria, pos_fname)))
+
+    def __len__(self):
+        return len(self.posiciones)
+
+    def fuera_de_zonas(self, zonas, radios):
+        """
+        Devuelve un arreglo booleano que es True para las fuentes que están a más de radio de todas las zonas.
+
+        Parametros
+        ----------
+
+        zonas: lista de dos dimensiones
+            Posiciones (x, y) del centro de cada zona.
+
+        radios: float o lista
+            Radio de cada zona, en pixeles. Si es un escalar, se usa el mismo para todas las zonas.
+
+        """
+
+        zonas = np.asarray(zonas, dtype=np.float64).reshape(-1, 2)
+        radios = np.broadcast_to(np.asarray(radios, dtype=np.float64), len(zonas))
+        fuera = np.ones(len(self), dtype=bool)
+        for indices in self.arbol.query_ball_point(zonas, radios):
+            fuera[indices] = False
+        return fuera
+
+    def mas_cercana(self, x, y):
+        """
+        Devuelve el índice de la fuente más cercana a la posición (x, y) y su distancia.
+
+        """
+
+        distancia, indice = self.arbol.query([x, y])
+        return int(indice), distancia
+
+    def contaminadas(self, radio, mag=None, diferencia_mag=None):
+        """
+        Devuelve un arreglo booleano que es True para las fuentes que tienen otra fuente a menos de radio pixeles.
+
+        Parametros
+        ----------
+
+        radio: float
+            Distancia, en pixeles, dentro de la cual otra fuente contamina la apertura.
+
+        mag: numpy array, opcional
+            Magnitud de cada fuente.
+
+        diferencia_mag: float, opcional
+            Si se entregan las magnitudes, una vecina solo contamina si es a lo más diferencia_mag magnitudes más débil que la fuente.
+
+        """
+
+        pares = self.arbol.query_pairs(radio, output_type='ndarray')
+        contaminadas = np.zeros(len(self), dtype=bool)
+        if len(pares) == 0:
+            return contaminadas
+        i, j = pares[:, 0], pares[:, 1]
+        if mag is None or diferencia_mag is None:
+            contaminadas[i] = True
+            contaminadas[j] = True
+        else:
+            mag = np.asarray(mag)
+            contaminadas[i[mag[j] - mag[i] <= diferencia_mag]] = True
+            contaminadas[j[mag[i] - mag[j] <= diferencia_mag]] = True
+        return contaminadas
+
+    def cruzar(self, otras_posiciones, radio=3.0):
+        """
+        Identifica las fuentes de este catálogo en otra lista de posiciones, por ejemplo de otra imagen. Dos fuentes se consideran la misma si cada una es la más cercana a la otra y están a menos de radio pixeles.
+
+        Devuelve un arreglo con el índice en otras_posiciones de cada fuente del catálogo, o -1 si no se encontró.
+
+        """
+
+        otro = otras_posiciones if isinstance(otras_posiciones, CatalogoFuentes) else CatalogoFuentes(otras_posiciones)
+        indices = np.full(len(self), -1)
+        if len(self) == 0 or len(otro) == 0:
+            return indices
+
+        #Buscar la más cercana en cada dirección y quedarse solo con las parejas mutuas.
+        distancia, ida = otro.arbol.query(self.posiciones, distance_upper_bound=radio)
+        distancia_vuelta, vuelta = self.arbol.query(otro.posiciones, distance_upper_bound=radio)
+        encontradas = np.isfinite(distancia)
+        mutuas = np.zeros(len(self), dtype=bool)
+        mutuas[encontradas] = vuelta[ida[encontradas]] == np.arange(len(self))[encontradas]
+        indices[mutuas] = ida[mutuas]
+        return indices
@@ -1,14 +1,18 @@
 import numpy as np
 import re
+import os
+import json
 import matplotlib.pyplot as plt
 
-import astropy.units as u
-from astropy.time import Time
-
-from astropy.io import fits
 from astropy.stats import sigma_clipped_stats
 
-def curva_de_luz(imagenes, x_fuente, y_fuente, directorio_imagenes_reducidas="imagenes_reducidas", directorio_fotometria="fotometria"):
+from ..reduccion.indice import indice_imagenes
+from .catalogo import CatalogoFuentes
+from .tiempos import tiempos_imagenes
+from .ensamble import fotometria_diferencial
+from .phot import leer_fotometria, _leer_multifotometria
+
+def curva_de_luz(imagenes, x_fuente, y_fuente, directorio_imagenes_reducidas="imagenes_reducidas", directorio_fotometria="fotometria", cubo=None, radio_cruce=3.0, r_ap=None, almacen=None, tiempo="mjd"):
     """
     Es rutina toma todas las mediciones de la fotometría y genera la curva de luz para un objeto en cuestión, usando todo el resto de los objetos como referencia para calibrar las magnitudes.
 
@@ -30,22 +34,39 @@ def curva_de_luz(imagenes, x_fuente, y_fuente, directorio_imagenes_reducidas="im
     directorio_fotometria: string, opcional
         Directorio donde se encuentran los archivos de la fotometría.
 
+    cubo: str, opcional
+        Nombre del cubo (sin extensión) donde están las imagenes, si se guardaron en un cubo en vez de archivos separados. Los encabezados se leen de la tabla del cubo.
+
+    radio_cruce: float, opcional
+        Las fuentes de cada imagen son las mismas de la primera imagen, en el mismo orden, si fueron recentradas a partir de las mismas posiciones de referencia. Si una imagen tiene otro número de fuentes, sus fuentes se identifican con las de la primera imagen buscando la más cercana a menos de radio_cruce pixeles.
+
+    r_ap: float, opcional
+        Si se midió la fotometría en varios radios, radio (en segundos de arco) que se usará, por ejemplo el que entrega elegir_apertura. Si es None, se usa el archivo .phot.dat.
+
+    almacen: AlmacenFotometria, opcional
+        Si se entrega, la fotometría, las posiciones y los datos de cada imagen se leen del almacén binario de la noche en vez de los archivos de texto, y la curva se calcula para todas las imagenes a la vez.
+
+    tiempo: str, opcional
+        Tiempo que se devuelve para cada imagen, a la mitad de la exposición: "mjd" para el dia Juliano modificado en UTC, o "bjd_tdb" para el dia Juliano baricéntrico (requiere RA y DEC en los encabezados). Ver indice_imagenes y tiempos_imagenes.
+
     """
 
+    if almacen is not None:
+        return _curva_de_luz_almacen(imagenes, x_fuente, y_fuente, almacen, r_ap, tiempo)
+
     target_mag = []
     target_mag_err = []
-    mjd = []
+
+    #El tiempo y la exposición de cada imagen se leen del índice de encabezados.
+    indice = indice_imagenes(imagenes, directorio_imagenes_reducidas, cubo)
 
     for k, imagen in enumerate(imagenes):
 
-        #Definir el nombre del archivo que guardará la fotometría.
-        phot_fname = re.sub(".fits?",".phot.dat",imagen)
         try:
             #Tratar de leer el archivo con la fotometría. Si no existe, se levantará la excepción OSError y se procederá a hacer el cálculo. Si existe, leer y entregar los valores correspondientes.
-            phot_data = np.loadtxt("{}/{}".format(directorio_fotometria, phot_fname))
-            h = fits.open("{}/{}".format(directorio_imagenes_reducidas, imagen))
-            mag_all = -2.5*np.log10(phot_data[:,0]/h[0].header['EXPTIME'])
-            mag_err_all = (2.5/np.log(10.)) * phot_data[:,1]/phot_data[:,0]
+            flujo, flujo_err = leer_fotometria(imagen, directorio_fotometria, r_ap)
+            mag_all = -2.5*np.log10(flujo/indice['EXPTIME'][k])
+            mag_err_all = (2.5/np.log(10.)) * flujo_err/flujo
         except OSError:
             print("Se debe calcular la fotometria primero.")
             return [None]*3
@@ -63,13 +84,17 @@ def curva_de_luz(imagenes, x_fuente, y_fuente, directorio_imagenes_reducidas="im
             return [None]*3
 
 
-        #Si es la primera imagen, guardar las magnitudes como referencias.
+        #Si es la primera imagen, guardar las magnitudes como referencias y encontrar cual es la fuente que queremos medir.
         if k==0:
             mag_ref = np.copy(mag_all)
+            catalogo = CatalogoFuentes(posiciones)
+            imin, distancia = catalogo.mas_cercana(x_fuente, y_fuente)
 
-        #Encontrar cual es la fuente que queremos medir.
-        d2 = (posiciones[:,0]-x_fuente)**2 + (posiciones[:,1]-y_fuente)**2
-        imin = np.argmin(d2)
+        #Si la imagen no tiene las mismas fuentes que la primera, ordenarlas como en la primera. Las que no se encuentran quedan como NaN y no se usan en la normalización.
+        elif len(posiciones) != len(catalogo):
+            indices = catalogo.cruzar(posiciones, radio=radio_cruce)
+            mag_all = np.where(indices >= 0, mag_all[indices], np.nan)
+            mag_err_all = np.where(indices >= 0, mag_err_all[indices], np.nan)
 
         #Cacular la normalización
         cond = np.arange(0,len(mag_all))!=imin
@@ -78,12 +103,265 @@ def curva_de_luz(imagenes, x_fuente, y_fuente, directorio_imagenes_reducidas="im
         target_mag.append(mag_all[imin]+norm)
         target_mag_err.append(mag_err_all[imin])
 
-        #Guardar el dia Juliano modificado de las observaciones.
-        t = Time(h[0].header['DATE-OBS'], format='isot', scale='utc') + 4.0*u.hr
-        mjd.append(t.mjd)
+    #Tiempo de las observaciones.
+    mjd = list(indice[tiempo])
 
     return mjd, target_mag, target_mag_err
 
+
+def _curva_de_luz_almacen(imagenes, x_fuente, y_fuente, almacen, r_ap=None, tiempo="mjd"):
+    try:
+        indices = [almacen.indice(imagen) for imagen in imagenes]
+    except KeyError:
+        print("Se debe calcular la fotometria primero.")
+        return [None]*3
+    j = almacen.indice_radio(r_ap)
+    if j is None:
+        raise ValueError("El almacén tiene varios radios; se debe indicar r_ap.")
+
+    #Leer solo las imagenes pedidas, en el radio pedido.
+    flujo = np.array(almacen.columna("flujo")[indices, :, j])
+    flujo_err = np.array(almacen.columna("error")[indices, :, j])
+    exptime = np.array([almacen.metadatos[i]['EXPTIME'] for i in indices], dtype=np.float64)
+    mag_all = -2.5*np.log10(flujo/exptime[:,None])
+    mag_err_all = (2.5/np.log(10.)) * flujo_err/flujo
+
+    #Encontrar cual es la fuente que queremos medir en la primera imagen.
+    posiciones = np.vstack((almacen.columna("x")[indices[0]], almacen.columna("y")[indices[0]])).T
+    imin, distancia = CatalogoFuentes(posiciones).mas_cercana(x_fuente, y_fuente)
+
+    #Calcular la normalización de todas las imagenes a la vez, respecto a la primera.
+    cond = np.arange(0,mag_all.shape[1])!=imin
+    norm, norm_median, norm_std = sigma_clipped_stats(mag_all[0,cond][None]-mag_all[:,cond], axis=1)
+
+    #Tiempo de las observaciones, con las coordenadas del encabezado si se pide bjd_tdb.
+    metadatos = [almacen.metadatos[i] for i in indices]
+    coordenadas = [m.get('RA') for m in metadatos], [m.get('DEC') for m in metadatos]
+    if tiempo == "mjd" or None in coordenadas[0] or None in coordenadas[1]:
+        coordenadas = None, None
+    mjd_utc, bjd_tdb = tiempos_imagenes([m['DATE-OBS'] for m in metadatos], exptime, *coordenadas)
+
+    return (mjd_utc if tiempo == "mjd" else bjd_tdb), mag_all[:,imin]+norm, mag_err_all[:,imin]
+
+
+def curvas_de_luz(imagenes, directorio_imagenes_reducidas="imagenes_reducidas", directorio_fotometria="fotometria", cubo=None, radio_cruce=3.0, r_ap=None, almacen=None, tiempo="mjd", **opciones):
+    """
+    Genera las curvas de luz de todas las fuentes del campo a la vez con fotometria_diferencial, en vez de una fuente a la vez como curva_de_luz. Sirve, por ejemplo, para buscar fuentes variables en todo el campo.
+
+    Devuelve el tiempo de cada imagen, las magnitudes calibradas y sus errores (imagenes x fuentes), la dispersión de cada fuente y un arreglo booleano que es True para las fuentes marcadas como variables. Las fuentes están en el orden de la primera imagen.
+
+    Parametros
+    ----------
+
+    imagenes, directorio_imagenes_reducidas, directorio_fotometria, cubo, radio_cruce, r_ap, almacen, tiempo: opcionales
+        Igual que en curva_de_luz.
+
+    opciones: opcionales
+        Parámetros de fotometria_diferencial (iteraciones, sigma, umbral_variables, tolerancia).
+
+    """
+
+    #Leer las magnitudes de todas las imagenes en un solo arreglo.
+    if almacen is not None:
+        indices = [almacen.indice(imagen) for imagen in imagenes]
+        j = almacen.indice_radio(r_ap)
+        if j is None:
+            raise ValueError("El almacén tiene varios radios; se debe indicar r_ap.")
+        flujo = np.array(almacen.columna("flujo")[indices, :, j])
+        flujo_err = np.array(almacen.columna("error")[indices, :, j])
+        metadatos = [almacen.metadatos[i] for i in indices]
+        exptime = np.array([m['EXPTIME'] for m in metadatos], dtype=np.float64)
+        coordenadas = [m.get('RA') for m in metadatos], [m.get('DEC') for m in metadatos]
+        if tiempo == "mjd" or None in coordenadas[0] or None in coordenadas[1]:
+            coordenadas = None, None
+        mjd_utc, bjd_tdb = tiempos_imagenes([m['DATE-OBS'] for m in metadatos], exptime, *coordenadas)
+        t = mjd_utc if tiempo == "mjd" else bjd_tdb
+    else:
+        indice = indice_imagenes(imagenes, directorio_imagenes_reducidas, cubo)
+        exptime = np.asarray(indice['EXPTIME'], dtype=np.float64)
+        t = np.asarray(indice[tiempo])
+        flujo, flujo_err = [], []
+        for k, imagen in enumerate(imagenes):
+            f, f_err = leer_fotometria(imagen, directorio_fotometria, r_ap)
+
+            #Si la imagen no tiene las mismas fuentes que la primera, ordenarlas como en la primera.
+            if k == 0:
+                catalogo = CatalogoFuentes.desde_archivo(imagen, directorio_fotometria)
+            elif len(f) != len(catalogo):
+                cruce = catalogo.cruzar(CatalogoFuentes.desde_archivo(imagen, directorio_fotometria), radio=radio_cruce)
+                f, f_err = np.where(cruce >= 0, f[cruce], np.nan), np.where(cruce >= 0, f_err[cruce], np.nan)
+            flujo.append(f)
+            flujo_err.append(f_err)
+        flujo, flujo_err = np.array(flujo), np.array(flujo_err)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mag_all = -2.5*np.log10(flujo/exptime[:,None])
+        mag_err_all = (2.5/np.log(10.)) * flujo_err/flujo
+
+    mag, rms, punto_cero, pesos, variables = fotometria_diferencial(mag_all, mag_err_all, **opciones)
+    return t, mag, mag_err_all, rms, variables
+
+
+def elegir_apertura(imagenes, x_fuente, y_fuente, directorio_imagenes_reducidas="imagenes_reducidas", directorio_fotometria="fotometria", cubo=None, posiciones=None):
+    """
+    Elige el radio de apertura que da la curva de luz con menor dispersión, a partir de la fotometría medida en varios radios con medir_fotometria. Para cada radio se arma la curva de luz diferencial igual que en curva_de_luz, todos los radios a la vez, y la dispersión se mide como la diferencia entre puntos consecutivos, para que la forma del tránsito no la afecte.
+
+    Devuelve el mejor radio para el objeto, los radios medidos, la dispersión del objeto en cada radio y el mejor radio para cada fuente.
+
+    Parametros
+    ----------
+
+    imagenes: lista
+        lista de imagenes a incluir en la curva de luz.
+
+    x_fuente, y_fuente: float
+        Posición de la fuente para la que se medirá la curva de luz.
+
+    directorio_imagenes_reducidas: str, opcional
+        Directorio donde se encuentran las imagenes.
+
+    directorio_fotometria: string, opcional
+        Directorio donde se encuentran los archivos de la fotometría.
+
+    cubo: str, opcional
+        Nombre del cubo (sin extensión) donde están las imagenes, si se guardaron en un cubo.
+
+    posiciones: numpy array, opcional
+        Posiciones de las fuentes en la primera imagen. Si es None, se leen de su archivo .pos.dat.
+
+    """
+
+    #Leer la fotometría de todas las imagenes en todos los radios.
+    indice = indice_imagenes(imagenes, directorio_imagenes_reducidas, cubo)
+    mag_all = []
+    for k, imagen in enumerate(imagenes):
+        radios, flujo, flujo_err = _leer_multifotometria("{}/{}".format(directorio_fotometria, re.sub(".fits?",".multiphot.dat",imagen)))
+        mag_all.append(-2.5*np.log10(flujo/indice['EXPTIME'][k]))
+    mag_all = np.array(mag_all)
+
+    #Encontrar cual es la fuente que queremos medir.
+    if posiciones is None:
+        posiciones = np.loadtxt("{}/{}".format(directorio_fotometria, re.sub(".fits?",".pos.dat",imagenes[0])))
+    imin, distancia = CatalogoFuentes(posiciones).mas_cercana(x_fuente, y_fuente)
+
+    #Calcular la normalización de cada imagen en cada radio, sin el objeto, y su curva de luz.
+    cond = np.arange(0,mag_all.shape[1])!=imin
+    norm, norm_median, norm_std = sigma_clipped_stats(mag_all[0,cond][None]-mag_all[:,cond], axis=1)
+    dispersion = _dispersion(mag_all[:,imin]+norm)
+
+    #Para las demás fuentes, usar una normalización con todas las fuentes.
+    norm_todas, norm_median, norm_std = sigma_clipped_stats(mag_all[0][None]-mag_all, axis=1)
+    dispersion_fuentes = _dispersion(mag_all + norm_todas[:,None,:])
+    r_ap_fuentes = radios[np.argmin(np.where(np.isfinite(dispersion_fuentes), dispersion_fuentes, np.inf), axis=1)]
+
+    return radios[np.nanargmin(dispersion)], radios, dispersion, r_ap_fuentes
+
+def _dispersion(mag):
+
+    #Dispersión a partir de las diferencias entre puntos consecutivos, usando la mediana de su valor absoluto.
+    return 1.4826 * np.nanmedian(np.abs(np.diff(mag, axis=0)), axis=0) / 2.**0.5
+
+
+class CurvaDeLuzIncremental:
+    """
+    Curva de luz que crece una imagen a la vez. Las magnitudes de referencia se toman de la primera imagen, igual que en curva_de_luz, y cada imagen nueva se calibra solo contra ellas, así que agregar un punto toma el mismo tiempo sin importar cuántas imágenes haya ya en la curva. Cada punto se agrega de inmediato al final de un archivo de texto, de modo que si el proceso se interrumpe la curva se retoma desde donde quedó.
+
+    Parametros
+    ----------
+
+    archivo: str
+        Archivo donde se guarda la curva, con una fila por imagen (imagen, mjd, magnitud y error). Las magnitudes de referencia se guardan en el mismo archivo con extensión .ref.json.
+
+    x_fuente: float
+        Posición en x de la fuente en la imagen de referencia.
+
+    y_fuente: float
+        Posición en y de la fuente en la imagen de referencia.
+
+    """
+
+    def __init__(self, archivo, x_fuente, y_fuente):
+        self.archivo = archivo
+        self.archivo_referencia = re.sub(r"(\.[^./]*)?$", ".ref.json", archivo, count=1)
+        self.x_fuente = x_fuente
+        self.y_fuente = y_fuente
+
+        self.imagenes = []
+        self.mjd = []
+        self.mag = []
+        self.mag_err = []
+        self.referencia = None
+        self.indice_fuente = None
+        self.mag_ref = None
+
+        #Retomar la curva si ya existe.
+        if os.path.exists(self.archivo_referencia):
+            with open(self.archivo_referencia) as f:
+                ref = json.load(f)
+            self.referencia = ref["referencia"]
+            self.indice_fuente = ref["indice_fuente"]
+            self.mag_ref = np.array(ref["mag_ref"])
+            if os.path.exists(archivo):
+                with open(archivo) as f:
+                    for linea in f:
+                        imagen, mjd, mag, mag_err = linea.split()
+                        self.imagenes.append(imagen)
+                        self.mjd.append(float(mjd))
+                        self.mag.append(float(mag))
+                        self.mag_err.append(float(mag_err))
+
+    def agregar(self, imagen, mjd, flujo, flujo_err, exptime, posiciones):
+        """
+        Agrega una imagen a la curva y devuelve su mjd, magnitud y error. La primera imagen agregada es la referencia: en ella se busca la fuente más cercana a (x_fuente, y_fuente), y sus magnitudes se usan para calibrar el resto.
+
+        Parametros
+        ----------
+
+        imagen: str
+            Nombre de la imagen.
+
+        mjd: float
+            Dia Juliano modificado de la imagen.
+
+        flujo, flujo_err: numpy array
+            Flujo y error de todas las fuentes, como los que devuelve medir_fotometria.
+
+        exptime: float
+            Tiempo de exposición de la imagen.
+
+        posiciones: numpy array
+            Posiciones de las fuentes en la imagen. Solo se usan en la imagen de referencia.
+
+        """
+
+        flujo = np.asarray(flujo)
+        mag_all = -2.5*np.log10(flujo/exptime)
+        mag_err_all = (2.5/np.log(10.)) * np.asarray(flujo_err)/flujo
+
+        #Si es la primera imagen, guardar las magnitudes como referencias y encontrar cual es la fuente que queremos medir.
+        if self.mag_ref is None:
+            self.indice_fuente, distancia = CatalogoFuentes(posiciones).mas_cercana(self.x_fuente, self.y_fuente)
+            self.mag_ref = np.copy(mag_all)
+            self.referencia = imagen
+            with open(self.archivo_referencia, "w") as f:
+                json.dump({"referencia": imagen, "indice_fuente": self.indice_fuente, "mag_ref": self.mag_ref.tolist()}, f)
+
+        #Cacular la normalización.
+        imin = self.indice_fuente
+        cond = np.arange(0,len(mag_all))!=imin
+        norm, norm_median, norm_std = sigma_clipped_stats(self.mag_ref[cond]-mag_all[cond])
+        mag = mag_all[imin]+norm
+
+        #Agregar el punto a la curva y al archivo.
+        self.imagenes.append(imagen)
+        self.mjd.append(mjd)
+        self.mag.append(mag)
+        self.mag_err.append(mag_err_all[imin])
+        with open(self.archivo, "a") as f:
+            f.write("{} {:.8f} {:.6f} {:.6f}\n".format(imagen, mjd, mag, mag_err_all[imin]))
+
+        return mjd, mag, mag_err_all[imin]
+
 ###
 
 def graficar_curva_de_luz(mjd, mag, mag_err, titulo=None):
@@ -2,15 +2,17 @@ import numpy as np
 import re
 import matplotlib.pyplot as plt
 
-import astropy.units as u
-from astropy.time import Time
-
-from astropy.io import fits
 from astropy.stats import sigma_clipped_stats
 
+from ..reduccion.indice import indice_imagenes
+from .catalogo import CatalogoFuentes
+from .phot import leer_fotometria
+from .fondo import fondo_imagen
+from .tendencias import matriz_regresores, mascara_transito, ajustar_tendencias
+
 from scipy.signal import savgol_filter
 
-def curva_de_luz(imagenes, x_fuente, y_fuente, directorio_imagenes_reducidas="imagenes_reducidas", directorio_fotometria="fotometria"):
+def curva_de_luz(imagenes, x_fuente, y_fuente, directorio_imagenes_reducidas="imagenes_reducidas", directorio_fotometria="fotometria", cubo=None, r_ap=None, tiempo="mjd", metodo="savgol", regresores=("airmass", "cielo", "dx", "dy", "fwhm"), grado_tiempo=2, ventana_transito=None):
     """
     Es rutina toma todas las mediciones de la fotometría y genera la curva de luz para un objeto en cuestión, usando todo el resto de los objetos como referencia para calibrar las magnitudes.
 
@@ -32,24 +34,42 @@ def curva_de_luz(imagenes, x_fuente, y_fuente, directorio_imagenes_reducidas="im
     directorio_fotometria: string, opcional
         Directorio donde se encuentran los archivos de la fotometría.
 
+    cubo: str, opcional
+        Nombre del cubo (sin extensión) donde están las imagenes, si se guardaron en un cubo en vez de archivos separados. Los encabezados se leen de la tabla del cubo.
+
+    r_ap: float, opcional
+        Si se midió la fotometría en varios radios, radio (en segundos de arco) que se usará. Si es None, se usa el archivo .phot.dat.
+
+    tiempo: str, opcional
+        "mjd" o "bjd_tdb". Ver curva_de_luz.
+
+    metodo: str, opcional
+        "savgol" para suavizar las magnitudes de las fuentes de referencia con un filtro de Savitzky-Golay antes de normalizar, o "regresores" para normalizar con las magnitudes sin suavizar y luego restarle a la curva de luz una combinación de regresores de cada imagen ajustada con ajustar_tendencias.
+
+    regresores: lista, opcional
+        Solo se usa si metodo es "regresores". Regresores a incluir: "airmass" y "fwhm" (de los encabezados), "cielo" (mediana del modelo del fondo de cada imagen) y "dx", "dy" (desplazamiento mediano de las fuentes respecto a la primera imagen).
+
+    grado_tiempo: int, opcional
+        Solo se usa si metodo es "regresores". Grado del polinomio en el tiempo que se agrega a los regresores.
+
+    ventana_transito: tupla, opcional
+        Solo se usa si metodo es "regresores". Tiempos (t_inicio, t_fin) del tránsito, en las mismas unidades que tiempo. Las imagenes dentro de la ventana no se usan para ajustar los regresores.
+
     """
 
-    mjd = list()
+    #El tiempo y la exposición de cada imagen se leen del índice de encabezados.
+    indice = indice_imagenes(imagenes, directorio_imagenes_reducidas, cubo)
+    mjd = list(indice[tiempo])
+
     for k, imagen in enumerate(imagenes):
-        phot_fname = re.sub(".fits?",".phot.dat",imagen)
         pos_fname = re.sub(".fits?",".pos.dat",imagen)
 
-        h = fits.open("{}/{}".format(directorio_imagenes_reducidas, imagen))
-
-        t = Time(h[0].header['DATE-OBS'], format='isot', scale='utc') + 4.0*u.hr
-        mjd.append(t.mjd)
-
-        phot_data = np.loadtxt("{}/{}".format(directorio_fotometria, phot_fname))
+        flujo, flujo_err = leer_fotometria(imagen, directorio_fotometria, r_ap)
         if k==0:
-            mag_all     = np.zeros((len(imagenes), len(phot_data[:,0])))
+            mag_all     = np.zeros((len(imagenes), len(flujo)))
             mag_err_all = np.zeros(mag_all.shape)
-        mag_all[k] = -2.5*np.log10(phot_data[:,0]/h[0].header['EXPTIME'])
-        mag_err_all[k] = (2.5/np.log(10.)) * phot_data[:,1]/phot_data[:,0]
+        mag_all[k] = -2.5*np.log10(flujo/indice['EXPTIME'][k])
+        mag_err_all[k] = (2.5/np.log(10.)) * flujo_err/flujo
 
         if k==0:
             pos_data = np.loadtxt("{}/{}".format(directorio_fotometria,pos_fname))
@@ -57,10 +77,13 @@ def curva_de_luz(imagenes, x_fuente, y_fuente, directorio_imagenes_reducidas="im
             y = pos_data[:,1]
             posiciones = np.vstack((x,y)).T
 
+    if metodo == "regresores":
+        return _curva_de_luz_regresores(imagenes, x_fuente, y_fuente, mag_all, mag_err_all, posiciones, indice, directorio_imagenes_reducidas, directorio_fotometria,
+                                        cubo, tiempo, regresores, grado_tiempo, ventana_transito)
+
     mag_smoothed = savgol_filter(mag_all, 7, 5, axis=0)
 
-    d2 = (posiciones[:,0]-x_fuente)**2 + (posiciones[:,1]-y_fuente)**2
-    imin = np.argmin(d2)
+    imin, distancia = CatalogoFuentes(posiciones).mas_cercana(x_fuente, y_fuente)
 
     cond = np.arange(0,mag_all.shape[1])!=imin
 
@@ -74,6 +97,44 @@ def curva_de_luz(imagenes, x_fuente, y_fuente, directorio_imagenes_reducidas="im
     return mjd, target_mag, target_mag_err
 
 
+def _curva_de_luz_regresores(imagenes, x_fuente, y_fuente, mag_all, mag_err_all, posiciones, indice, directorio_imagenes_reducidas, directorio_fotometria,
+                             cubo, tiempo, regresores, grado_tiempo, ventana_transito):
+
+    #Curva de luz diferencial, normalizando cada imagen con las demás fuentes igual que en curva_de_luz.
+    imin, distancia = CatalogoFuentes(posiciones).mas_cercana(x_fuente, y_fuente)
+    cond = np.arange(0,mag_all.shape[1])!=imin
+    norm, norm_median, norm_std = sigma_clipped_stats(mag_all[0,cond][None]-mag_all[:,cond], axis=1)
+    target_mag = mag_all[:,imin]+norm
+    target_mag_err = mag_err_all[:,imin]
+
+    #Regresores de cada imagen.
+    t = np.asarray(indice[tiempo], dtype=np.float64)
+    valores = {}
+    if "airmass" in regresores and indice['AIRMASS'].dtype.kind == 'f':
+        valores['airmass'] = indice['AIRMASS']
+    if "fwhm" in regresores and indice['FWHM'].dtype.kind == 'f':
+        valores['fwhm'] = indice['FWHM']
+    if "cielo" in regresores:
+        valores['cielo'] = [np.median(fondo_imagen(imagen, directorio_imagenes_reducidas, cubo).grilla) for imagen in imagenes]
+    if "dx" in regresores or "dy" in regresores:
+        deriva = np.full((len(imagenes), 2), np.nan)
+        for k, imagen in enumerate(imagenes):
+            pos_data = np.loadtxt("{}/{}".format(directorio_fotometria, re.sub(".fits?",".pos.dat",imagen)), ndmin=2)
+            if len(pos_data) == len(posiciones):
+                deriva[k] = np.median(pos_data[:,:2] - posiciones, axis=0)
+        if "dx" in regresores:
+            valores['dx'] = deriva[:,0]
+        if "dy" in regresores:
+            valores['dy'] = deriva[:,1]
+    X, nombres = matriz_regresores(t, grado_tiempo=grado_tiempo, **valores)
+
+    #Ajustar los regresores fuera del tránsito y restar la tendencia a toda la curva.
+    mascara = None if ventana_transito is None else mascara_transito(t, *ventana_transito)
+    target_mag, coeficientes, tendencia, rms, bic = ajustar_tendencias(target_mag, X, target_mag_err, mascara)
+
+    return list(t), target_mag, target_mag_err
+
+
 ###
 
 def graficar_curva_de_luz(mjd, mag, mag_err, titulo=None):
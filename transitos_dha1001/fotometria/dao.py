@@ -1,14 +1,21 @@
 import numpy as np
 import re
 
-from astropy.io import fits
 from astropy.stats import sigma_clipped_stats
 
 from photutils import DAOStarFinder, centroid_sources, centroid_com
 
 import subprocess
+from concurrent.futures import ProcessPoolExecutor
 
-def dao_busqueda(imagen, directorio_imagenes_reducidas="imagenes_reducidas", directorio_fotometria="fot", recalcular=True):
+from ..reduccion.alinear import leer_transformaciones, transformar_posiciones
+from ..reduccion.cubo import abrir_imagenes
+from .catalogo import CatalogoFuentes
+
+margen_bloque = 16 #Margen, en pixeles, que se agrega a cada bloque para que el filtro de DAOStarFinder vea los mismos pixeles que en la imagen completa.
+
+def dao_busqueda(imagen, directorio_imagenes_reducidas="imagenes_reducidas", directorio_fotometria="fot", recalcular=True, cubo=None,
+                 region=(150, 1850, 150, 1850), submuestreo=1, n_bloques=1, n_procesos=1):
     """
     Función que busca fuentes (estrellas) en una imagen.
 
@@ -27,6 +34,21 @@ def dao_busqueda(imagen, directorio_imagenes_reducidas="imagenes_reducidas", dir
     recalcular: boolean, opcional
         Debe ser igual a True si se desea recalcular las posiciones.
 
+    cubo: str, opcional
+        Nombre del cubo (sin extensión) donde están las imagenes, si se guardaron en un cubo en vez de archivos separados.
+
+    region: tupla, opcional
+        Límites (xmin, xmax, ymin, ymax), en pixeles, de la zona de la imagen donde se buscan fuentes. Solo se busca dentro de esta zona (más un margen para el filtro de DAOStarFinder), en vez de buscar en toda la imagen y luego descartar. Si es None, se usa toda la imagen.
+
+    submuestreo: int, opcional
+        Las estadísticas del cielo se calculan usando solo un pixel de cada submuestreo en cada eje. Con 4, por ejemplo, se usa un dieciseisavo de los pixeles.
+
+    n_bloques: int, opcional
+        La región se divide en n_bloques x n_bloques bloques que se traslapan en un margen, y en cada uno se buscan fuentes por separado. Cada fuente se asigna solo al bloque en cuyo interior (sin el margen) está su centro, así que las fuentes en los bordes entre bloques no se repiten.
+
+    n_procesos: int, opcional
+        Número de procesos en que se reparten los bloques.
+
     """
 
     #Crear el directorio de la fotometria si no existe.
@@ -48,23 +70,40 @@ def dao_busqueda(imagen, directorio_imagenes_reducidas="imagenes_reducidas", dir
 
         print("Buscando fuentes en la imagen ",imagen)
 
-        #Abrir la imagen.
-        h = fits.open("{}/{}".format(directorio_imagenes_reducidas, imagen))
+        #Leer la imagen.
+        datos = abrir_imagenes(directorio_imagenes_reducidas, cubo).datos(imagen)
 
         #Calcular la mediana y desviación estándar haciendo reyección de 3 sigma para solo contabilizar el cielo.
-        mean, median, std = sigma_clipped_stats(h[0].data, sigma=3.0)
-
-        #Buscar las fuentes. Su brillo debe estar 20 veces sobre el ruido del cielo.
-        daofind = DAOStarFinder(fwhm=3.0, threshold=20.*std)
-        fuentes = daofind(h[0].data - median)
-        x = fuentes['xcentroid']
-        y = fuentes['ycentroid']
-        h.close()
+        mean, median, std = sigma_clipped_stats(datos[::submuestreo, ::submuestreo], sigma=3.0)
+
+        #Dividir la región en bloques.
+        ny, nx = datos.shape
+        xmin, xmax, ymin, ymax = (0, nx, 0, ny) if region is None else region
+        bordes_x = np.linspace(max(int(np.floor(xmin)), 0), min(int(np.ceil(xmax))+1, nx), n_bloques+1).astype(int)
+        bordes_y = np.linspace(max(int(np.floor(ymin)), 0), min(int(np.ceil(ymax))+1, ny), n_bloques+1).astype(int)
+        bloques = []
+        for j in range(n_bloques):
+            for i in range(n_bloques):
+                x0, x1 = bordes_x[i], bordes_x[i+1]
+                y0, y1 = bordes_y[j], bordes_y[j+1]
+                xa, xb = max(x0-margen_bloque, 0), min(x1+margen_bloque, nx)
+                ya, yb = max(y0-margen_bloque, 0), min(y1+margen_bloque, ny)
+                bloques.append((np.asarray(datos[ya:yb, xa:xb]), xa, ya, (x0, x1, y0, y1), median, std))
+
+        #Buscar las fuentes en cada bloque, en este mismo proceso o repartiéndolos en varios.
+        if n_procesos == 1:
+            resultados = [_buscar_en_bloque(*bloque) for bloque in bloques]
+        else:
+            with ProcessPoolExecutor(max_workers=n_procesos) as ejecutor:
+                resultados = list(ejecutor.map(_buscar_en_bloque, *zip(*bloques)))
+        x = np.concatenate([r[0] for r in resultados])
+        y = np.concatenate([r[1] for r in resultados])
 
         #Solo vamos a querer fuentes lejos de los bordes.
-        cond = (x>150) & (x<1850) & (y>150) & (y<1850)
-        x = x[cond]
-        y = y[cond]
+        if region is not None:
+            cond = (x>xmin) & (x<xmax) & (y>ymin) & (y<ymax)
+            x = x[cond]
+            y = y[cond]
 
         #Guardar las posiciones en el archivo correspondiente.
         np.savetxt("{}/{}".format(directorio_fotometria, pos_fname), np.array([x,y]).T)
@@ -74,7 +113,23 @@ def dao_busqueda(imagen, directorio_imagenes_reducidas="imagenes_reducidas", dir
     return posiciones
 
 
-def dao_recentrar(imagen, posiciones_referencia, directorio_imagenes_reducidas="imagenes_reducidas", directorio_fotometria="fot", caja_busqueda=21, recalcular=True):
+def _buscar_en_bloque(datos, x_inicio, y_inicio, limites, median, std):
+
+    #Buscar las fuentes. Su brillo debe estar 20 veces sobre el ruido del cielo.
+    daofind = DAOStarFinder(fwhm=3.0, threshold=20.*std)
+    fuentes = daofind(datos - median)
+    if fuentes is None:
+        return np.zeros(0), np.zeros(0)
+    x = np.asarray(fuentes['xcentroid']) + x_inicio
+    y = np.asarray(fuentes['ycentroid']) + y_inicio
+
+    #Quedarse solo con las fuentes cuyo centro está dentro del bloque, sin el margen.
+    x0, x1, y0, y1 = limites
+    cond = (x>=x0-0.5) & (x<x1-0.5) & (y>=y0-0.5) & (y<y1-0.5)
+    return x[cond], y[cond]
+
+
+def dao_recentrar(imagen, posiciones_referencia, directorio_imagenes_reducidas="imagenes_reducidas", directorio_fotometria="fot", caja_busqueda=21, recalcular=True, transformaciones=None, cubo=None):
     """
     Rutina para recentrar un set de posiciones de referencia. Estas posiciones de referencia deben haber sido calculadas con la función dao_busqueda.
 
@@ -99,6 +154,12 @@ def dao_recentrar(imagen, posiciones_referencia, directorio_imagenes_reducidas="
     recalcular: boolean, opcional
         Debe ser igual a True si se desea recalcular las posiciones.
 
+    transformaciones: diccionario o str, opcional
+        Transformaciones de cada imagen respecto a la referencia, o el archivo donde están guardadas, como las que calcula alinear_imagenes_ciencia con solo_transformacion=True. Si se indican, la imagen no necesita estar alineada: las posiciones de referencia se llevan primero a la imagen original y ahí se recentran.
+
+    cubo: str, opcional
+        Nombre del cubo (sin extensión) donde están las imagenes, si se guardaron en un cubo en vez de archivos separados.
+
     """
 
     print("Recentrando fuentes en la imagen",imagen)
@@ -118,14 +179,19 @@ def dao_recentrar(imagen, posiciones_referencia, directorio_imagenes_reducidas="
 
     except OSError:
 
-        #Abrir la image,
-        h = fits.open("{0:s}/{1:s}".format(directorio_imagenes_reducidas, imagen))
+        #Leer la imagen.
+        datos = abrir_imagenes(directorio_imagenes_reducidas, cubo).datos(imagen)
 
         #Tomar las posiciones de referencia y recentrar las fuentes alrededor de estas posiciones tomando una caja de tamaño caja_busqueda.
         x_ref = np.copy(posiciones_referencia[:,0])
         y_ref = np.copy(posiciones_referencia[:,1])
-        x, y = centroid_sources(h[0].data, x_ref, y_ref, box_size=caja_busqueda, centroid_func=centroid_com)
-        h.close()
+
+        #Si la imagen no está alineada, llevar las posiciones de referencia a la imagen.
+        if transformaciones is not None:
+            if isinstance(transformaciones, str):
+                transformaciones = leer_transformaciones(transformaciones)
+            x_ref, y_ref = transformar_posiciones(posiciones_referencia, transformaciones[imagen]).T
+        x, y = centroid_sources(datos, x_ref, y_ref, box_size=caja_busqueda, centroid_func=centroid_com)
 
         #Guardar las posiciones en el archivo correspondiente.
         np.savetxt("{}/{}".format(directorio_fotometria, pos_fname), np.array([x,y]).T)
@@ -134,6 +200,155 @@ def dao_recentrar(imagen, posiciones_referencia, directorio_imagenes_reducidas="
     posiciones = np.vstack((x,y)).T
     return posiciones
 
+def dao_recentrar_lote(imagenes, posiciones_referencia, directorio_imagenes_reducidas="imagenes_reducidas", directorio_fotometria="fot",
+                       caja_busqueda=21, metodo="com", seguir_deriva=True, transformaciones=None, cubo=None,
+                       archivo_posiciones="posiciones.npy", archivo_recortes=None):
+    """
+    Rutina para recentrar un set de posiciones de referencia en todas las imagenes de una vez. Para cada imagen se toma un recorte de caja_busqueda x caja_busqueda alrededor de cada fuente, y los centros se calculan para todas las fuentes a la vez. Las cajas de cada imagen se centran en las posiciones encontradas en la imagen anterior, de modo que se sigue la deriva del telescopio.
+
+    Devuelve un arreglo de (imagenes x fuentes x 2) con las posiciones (x, y), que también se guarda en archivo_posiciones en vez de un archivo .pos.dat por imagen. Las posiciones de una imagen se pueden entregar a medir_fotometria con el parámetro posiciones.
+
+    Parametros
+    ----------
+
+    imagenes: lista
+        Imagenes en que se recentrarán las fuentes, en orden de observación.
+
+    posiciones_referencia: numpy array
+        Arreglo con las posiciones de las fuentes en la imagen de referencia. Debe ser generado por la función dao_busqueda.
+
+    directorio_imagenes_reducidas: string, opcional
+        Nombre del directorio donde se encuentran las imagenes.
+
+    directorio_fotometria: string, opcional
+        Nombre del directorio donde se guardarán las posiciones.
+
+    caja_busqueda: int, opcional
+        Tamaño de la caja de búsqueda de las fuentes.
+
+    metodo: str, opcional
+        "com" para usar el centro de masa de cada caja, como dao_recentrar, o "gauss" para ajustar una gaussiana a la suma de la caja en cada eje (método de Caruana, ajustando una parábola al logaritmo). Si el ajuste gaussiano falla en alguna fuente, se usa el centro de masa.
+
+    seguir_deriva: bool, opcional
+        Si es True, las cajas de cada imagen se centran en las posiciones de la imagen anterior. Si es False, siempre se centran en las posiciones de referencia.
+
+    transformaciones: diccionario o str, opcional
+        Transformaciones de cada imagen respecto a la referencia, o el archivo donde están guardadas. Si se indican, las cajas se centran en las posiciones de referencia llevadas a cada imagen, y no se sigue la deriva.
+
+    cubo: str, opcional
+        Nombre del cubo (sin extensión) donde están las imagenes, si se guardaron en un cubo en vez de archivos separados.
+
+    archivo_posiciones: str, opcional
+        Nombre del archivo .npy, dentro del directorio de fotometría, donde se guardan las posiciones. Si es None, no se guardan.
+
+    archivo_recortes: str, opcional
+        Si se indica, la pila de recortes (imagenes x fuentes x caja x caja) se guarda en este archivo .npy del directorio de fotometría, con memory mapping, en vez de tenerla en memoria.
+
+    """
+
+    print("Recentrando fuentes en", len(imagenes), "imagenes")
+
+    acceso = abrir_imagenes(directorio_imagenes_reducidas, cubo)
+    if isinstance(transformaciones, str):
+        transformaciones = leer_transformaciones(transformaciones)
+
+    #Crear la pila de recortes y el arreglo de posiciones.
+    posiciones_referencia = np.asarray(posiciones_referencia, dtype=np.float64)
+    forma = (len(imagenes), len(posiciones_referencia), caja_busqueda, caja_busqueda)
+    if archivo_recortes is None:
+        recortes = np.empty(forma, dtype=np.float32)
+    else:
+        subprocess.call(["mkdir",directorio_fotometria], stderr=subprocess.DEVNULL)
+        recortes = np.lib.format.open_memmap("{}/{}".format(directorio_fotometria, archivo_recortes), mode='w+', dtype=np.float32, shape=forma)
+    posiciones = np.empty((len(imagenes), len(posiciones_referencia), 2))
+
+    semilla = posiciones_referencia
+    for k, imagen in enumerate(imagenes):
+
+        #Centrar las cajas en las posiciones de referencia llevadas a la imagen o en las de la imagen anterior.
+        if transformaciones is not None:
+            semilla = transformar_posiciones(posiciones_referencia, transformaciones[imagen])
+
+        #Tomar los recortes y calcular los centros dentro de cada caja.
+        recortes[k] = acceso.recortes(imagen, semilla[:,0], semilla[:,1], caja_busqueda)
+        x, y = _centroides(recortes[k], metodo)
+        esquina = np.round(semilla) - caja_busqueda//2
+        posiciones[k,:,0] = esquina[:,0] + x
+        posiciones[k,:,1] = esquina[:,1] + y
+
+        #Si alguna caja quedó completamente fuera de la imagen, dejar la posición de la semilla.
+        malas = ~np.isfinite(posiciones[k]).all(axis=1)
+        posiciones[k][malas] = semilla[malas]
+
+        if seguir_deriva:
+            semilla = posiciones[k]
+
+    if archivo_recortes is not None:
+        recortes.flush()
+
+    #Guardar las posiciones en un solo archivo.
+    if archivo_posiciones is not None:
+        subprocess.call(["mkdir",directorio_fotometria], stderr=subprocess.DEVNULL)
+        np.save("{}/{}".format(directorio_fotometria, archivo_posiciones), posiciones)
+
+    return posiciones
+
+
+def _centroides(recortes, metodo="com"):
+
+    #Sumar cada caja en cada eje. Los pixeles fuera de la imagen no cuentan.
+    pesos = np.nan_to_num(np.float64(recortes))
+    caja = pesos.shape[-1]
+    indices = np.arange(caja)
+    suma_x = pesos.sum(axis=1)
+    suma_y = pesos.sum(axis=2)
+
+    #Centro de masa.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        total = suma_x.sum(axis=1)
+        x = suma_x @ indices / total
+        y = suma_y @ indices / total
+
+    #Ajuste gaussiano en cada eje, usando el centro de masa donde el ajuste no funciona.
+    if metodo == "gauss":
+        x_gauss = _gaussiana_1d(suma_x)
+        y_gauss = _gaussiana_1d(suma_y)
+        x = np.where(np.isfinite(x_gauss), x_gauss, x)
+        y = np.where(np.isfinite(y_gauss), y_gauss, y)
+    elif metodo != "com":
+        raise ValueError("El método debe ser com o gauss.")
+
+    return x, y
+
+
+def _gaussiana_1d(perfiles):
+
+    #Restar el fondo, estimado con el menor de los extremos de cada perfil.
+    n = perfiles.shape[1]
+    t = np.arange(n, dtype=np.float64)
+    perfiles = perfiles - np.minimum(perfiles[:, :1], perfiles[:, -1:])
+
+    #Ajustar una parábola al logaritmo del perfil, con pesos iguales al cuadrado del perfil para no darle importancia al ruido de las alas.
+    validos = perfiles > 0
+    log_perfil = np.log(np.where(validos, perfiles, 1.))
+    pesos = np.where(validos, perfiles**2, 0.)
+    base = np.stack([np.ones(n), t, t**2], axis=1)
+    A = np.einsum('si,ij,ik->sjk', pesos, base, base)
+    b = np.einsum('si,si,ij->sj', pesos, log_perfil, base)
+
+    #Resolver solo los sistemas que tienen solución.
+    coefs = np.full((len(perfiles), 3), np.nan)
+    ok = np.abs(np.linalg.det(A)) > 1e-12 * np.abs(A).max(axis=(1,2))**3
+    if np.any(ok):
+        coefs[ok] = np.linalg.solve(A[ok], b[ok][..., None])[..., 0]
+
+    #El centro es el vértice de la parábola, que debe ser un máximo dentro de la caja.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        centro = -coefs[:, 1] / (2.*coefs[:, 2])
+    centro[~((coefs[:, 2] < 0) & (centro >= 0) & (centro <= n-1))] = np.nan
+    return centro
+
+
 def filtrar_posiciones(imagen, zonas_a_filtrar,
                        radio_de_filtro=10,
                        directorio_fotometria="fot"):
@@ -162,26 +377,8 @@ def filtrar_posiciones(imagen, zonas_a_filtrar,
     archivo_posiciones = re.sub(".fits?", ".pos.dat", imagen)
     posiciones_referencia = np.loadtxt("{}/{}".format(directorio_fotometria, archivo_posiciones))
 
-    #Poner las posiciones a filtrar en formato de arreglos de numpy.
-    zonas_a_filtrar = np.array(zonas_a_filtrar)
-    x_bad = zonas_a_filtrar[:,0]
-    y_bad = zonas_a_filtrar[:,1]
-
-    #El radio de eliminación puede ser distinto para cada zona de eliminación o la misma para todas.
-    if np.isscalar(radio_de_filtro):
-        r_bad = radio_de_filtro * np.ones(len(x_bad))
-    else:
-        r_bad = np.array(radio_de_filtro)
-
-    #Pasar por todas las zonas a filtrar, y crear una condición para luego filtrar el arreglo.
-    for k in range(len(x_bad)):
-        dx = (posiciones_referencia[:,0]-x_bad[k])
-        dy = (posiciones_referencia[:,1]-y_bad[k])
-        d  = (dx**2+dy**2)**0.5
-        if k==0:
-            cond = (d>r_bad[k])
-        else:
-            cond = cond & (d>r_bad[k])
+    #Eliminar las fuentes que estén dentro de alguna de las zonas. El radio de eliminación puede ser distinto para cada zona de eliminación o la misma para todas.
+    cond = CatalogoFuentes(posiciones_referencia).fuera_de_zonas(zonas_a_filtrar, radio_de_filtro)
     posiciones_referencia = posiciones_referencia[cond]
 
     #Guardar las posiciones filtradas.
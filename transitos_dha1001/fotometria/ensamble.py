@@ -0,0 +1,113 @@
+import numpy as np
+
+def fotometria_diferencial(mag, mag_err=None, iteraciones=20, sigma=3.0, umbral_variables=3.0, tolerancia=1e-6):
+    """
+    Resuelve la fotometría diferencial de todas las fuentes a la vez, a partir del arreglo de (imagenes x fuentes) con las magnitudes instrumentales. Cada magnitud se modela como el punto cero de la imagen más la magnitud media de la fuente, y ambos se resuelven iterativamente con promedios pesados sobre todo el arreglo: el punto cero de cada imagen con las fuentes de comparación, y la magnitud de cada fuente con todas las imagenes. El peso de cada medición es el inverso de su varianza (el error de la medición más la dispersión de la fuente), los puntos a más de sigma desviaciones se descartan, y las fuentes variables (las que tienen una dispersión mucho mayor a la de las fuentes de brillo similar) no se usan como comparación.
+
+    La curva de cada fuente se calibra con un punto cero calculado sin ella misma, igual que en curva_de_luz, y se normaliza a su magnitud en la primera imagen.
+
+    Devuelve las magnitudes calibradas (imagenes x fuentes), la dispersión de cada fuente, el punto cero de cada imagen, el peso de cada fuente y un arreglo booleano que es True para las fuentes marcadas como variables.
+
+    Parametros
+    ----------
+
+    mag: numpy array
+        Magnitudes instrumentales de (imagenes x fuentes). Las mediciones que faltan deben ser NaN.
+
+    mag_err: numpy array, opcional
+        Errores de las magnitudes, del mismo tamaño que mag.
+
+    iteraciones: int, opcional
+        Número máximo de iteraciones.
+
+    sigma: float, opcional
+        Número de desviaciones a partir del cual un punto no se usa para calcular los puntos cero.
+
+    umbral_variables: float, opcional
+        Una fuente se marca como variable si el logaritmo de su dispersión está a más de umbral_variables desviaciones (robustas) sobre la tendencia de la dispersión con la magnitud.
+
+    tolerancia: float, opcional
+        Las iteraciones terminan cuando ningún punto cero cambia más que tolerancia magnitudes.
+
+    """
+
+    mag = np.asarray(mag, dtype=np.float64)
+    validos = np.isfinite(mag)
+    if mag_err is None:
+        varianza_err = np.zeros(mag.shape)
+    else:
+        varianza_err = np.nan_to_num(np.asarray(mag_err, dtype=np.float64)**2, nan=0.)
+    m = np.where(validos, mag, 0.)
+
+    #Valores iniciales: punto cero nulo, magnitud media de cada fuente y la misma dispersión para todas. Los puntos cero son una columna y las magnitudes medias una fila.
+    punto_cero = np.zeros((mag.shape[0], 1))
+    mag_media = _promedio_pesado(m, validos.astype(np.float64), axis=0)
+    dispersion = np.full(mag.shape[1], np.nanmedian(np.nanstd(mag - mag_media, axis=0)))
+    variables = np.zeros(mag.shape[1], dtype=bool)
+    usados = validos.copy()
+
+    for k in range(iteraciones):
+
+        #Pesos de cada medición. Las fuentes variables y los puntos descartados no pesan en los puntos cero.
+        pesos = np.where(validos, 1./(varianza_err + np.maximum(dispersion, 1e-6)**2), 0.)
+        pesos_comparacion = np.where(usados & ~variables[None], pesos, 0.)
+
+        #Punto cero de cada imagen y magnitud media de cada fuente.
+        punto_cero_nuevo = _promedio_pesado(m - mag_media, pesos_comparacion, axis=1)
+        punto_cero_nuevo -= np.nanmedian(punto_cero_nuevo)
+        mag_media = _promedio_pesado(m - punto_cero_nuevo, np.where(usados, pesos, 0.), axis=0)
+
+        #Residuos, dispersión de cada fuente, puntos fuera de sigma y fuentes variables.
+        residuos = np.where(validos, m - punto_cero_nuevo - mag_media, np.nan)
+        dispersion = _dispersion(residuos, usados)
+        usados = validos & (np.abs(np.nan_to_num(residuos)) <= sigma*dispersion)
+        variables = _marcar_variables(mag_media, dispersion, umbral_variables)
+
+        cambio = np.nanmax(np.abs(punto_cero_nuevo - punto_cero)) if len(punto_cero) > 0 else 0.
+        punto_cero = punto_cero_nuevo
+        if cambio < tolerancia:
+            break
+
+    #Punto cero de cada imagen sin la fuente misma: se le resta su contribución al promedio pesado.
+    pesos = np.where(validos, 1./(varianza_err + np.maximum(dispersion, 1e-6)**2), 0.)
+    pesos_comparacion = np.where(usados & ~variables[None], pesos, 0.)
+    contribucion = np.where(pesos_comparacion > 0, pesos_comparacion*(m - mag_media), 0.)
+    numerador = np.sum(contribucion, axis=1, keepdims=True)
+    denominador = np.sum(pesos_comparacion, axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        punto_cero_sin = (numerador - contribucion) / (denominador - pesos_comparacion)
+
+    #Magnitudes calibradas, normalizadas a la primera imagen de cada fuente.
+    mag_calibrada = np.where(validos, mag - punto_cero_sin, np.nan)
+    primera = np.argmax(validos, axis=0)
+    mag_calibrada += (mag[primera, np.arange(mag.shape[1])] - mag_calibrada[primera, np.arange(mag.shape[1])])[None]
+
+    rms = np.nanstd(mag_calibrada, axis=0)
+    peso_fuentes = np.where(variables, 0., 1./np.maximum(dispersion, 1e-6)**2)
+    return mag_calibrada, rms, punto_cero.ravel(), peso_fuentes, variables
+
+def _promedio_pesado(valores, pesos, axis):
+    suma_pesos = np.sum(pesos, axis=axis, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        promedio = np.sum(np.where(pesos > 0, valores*pesos, 0.), axis=axis, keepdims=True) / suma_pesos
+    return np.where(suma_pesos > 0, promedio, np.nan)
+
+def _dispersion(residuos, usados):
+
+    #Desviación estándar de cada fuente solo con los puntos que no se han descartado, así que los puntos malos no la inflan después de la primera iteración.
+    n_usados = np.sum(usados, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.sqrt(np.sum(np.where(usados, residuos, 0.)**2, axis=0) / n_usados)
+
+def _marcar_variables(mag_media, dispersion, umbral):
+
+    #Tendencia del logaritmo de la dispersión con la magnitud (una parábola), y desviación robusta respecto a ella.
+    mag_media = np.ravel(mag_media)
+    log_dispersion = np.log10(np.maximum(dispersion, 1e-6))
+    buenas = np.isfinite(mag_media) & np.isfinite(log_dispersion)
+    if np.sum(buenas) < 4:
+        return np.zeros(len(dispersion), dtype=bool)
+    coeficientes = np.polyfit(mag_media[buenas], log_dispersion[buenas], 2)
+    diferencia = log_dispersion - np.polyval(coeficientes, mag_media)
+    desviacion = 1.4826 * np.median(np.abs(diferencia[buenas] - np.median(diferencia[buenas])))
+    return buenas & (diferencia > umbral*desviacion)
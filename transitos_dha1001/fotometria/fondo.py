@@ -0,0 +1,250 @@
+import numpy as np
+import os
+import re
+
+from astropy.io import fits
+from astropy.stats import SigmaClip
+from scipy.interpolate import RectBivariateSpline
+from concurrent.futures import ProcessPoolExecutor
+
+from photutils import Background2D, SExtractorBackground
+
+from ..reduccion.cubo import abrir_imagenes
+from ..reduccion.combinar import tomar_indices, mediana_intervalo
+
+class ModeloFondo:
+    """
+    Modelo del fondo de una imagen guardado solo como la grilla de baja resolución que calcula Background2D (un valor por caja, ya filtrado). El fondo en cualquier posición se obtiene interpolando la grilla con un spline bicúbico, así que se puede evaluar solo en las posiciones de las aperturas, sin construir la imagen de fondo completa.
+
+    Parametros
+    ----------
+
+    grilla: numpy array
+        Valor del fondo en cada caja.
+
+    forma: tupla
+        Tamaño (filas, columnas) de la imagen.
+
+    caja: int, opcional
+        Tamaño de las cajas, en pixeles.
+
+    """
+
+    def __init__(self, grilla, forma, caja=50):
+        self.grilla = np.asarray(grilla, dtype=np.float64)
+        self.forma = tuple(forma)
+        self.caja = caja
+
+        #Las cajas empiezan en el pixel 0, así que el centro de la caja j está en (j+0.5)*caja-0.5.
+        ny, nx = self.forma
+        y_centros = (np.arange(self.grilla.shape[0]) + 0.5) * caja - 0.5
+        x_centros = (np.arange(self.grilla.shape[1]) + 0.5) * caja - 0.5
+        caja_limite = [min(-0.5, y_centros[0]), max(ny-0.5, y_centros[-1]), min(-0.5, x_centros[0]), max(nx-0.5, x_centros[-1])]
+        self._spline = RectBivariateSpline(y_centros, x_centros, self.grilla, bbox=caja_limite,
+                                           kx=min(3, len(y_centros)-1), ky=min(3, len(x_centros)-1))
+
+    @classmethod
+    def calcular(cls, datos, caja=50, filtro=3):
+        """
+        Calcula el modelo del fondo de una imagen con Background2D, con reyección de 3 sigma y el estimador de SExtractor.
+
+        """
+
+        bkg = Background2D(datos, (caja, caja), filter_size=(filtro, filtro), sigma_clip=SigmaClip(sigma=3.), bkg_estimator=SExtractorBackground())
+        return cls(bkg.background_mesh, np.shape(datos), caja)
+
+    @classmethod
+    def leer(cls, fname):
+        """
+        Lee un modelo guardado con guardar.
+
+        """
+
+        grilla, header = fits.getdata(fname, header=True)
+        return cls(grilla, (header['FONDOY'], header['FONDOX']), header['CAJA'])
+
+    def guardar(self, fname):
+        """
+        Guarda la grilla del modelo en un archivo FITS, con el tamaño de la imagen y de las cajas en el encabezado.
+
+        """
+
+        header = fits.Header()
+        header['FONDOY'] = self.forma[0]
+        header['FONDOX'] = self.forma[1]
+        header['CAJA'] = self.caja
+        fits.writeto(fname, np.float32(self.grilla), header, overwrite=True)
+
+    def evaluar(self, x, y):
+        """
+        Devuelve el fondo en las posiciones (x, y).
+
+        """
+
+        return self._spline.ev(np.asarray(y, dtype=np.float64), np.asarray(x, dtype=np.float64))
+
+    @property
+    def background(self):
+        """
+        Imagen del fondo a resolución completa. Solo se calcula si se pide.
+
+        """
+
+        return self._spline(np.arange(self.forma[0]), np.arange(self.forma[1]))
+
+
+def fondo_imagen(imagen, directorio_imagenes_reducidas="red", cubo=None, recalcular=False, datos=None):
+    """
+    Devuelve el ModeloFondo de una imagen. Primero se busca el modelo guardado (imagen.bkgmesh.fits en el directorio de imagenes reducidas), y solo si no existe, si es más antiguo que la imagen (o que el cubo), o si se pide recalcular, se lee la imagen y se calcula.
+
+    Parametros
+    ----------
+
+    imagen: str
+        Nombre de la imagen.
+
+    directorio_imagenes_reducidas: str, opcional
+        Directorio donde está la imagen y donde se guarda el modelo.
+
+    cubo: str, opcional
+        Nombre del cubo (sin extensión) donde están las imagenes, si se guardaron en un cubo.
+
+    recalcular: bool, opcional
+        Si es True, el modelo se calcula aunque ya exista.
+
+    datos: numpy array, opcional
+        La imagen, si ya se leyó. Si es None, se lee solo cuando hay que calcular el modelo.
+
+    """
+
+    fname = "{}/{}".format(directorio_imagenes_reducidas, re.sub(".fits?", ".bkgmesh.fits", imagen))
+    if not recalcular and os.path.exists(fname):
+
+        #Si la imagen se volvió a reducir o alinear después de guardar el modelo, el modelo ya no le corresponde.
+        fuente = "{}/{}".format(directorio_imagenes_reducidas, imagen if cubo is None else cubo + ".npy")
+        if not os.path.exists(fuente) or os.path.getmtime(fname) >= os.path.getmtime(fuente):
+            return ModeloFondo.leer(fname)
+
+    if datos is None:
+        datos = abrir_imagenes(directorio_imagenes_reducidas, cubo).datos(imagen)
+    modelo = ModeloFondo.calcular(datos)
+    modelo.guardar(fname)
+    return modelo
+
+
+def calcular_fondos(imagenes, directorio_imagenes_reducidas="red", cubo=None, recalcular=False, n_procesos=1):
+    """
+    Calcula y guarda el modelo del fondo de varias imagenes, repartidas en n_procesos procesos. Las imagenes que ya tienen su modelo guardado se saltan si no se pide recalcular. Luego medir_fotometria solo lee los modelos guardados.
+
+    """
+
+    args = (directorio_imagenes_reducidas, cubo, recalcular)
+    if n_procesos == 1:
+        for imagen in imagenes:
+            _calcular_fondo(imagen, *args)
+    else:
+        with ProcessPoolExecutor(max_workers=n_procesos) as ejecutor:
+            list(ejecutor.map(_calcular_fondo, imagenes, *[[a]*len(imagenes) for a in args]))
+
+
+def _calcular_fondo(imagen, directorio_imagenes_reducidas, cubo, recalcular):
+    fondo_imagen(imagen, directorio_imagenes_reducidas, cubo, recalcular)
+
+
+def cielo_anillos(datos, posiciones, r_in, r_out, sigma=3.0, maxiters=5, fuentes_bloque=2000):
+    """
+    Calcula el cielo en un anillo alrededor de cada fuente, para todas las fuentes a la vez. Los pixeles cuyo centro cae dentro de cada anillo se juntan en un arreglo de (pixeles x fuentes), que se ordena una sola vez, y se les aplica una reyección iterativa de sigma a todas las fuentes a la vez, igual a la de sigma_clipped_stats. Los valores negativos del cielo se conservan.
+
+    Devuelve el promedio, la mediana y la desviación estándar del cielo de cada fuente.
+
+    Parametros
+    ----------
+
+    datos: numpy array
+        Imagen.
+
+    posiciones: numpy array
+        Arreglo de N x 2 con las posiciones (x, y) de las fuentes.
+
+    r_in, r_out: float
+        Radios interior y exterior del anillo, en pixeles.
+
+    sigma: float, opcional
+        Número de desviaciones estándar para la reyección.
+
+    maxiters: int, opcional
+        Número máximo de iteraciones de la reyección.
+
+    fuentes_bloque: int, opcional
+        Número de fuentes que se procesan a la vez, para limitar la memoria usada.
+
+    """
+
+    posiciones = np.asarray(posiciones, dtype=np.float64).reshape(-1, 2)
+    ny, nx = np.shape(datos)
+
+    #Desplazamientos de los pixeles de una caja que contiene el anillo, respecto al pixel más cercano a la fuente.
+    n = int(np.ceil(r_out)) + 1
+    dy, dx = np.mgrid[-n:n+1, -n:n+1]
+    dx, dy = dx.ravel(), dy.ravel()
+
+    promedio = np.full(len(posiciones), np.nan)
+    mediana = np.full(len(posiciones), np.nan)
+    desviacion = np.full(len(posiciones), np.nan)
+    for bloque in range(0, len(posiciones), fuentes_bloque):
+        x = posiciones[bloque:bloque+fuentes_bloque, 0]
+        y = posiciones[bloque:bloque+fuentes_bloque, 1]
+
+        #Juntar los pixeles de todos los anillos en un solo arreglo de (pixeles x fuentes). Los pixeles fuera del anillo o de la imagen se marcan con infinito, para que queden al final al ordenar.
+        ix = np.round(x).astype(int) + dx[:, None]
+        iy = np.round(y).astype(int) + dy[:, None]
+        d = np.hypot(ix - x, iy - y)
+        dentro = (d >= r_in) & (d < r_out) & (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+        valores = np.asarray(datos[np.clip(iy, 0, ny-1), np.clip(ix, 0, nx-1)], dtype=np.float64)
+        dentro &= np.isfinite(valores)
+        valores[~dentro] = np.inf
+
+        #Ordenar una sola vez. Los valores que se mantienen en cada iteración son siempre un intervalo [ini, fin) de los valores ordenados, como en combinar_imagenes.
+        valores.sort(axis=0)
+        n_validos = np.sum(dentro, axis=0)
+        ini = np.zeros(len(x), dtype=np.intp)
+        fin = n_validos.copy()
+
+        #Sumas acumuladas de los valores (centrados en la mediana inicial, para no perder precisión) y de sus cuadrados. Con ellas el promedio y la desviación estándar de cualquier intervalo son una resta.
+        centro_ini = np.nan_to_num(mediana_intervalo(valores, ini, np.maximum(fin, 1)), posinf=0.)
+        centrados = np.where(np.arange(len(valores))[:, None] < n_validos, valores - centro_ini, 0.)
+        suma = np.concatenate([np.zeros((1, len(x))), np.cumsum(centrados, axis=0)])
+        suma2 = np.concatenate([np.zeros((1, len(x))), np.cumsum(centrados**2, axis=0)])
+
+        #Reyección iterativa de sigma, como sigma_clip de astropy: en cada iteración los límites se calculan con los valores que quedan y solo pueden achicar el intervalo.
+        for k in range(maxiters):
+            centro = mediana_intervalo(valores, ini, np.maximum(fin, ini+1))
+            desviacion_k = _desviacion_intervalo(suma, suma2, ini, fin)
+            limite_inf = (centro - sigma*desviacion_k)[None]
+            limite_sup = (centro + sigma*desviacion_k)[None]
+            ini_nuevo = np.maximum(ini, np.sum(valores < limite_inf, axis=0))
+            fin_nuevo = np.minimum(fin, np.sum(valores <= limite_sup, axis=0))
+            if np.array_equal(ini_nuevo, ini) and np.array_equal(fin_nuevo, fin):
+                break
+            ini, fin = ini_nuevo, fin_nuevo
+
+        #Al terminar, los últimos límites se aplican a todos los valores.
+        ini = np.sum(valores < limite_inf, axis=0)
+        fin = np.minimum(np.sum(valores <= limite_sup, axis=0), n_validos)
+
+        #Estadísticas del intervalo final. Los anillos sin pixeles quedan en NaN.
+        n_val = fin - ini
+        validos = n_val > 0
+        ini, fin = ini[validos], fin[validos]
+        fuentes = np.arange(bloque, bloque+len(x))[validos]
+        suma_intervalo = tomar_indices(suma[:, validos], fin) - tomar_indices(suma[:, validos], ini)
+        promedio[fuentes] = suma_intervalo/n_val[validos] + centro_ini[validos]
+        mediana[fuentes] = mediana_intervalo(valores[:, validos], ini, fin)
+        desviacion[fuentes] = _desviacion_intervalo(suma[:, validos], suma2[:, validos], ini, fin)
+    return promedio, mediana, desviacion
+
+def _desviacion_intervalo(suma, suma2, ini, fin):
+    n_val = (fin - ini).astype(np.float64)
+    n_val[n_val <= 0] = np.nan
+    promedio = (tomar_indices(suma, fin) - tomar_indices(suma, ini)) / n_val
+    return np.sqrt(np.maximum((tomar_indices(suma2, fin) - tomar_indices(suma2, ini)) / n_val - promedio**2, 0.))
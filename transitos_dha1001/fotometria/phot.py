@@ -4,16 +4,18 @@ import re
 import astropy.units as u
 from astropy.time import Time
 
-from astropy.io import fits
-from astropy.stats import sigma_clipped_stats, SigmaClip
+from photutils import CircularAperture, aperture_photometry
 
-from photutils import CircularAperture, CircularAnnulus, aperture_photometry
-from photutils import Background2D, SExtractorBackground
+from ..reduccion.alinear import leer_transformaciones, transformar_posiciones
+from ..reduccion.cubo import abrir_imagenes
+from .aperturas import OperadorAperturas
+from .fondo import fondo_imagen, cielo_anillos
 
 pix_scale = 0.6 # Escala de un pixel en segundos de arco.
 fwhm_pix  = 1./pix_scale #Seeing fue aproximadamente 1".
+claves_almacen = ("DATE-OBS", "EXPTIME", "AIRMASS", "RA", "DEC") #Claves del encabezado que se guardan en el almacén de fotometría.
 
-def medir_fotometria(imagen, r_ap, r_an_in=None, r_an_out=None, directorio_imagenes_reducidas="imagenes_reducidas", directorio_fotometria="fotometria", bkg_type='global', RON=15.0, GAIN=1.33, recalcular=True):
+def medir_fotometria(imagen, r_ap, r_an_in=None, r_an_out=None, directorio_imagenes_reducidas="imagenes_reducidas", directorio_fotometria="fotometria", bkg_type='global', RON=15.0, GAIN=1.33, recalcular=True, posiciones_referencia=None, transformaciones=None, cubo=None, posiciones=None, operador=None, fondo_en_posiciones=True, almacen=None, recalcular_fondo=False):
     """
     Rutina para medir fotometría de apertura de las fuentes en una imagen ubicadas en ciertas posiciones.
 
@@ -23,8 +25,8 @@ def medir_fotometria(imagen, r_ap, r_an_in=None, r_an_out=None, directorio_image
     imagen: str
         Imagen en la que se medirá la fotometría.
 
-    r_ap: float
-        Radio de la apertura en segundos de arco.
+    r_ap: float o lista
+        Radio de la apertura en segundos de arco. Si es una lista de radios, la fotometría se mide en todos los radios a la vez con un OperadorAperturas (sumando anillos), se devuelven arreglos de (fuentes x radios) y se guarda en un archivo .multiphot.dat en vez de .phot.dat. Ver leer_fotometria y elegir_apertura.
 
     r_an_in: float, opcional
         Radio interior del anillo para calcular la contribución del cielo. Solo es usado si bkg_type es "local".
@@ -42,101 +44,202 @@ def medir_fotometria(imagen, r_ap, r_an_in=None, r_an_out=None, directorio_image
         Debe ser igual a "global" para hacer una estimación global del cielo, o "local" para hacerlo local a cada aperture usando un anillo. Si se usa local, se debe también definir r_an_in y r_an_out.
 
     recalcular: boolean, opcional
-        Debe ser True para recalcular la fotometría y la imagen de fondo (si bkg_type=global) si es que ya han sido calculadas con anterioridad.
+        Debe ser True para recalcular la fotometría si es que ya ha sido calculada con anterioridad. El modelo del fondo se controla aparte con recalcular_fondo.
+
+    posiciones_referencia: numpy array, opcional
+        Posiciones de las fuentes en la imagen de referencia. Solo se usan si no existe el archivo de posiciones de la imagen y se entregan las transformaciones.
+
+    transformaciones: diccionario o str, opcional
+        Transformaciones de cada imagen respecto a la referencia, o el archivo donde están guardadas, como las que calcula alinear_imagenes_ciencia con solo_transformacion=True. Permiten medir la fotometría en la imagen original sin alinear, llevando las posiciones de referencia a la imagen.
+
+    cubo: str, opcional
+        Nombre del cubo (sin extensión) donde están las imagenes, si se guardaron en un cubo en vez de archivos separados. La imagen de fondo se sigue guardando en directorio_imagenes_reducidas.
+
+    posiciones: numpy array, opcional
+        Posiciones de las fuentes en esta imagen, por ejemplo una fila del arreglo que devuelve dao_recentrar_lote. Si se entregan, no se lee el archivo de posiciones.
+
+    operador: OperadorAperturas, opcional
+        Operador con las aperturas precalculadas, con radio (o radios) r_ap en pixeles. Si se entrega, las sumas en las aperturas se hacen con el operador en vez de aperture_photometry, y el operador solo se recalcula si las posiciones se movieron más que su tolerancia. El mismo operador se puede usar para todas las imagenes de la noche.
+
+    fondo_en_posiciones: bool, opcional
+        Solo se usa si bkg_type es "global". Si es True, el fondo se evalúa solo en el centro de cada apertura y se multiplica por el área de la apertura que cae dentro de la imagen; esto supone que el fondo varía linealmente dentro de la apertura, y difiere de sumar la imagen de fondo solo por la curvatura del fondo en escalas del radio de la apertura. Si es False, se construye la imagen de fondo completa y se suma dentro de cada apertura, como antes de que existiera esta opción. El modelo del fondo se guarda como una grilla de baja resolución (ver ModeloFondo), y se puede calcular antes para todas las imagenes con calcular_fondos.
+
+    almacen: AlmacenFotometria, opcional
+        Si se entrega, la fotometría se lee y se guarda en el almacén binario de la noche (junto con las posiciones, el cielo y algunos datos del encabezado) en vez del archivo de texto de la imagen. Los radios del almacén deben ser r_ap.
+
+    recalcular_fondo: boolean, opcional
+        Solo se usa si bkg_type es "global". Si es True, el modelo del fondo se calcula aunque ya esté guardado. Si es False, se usa el modelo guardado (por ejemplo por calcular_fondos) siempre que no sea más antiguo que la imagen.
 
     """
 
     #Definir el nombre del archivo que guardará la fotometría.
-    phot_fname = re.sub(".fits?",".phot.dat",imagen)
+    multiple = np.ndim(r_ap) > 0
+    if multiple:
+        r_ap = np.sort(np.asarray(r_ap, dtype=np.float64))
+    phot_fname = re.sub(".fits?",".multiphot.dat" if multiple else ".phot.dat",imagen)
+
+    #Si se usa un almacén, revisar que tenga los mismos radios.
+    if almacen is not None:
+        if almacen.radios is None:
+            almacen.radios = np.atleast_1d(np.asarray(r_ap, dtype=np.float64))
+        elif len(almacen.radios) != np.size(r_ap) or not np.allclose(almacen.radios, r_ap):
+            raise ValueError("Los radios del almacén no corresponden a r_ap.")
+
     try:
         #Si se pide recalcular la fotometria, forzar la excepción.
         if recalcular:
             raise OSError
 
+        #Si se usa un almacén, leer la fotometría de ahí.
+        if almacen is not None:
+            if imagen not in almacen:
+                raise OSError
+            valores = almacen.imagen(imagen)
+            return valores["flujo"], valores["error"]
+
         #Tratar de leer el archivo con la fotometría. Si no existe, se levantará la excepción OSError y se procederá a hacer el cálculo. Si existe, leer y entregar los valores correspondientes.
+        if multiple:
+            radios, flujo, error = _leer_multifotometria("{}/{}".format(directorio_fotometria, phot_fname))
+            if len(radios) == len(r_ap) and np.allclose(radios, r_ap):
+                return flujo, error
+            raise OSError
         phot_data = np.loadtxt("{}/{}".format(directorio_fotometria, phot_fname))
         return phot_data[:,0], phot_data[:,1]
 
     except OSError:
         pass
 
-    #Nombre donde estarían guardadas las posiciones recentradas.
-    pos_fname = re.sub(".fits?",".pos.dat",imagen)
-    try:
-        #Tratar de leer el archivo. Si el archivo no existe, se levantará la excepción OSError, que llevará a calcular las posiciones.
-        pos_data = np.loadtxt("{}/{}".format(directorio_fotometria,pos_fname))
-        x = pos_data[:,0]
-        y = pos_data[:,1]
-        posiciones = np.vstack((x,y)).T
-    except OSError:
-        print("Se deben calcular las posiciones primero.")
-        return None, None
-
-    #Transformar la apertura y anillo a escala de pixeles y crear las aperturas.
-    r_ap_use     = r_ap/pix_scale
-    aps   = CircularAperture(posiciones, r=r_ap_use)
+    #Si se entregaron las posiciones, usarlas directamente. Si no, leerlas del archivo de posiciones recentradas.
+    if posiciones is not None:
+        posiciones = np.asarray(posiciones)
+    else:
+        #Nombre donde estarían guardadas las posiciones recentradas.
+        pos_fname = re.sub(".fits?",".pos.dat",imagen)
+        try:
+            #Tratar de leer el archivo. Si el archivo no existe, se levantará la excepción OSError, que llevará a calcular las posiciones.
+            pos_data = np.loadtxt("{}/{}".format(directorio_fotometria,pos_fname))
+            x = pos_data[:,0]
+            y = pos_data[:,1]
+            posiciones = np.vstack((x,y)).T
+        except OSError:
+            #Si no hay posiciones recentradas, pero sí las transformaciones, llevar las posiciones de referencia a la imagen.
+            if posiciones_referencia is None or transformaciones is None:
+                print("Se deben calcular las posiciones primero.")
+                return None, None
+            if isinstance(transformaciones, str):
+                transformaciones = leer_transformaciones(transformaciones)
+            posiciones = transformar_posiciones(posiciones_referencia, transformaciones[imagen])
+
+    #Transformar la apertura y anillo a escala de pixeles y crear las aperturas. Con varios radios, las aperturas las maneja el operador.
+    r_ap_use     = np.asarray(r_ap)/pix_scale if multiple else r_ap/pix_scale
+    aps   = None if multiple else CircularAperture(posiciones, r=r_ap_use)
     if bkg_type=='local':
         r_an_in_use  = r_an_in/pix_scale
         r_an_out_use = r_an_out/pix_scale
-        anns  = CircularAnnulus(posiciones, r_in=r_an_in_use, r_out=r_an_out_use)
 
-    #Abrir la imagen y medir la fotometría en las aperturas.
-    h = fits.open("{}/{}".format(directorio_imagenes_reducidas, imagen))
+    #Leer la imagen y medir la fotometría en las aperturas.
+    acceso = abrir_imagenes(directorio_imagenes_reducidas, cubo)
+    datos = acceso.datos(imagen)
+
+    #Si se usa el operador de aperturas, recalcularlo solo si las fuentes se movieron. Con varios radios y sin operador, crear uno solo para esta imagen.
+    if operador is not None:
+        if np.shape(operador.radio) != np.shape(r_ap_use) or not np.allclose(operador.radios, np.atleast_1d(r_ap_use)):
+            raise ValueError("El radio del operador de aperturas no corresponde a r_ap.")
+        operador.actualizar(posiciones)
+    elif multiple:
+        operador = OperadorAperturas(posiciones, r_ap_use, datos.shape, tolerancia=0.)
 
-    #Calcular la fotometria de apertura.
-    phot_table = aperture_photometry(h[0].data*GAIN, [aps])
+    #Calcular la fotometria de apertura. Las aperturas que cruzan el borde solo suman los pixeles de la imagen, así que el cielo se resta solo en el área que cae dentro.
+    suma_ap = _sumar_aperturas(datos*GAIN, aps, operador)
+    area_dentro = aps.area_overlap(datos) if operador is None else operador.area
 
     #Sustraer el cielo y calcular los errores.
     if bkg_type=='global':
 
-        #Si es global, lo primero es calcular la imagen del fondo.
-        bname = re.sub(".fits?",".bkg.fits",imagen)
-        bkg = _global_back(h, bname, directorio_imagenes_reducidas, recalcular=recalcular)
+        #Si es global, lo primero es leer o calcular el modelo del fondo.
+        bkg = fondo_imagen(imagen, directorio_imagenes_reducidas, cubo, recalcular=recalcular_fondo, datos=datos)
 
-        #Calcular la fotometria de apertura pero en la imagen de fondo ahora.
-        bkg_table = aperture_photometry(bkg.background*GAIN, [aps])
+        #Calcular la contribución del fondo en las aperturas, evaluándolo en el centro de cada una o sumando la imagen de fondo completa.
+        cielo = bkg.evaluar(posiciones[:,0], posiciones[:,1])
+        if fondo_en_posiciones:
+            bkg_centro = cielo
+            if multiple:
+                bkg_centro = bkg_centro[:,None]
+            suma_bkg = bkg_centro * area_dentro * GAIN
+        else:
+            suma_bkg = _sumar_aperturas(bkg.background*GAIN, aps, operador)
 
         #Ahora sustraemos la contribución del fondo y determinamos los errores.
-        suma_final = phot_table['aperture_sum_0'] - bkg_table['aperture_sum_0']
-        error_final = ( phot_table['aperture_sum_0'] + bkg_table['aperture_sum_0'] )**0.5
+        suma_final = suma_ap - suma_bkg
+        error_final = ( suma_ap + suma_bkg )**0.5
 
     elif bkg_type=='local':
 
         #Si es local, entonces calcular la contribución de los anillos.
-        bkg_mean, bkg_sig = _local_back(h, anns, posiciones)
-
-        #Sustraer la contribución del fondo.
-        bkg_sum = bkg_mean * aps.area
-        suma_final  = phot_table['aperture_sum_0'] - bkg_sum
-        error_final = ( phot_table['aperture_sum_0'] + bkg_sig**2 * (aps.area)**2 )**0.5
-
-    #Guardar la fotometria.
-    np.savetxt("{}/{}".format(directorio_fotometria, phot_fname), np.array([suma_final, error_final]).T)
+        bkg_mean, bkg_sig = _local_back(datos, posiciones, r_an_in_use, r_an_out_use)
+        cielo = bkg_mean
+        if multiple:
+            bkg_mean, bkg_sig = bkg_mean[:,None], bkg_sig[:,None]
+
+        #Sustraer la contribución del fondo. El cielo de los anillos está en cuentas y la suma de las aperturas en electrones.
+        bkg_sum = bkg_mean * area_dentro * GAIN
+        suma_final  = suma_ap - bkg_sum
+        error_final = ( suma_ap + (bkg_sig * GAIN)**2 * (area_dentro)**2 )**0.5
+
+    #Guardar la fotometria, en el almacén o en un archivo de texto. Con varios radios, en el archivo primero van los flujos en cada radio y luego los errores, con los radios en el encabezado.
+    if almacen is not None:
+        header = acceso.encabezado(imagen)
+        almacen.agregar(imagen, suma_final, error_final, posiciones[:,0], posiciones[:,1], cielo,
+                        **{clave: header[clave] for clave in claves_almacen if clave in header})
+    elif multiple:
+        np.savetxt("{}/{}".format(directorio_fotometria, phot_fname), np.hstack([suma_final, error_final]),
+                   header="radios " + " ".join(str(r) for r in r_ap))
+    else:
+        np.savetxt("{}/{}".format(directorio_fotometria, phot_fname), np.array([suma_final, error_final]).T)
 
     #Retornar la fotometria.
     return suma_final, error_final
 
 
-def _global_back(h, bname, data_folder, recalcular=False):
-    sigma_clip = SigmaClip(sigma=3.)
-    bkg_estimator = SExtractorBackground()
-    bkg = Background2D(h[0].data, (50, 50), filter_size=(3, 3), sigma_clip=sigma_clip, bkg_estimator=bkg_estimator)
-    try:
-        if recalcular:
-            raise FileNotFoundError
-        bkg_image = fits.open("{0:s}/{1:s}".format(data_folder, bname))
-        bkg.background = bkg_image[0].data
-    except FileNotFoundError:
-        bkg = Background2D(h[0].data, (50, 50), filter_size=(3, 3), sigma_clip=sigma_clip, bkg_estimator=bkg_estimator)
-        fits.writeto("{0:s}/{1:s}".format(data_folder, bname), bkg.background, overwrite=True)
-    return bkg
-
-def _local_back(h, anns, posiciones):
-    annulus_masks = anns.to_mask(method='center')
-    bkg_mean = np.zeros(len(posiciones))
-    bkg_sig  = np.zeros(len(posiciones))
-    for k, ann_mask in enumerate(annulus_masks):
-        ann_data = ann_mask.multiply(h[0].data)
-        ann_data_1d = ann_data[ann_data>0]
-        bkg_mean[k], bkg_median, bkg_sig[k] = sigma_clipped_stats(ann_data_1d)
+def leer_fotometria(imagen, directorio_fotometria="fotometria", r_ap=None):
+    """
+    Lee la fotometría de una imagen guardada por medir_fotometria y devuelve el flujo y el error de cada fuente.
+
+    Parametros
+    ----------
+
+    imagen: str
+        Imagen de la que se leerá la fotometría.
+
+    directorio_fotometria: str, opcional
+        Directorio donde se encuentran los archivos de la fotometría.
+
+    r_ap: float, opcional
+        Si es None, se lee el archivo .phot.dat. Si se indica, se lee la fotometría en ese radio (en segundos de arco) del archivo .multiphot.dat.
+
+    """
+
+    if r_ap is None:
+        phot_data = np.loadtxt("{}/{}".format(directorio_fotometria, re.sub(".fits?",".phot.dat",imagen)))
+        return phot_data[:,0], phot_data[:,1]
+
+    radios, flujo, error = _leer_multifotometria("{}/{}".format(directorio_fotometria, re.sub(".fits?",".multiphot.dat",imagen)))
+    j = np.flatnonzero(np.isclose(radios, r_ap))
+    if len(j) == 0:
+        raise ValueError("El radio {} no fue medido en la imagen {}.".format(r_ap, imagen))
+    return flujo[:,j[0]], error[:,j[0]]
+
+def _leer_multifotometria(fname):
+    with open(fname) as f:
+        radios = np.array(f.readline().split()[2:], dtype=np.float64)
+    phot_data = np.loadtxt(fname, ndmin=2)
+    return radios, phot_data[:,:len(radios)], phot_data[:,len(radios):]
+
+def _sumar_aperturas(datos, aps, operador=None):
+    if operador is None:
+        return aperture_photometry(datos, [aps])['aperture_sum_0']
+    return operador.sumar(datos)
+
+def _local_back(datos, posiciones, r_in, r_out):
+    bkg_mean, bkg_median, bkg_sig = cielo_anillos(datos, posiciones, r_in, r_out)
     return bkg_mean, bkg_sig
@@ -0,0 +1,124 @@
+import numpy as np
+
+def matriz_regresores(tiempo, airmass=None, cielo=None, dx=None, dy=None, fwhm=None, grado_tiempo=2):
+    """
+    Construye la matriz de regresores de (imagenes x regresores) para ajustar_tendencias. La primera columna es una constante; luego va cada regresor entregado, restándole su promedio y dividiéndolo por su desviación estándar, y al final las potencias del tiempo (llevado al intervalo [-1, 1]) hasta grado_tiempo. Los regresores que no se entregan, o que son constantes, no se incluyen.
+
+    Devuelve la matriz y la lista con el nombre de cada columna.
+
+    Parametros
+    ----------
+
+    tiempo: numpy array
+        Tiempo de cada imagen.
+
+    airmass, cielo, dx, dy, fwhm: numpy array, opcional
+        Masa de aire, nivel del cielo, desplazamiento de los centroides en x e y, y FWHM de cada imagen.
+
+    grado_tiempo: int, opcional
+        Grado del polinomio en el tiempo. Con 0 no se incluye el tiempo.
+
+    """
+
+    tiempo = np.asarray(tiempo, dtype=np.float64)
+    columnas = [np.ones(len(tiempo))]
+    nombres = ["constante"]
+
+    for nombre, valores in (("airmass", airmass), ("cielo", cielo), ("dx", dx), ("dy", dy), ("fwhm", fwhm)):
+        if valores is None:
+            continue
+        valores = np.asarray(valores, dtype=np.float64)
+        if not np.any(np.isfinite(valores)):
+            continue
+        valores = np.where(np.isfinite(valores), valores, np.nanmean(valores))
+        desviacion = np.std(valores)
+        if desviacion == 0:
+            continue
+        columnas.append((valores - np.mean(valores)) / desviacion)
+        nombres.append(nombre)
+
+    #Potencias del tiempo, en [-1, 1] para que la matriz quede bien condicionada.
+    if grado_tiempo > 0 and np.ptp(tiempo) > 0:
+        t = 2.*(tiempo - np.min(tiempo))/np.ptp(tiempo) - 1.
+        for grado in range(1, grado_tiempo+1):
+            columnas.append(t**grado)
+            nombres.append("tiempo{}".format(grado))
+
+    return np.stack(columnas, axis=1), nombres
+
+def mascara_transito(tiempo, t_inicio, t_fin):
+    """
+    Devuelve un arreglo booleano que es True para las imagenes fuera de la ventana del tránsito [t_inicio, t_fin], las que se usan para ajustar las tendencias.
+
+    """
+
+    tiempo = np.asarray(tiempo)
+    return (tiempo < t_inicio) | (tiempo > t_fin)
+
+def ajustar_tendencias(mag, regresores, mag_err=None, mascara=None):
+    """
+    Ajusta la misma combinación de regresores a todas las fuentes a la vez, por mínimos cuadrados, sobre el arreglo de (imagenes x fuentes) con las magnitudes. Si ninguna fuente tiene mediciones faltantes y no se entregan errores, todas las fuentes se ajustan con una sola llamada a lstsq con varias columnas; si no, se arman las ecuaciones normales de cada fuente con sus propios pesos y se resuelven todas en una sola llamada. En ambos casos ajustar un modelo toma una fracción de segundo, así que se pueden comparar muchos modelos (por ejemplo con distintos regresores) de forma interactiva.
+
+    Devuelve las magnitudes corregidas (sin la tendencia, pero conservando el nivel medio de cada fuente), los coeficientes de (fuentes x regresores), la tendencia ajustada de (imagenes x fuentes), la dispersión de los residuos y el BIC de cada fuente, para comparar modelos.
+
+    Parametros
+    ----------
+
+    mag: numpy array
+        Magnitudes de (imagenes x fuentes), o de una sola fuente. Las mediciones que faltan deben ser NaN.
+
+    regresores: numpy array
+        Matriz de (imagenes x regresores), como la que entrega matriz_regresores. La primera columna debe ser la constante.
+
+    mag_err: numpy array, opcional
+        Errores de las magnitudes, para pesar cada medición.
+
+    mascara: numpy array, opcional
+        Arreglo booleano con las imagenes que se usan en el ajuste, por ejemplo las que están fuera del tránsito (ver mascara_transito). La corrección se aplica a todas las imagenes.
+
+    """
+
+    mag = np.asarray(mag, dtype=np.float64)
+    una_fuente = mag.ndim == 1
+    if una_fuente:
+        mag = mag[:,None]
+        mag_err = None if mag_err is None else np.asarray(mag_err)[:,None]
+    X = np.asarray(regresores, dtype=np.float64)
+    n_regresores = X.shape[1]
+
+    usados = np.isfinite(mag)
+    if mascara is not None:
+        usados &= np.asarray(mascara, dtype=bool)[:,None]
+    y = np.where(usados, mag, 0.)
+
+    if mag_err is None and np.all(usados == usados[:,:1]):
+
+        #Todas las fuentes usan las mismas imagenes con el mismo peso: un solo ajuste con varias columnas.
+        filas = usados[:,0]
+        coeficientes = np.linalg.lstsq(X[filas], y[filas], rcond=None)[0].T
+    else:
+
+        #Ecuaciones normales de cada fuente, con sus propias imagenes y pesos, resueltas todas a la vez.
+        pesos = usados.astype(np.float64) if mag_err is None else np.where(usados, 1./np.maximum(np.asarray(mag_err, dtype=np.float64), 1e-6)**2, 0.)
+        A = (pesos.T @ (X[:,:,None]*X[:,None,:]).reshape(len(X), -1)).reshape(-1, n_regresores, n_regresores)
+        b = (pesos*y).T @ X
+        try:
+            coeficientes = np.linalg.solve(A, b[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            coeficientes = np.einsum('spq,sq->sp', np.linalg.pinv(A), b)
+
+    #Tendencia y magnitudes corregidas, conservando la constante de cada fuente.
+    tendencia = X @ coeficientes.T
+    corregidas = mag - (tendencia - coeficientes[:,0][None])
+
+    #Dispersión de los residuos y BIC de cada fuente, solo con las imagenes usadas en el ajuste.
+    residuos = np.where(usados, mag - tendencia, 0.)
+    n = np.sum(usados, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rss = np.sum(residuos**2, axis=0)
+        rms = np.sqrt(rss/n)
+        bic = n*np.log(rss/n) + n_regresores*np.log(n)
+
+    if una_fuente:
+        return corregidas[:,0], coeficientes[0], tendencia[:,0], rms[0], bic[0]
+    return corregidas, coeficientes, tendencia, rms, bic
@@ -0,0 +1,62 @@
+import numpy as np
+
+import astropy.units as u
+from astropy.time import Time
+from astropy.coordinates import SkyCoord, EarthLocation
+
+#Observatorio El Sauce, Río Hurtado, Chile.
+el_sauce = EarthLocation(lat=-30.4726*u.deg, lon=-70.7631*u.deg, height=1600.*u.m)
+
+def tiempos_imagenes(fechas, exptime=None, ra=None, dec=None, desfase=4.0, mitad_exposicion=True, sitio=el_sauce):
+    """
+    Convierte los DATE-OBS de todas las imagenes de una noche, de una sola vez, al dia Juliano modificado en UTC y al dia Juliano baricéntrico en TDB (BJD_TDB). La corrección baricéntrica se calcula para todas las imagenes en una sola llamada a light_travel_time, con las efemérides internas de astropy, así que no se descarga nada.
+
+    Devuelve dos arreglos: mjd_utc y bjd_tdb. Si no se entregan coordenadas, bjd_tdb es NaN.
+
+    Parámetros
+    ----------
+
+    fechas: lista
+        DATE-OBS de cada imagen, en formato isot.
+
+    exptime: float o lista, opcional
+        Tiempo de exposición de cada imagen, en segundos.
+
+    ra, dec: float, str o lista, opcional
+        Coordenadas del objeto, una para toda la noche o una por imagen. Pueden ser grados o textos sexagesimales como los de los encabezados (ra en horas).
+
+    desfase: float, opcional
+        Horas que se suman a DATE-OBS para llevarlo a UTC. Las imagenes de la cámara guardan la hora local (UTC-4), por eso el valor por defecto es 4.
+
+    mitad_exposicion: bool, opcional
+        Si es True, y se entrega exptime, el tiempo corresponde a la mitad de la exposición en vez del comienzo.
+
+    sitio: EarthLocation, opcional
+        Ubicación del observatorio.
+
+    """
+
+    t = Time(list(fechas), format='isot', scale='utc', location=sitio) + desfase*u.hr
+    if mitad_exposicion and exptime is not None:
+        t = t + 0.5*np.asarray(exptime, dtype=np.float64)*u.s
+    mjd_utc = np.atleast_1d(t.mjd)
+
+    if ra is None or dec is None:
+        return mjd_utc, np.full(len(mjd_utc), np.nan)
+
+    #Corrección por el tiempo de viaje de la luz hasta el baricentro del sistema solar, para todas las imagenes a la vez.
+    objeto = coordenadas(ra, dec)
+    ltt = t.light_travel_time(objeto, kind='barycentric', ephemeris='builtin')
+    bjd_tdb = np.atleast_1d((t.tdb + ltt).jd)
+    return mjd_utc, bjd_tdb
+
+def coordenadas(ra, dec):
+    """
+    Devuelve un SkyCoord a partir de ra y dec en grados o como textos sexagesimales (ra en horas), como los de los encabezados.
+
+    """
+
+    ra, dec = np.asarray(ra), np.asarray(dec)
+    if ra.dtype.kind in "US":
+        return SkyCoord(ra.tolist(), dec.tolist(), unit=(u.hourangle, u.deg))
+    return SkyCoord(ra*u.deg, dec*u.deg)
@@ -0,0 +1,286 @@
+import numpy as np
+import glob
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from astropy.io import fits
+
+from .pipeline import pipeline_noche, _serializar
+from .reduccion.combinar import rechazos
+from .reduccion.indice import indice_imagenes
+
+#Opciones de pipeline_noche que se pueden dar en el manifiesto.
+opciones_noche = ("r_ap", "bkg_type", "zonas_a_filtrar", "caja_busqueda", "metodo_alineamiento", "solo_transformacion", "cubo")
+
+def leer_manifiesto(archivo):
+    """
+    Lee el manifiesto JSON de un lote de noches, y devuelve la lista de noches con todo resuelto: las listas de imagenes (los patrones se buscan con glob en el directorio de imagenes originales), las calibraciones, los directorios de salida, las coordenadas del objeto y las opciones del pipeline.
+
+    El manifiesto es un diccionario con las claves:
+
+        noches: lista con un diccionario por noche, con las claves nombre, directorio_imagenes_originales, ciencia, y opcionalmente bias, darks, flats (o calibracion), objeto, ra, dec, memoria, directorio_imagenes_reducidas, directorio_fotometria y cualquiera de las opciones de pipeline_noche (r_ap, bkg_type, zonas_a_filtrar, caja_busqueda, metodo_alineamiento, solo_transformacion, cubo).
+        calibraciones: opcional, diccionario de conjuntos de calibración con nombre, cada uno con las claves bias, darks, flats y opcionalmente directorio_imagenes_originales, para compartirlos entre noches con calibracion = nombre del conjunto.
+        objetos: opcional, diccionario con las coordenadas (ra, dec) de cada objeto, para las noches que indican objeto en vez de ra y dec.
+        opciones: opcional, opciones de pipeline_noche que se usan en todas las noches que no las cambian.
+        directorio_salida: opcional, directorio donde se crean los directorios red y fot de cada noche (directorio_salida/nombre/red y directorio_salida/nombre/fot). Por defecto es "lote".
+
+    Las listas de imagenes pueden ser listas de nombres o un patrón como "bias*.fits".
+
+    Parámetros
+    ----------
+
+    archivo: str
+        Archivo JSON con el manifiesto.
+
+    """
+
+    with open(archivo) as f:
+        manifiesto = json.load(f)
+
+    calibraciones = manifiesto.get("calibraciones", {})
+    objetos = manifiesto.get("objetos", {})
+    opciones = manifiesto.get("opciones", {})
+    salida = manifiesto.get("directorio_salida", "lote")
+
+    noches = []
+    nombres = set()
+    for entrada in manifiesto["noches"]:
+        nombre = entrada["nombre"]
+        if nombre in nombres:
+            raise ValueError("La noche {} aparece más de una vez en el manifiesto.".format(nombre))
+        nombres.add(nombre)
+        raw = entrada["directorio_imagenes_originales"]
+        noche = {"nombre": nombre, "directorio_imagenes_originales": raw,
+                 "directorio_imagenes_reducidas": entrada.get("directorio_imagenes_reducidas", "{}/{}/red".format(salida, nombre)),
+                 "directorio_fotometria": entrada.get("directorio_fotometria", "{}/{}/fot".format(salida, nombre)),
+                 "memoria": entrada.get("memoria")}
+
+        #Imagenes de calibración: de la misma noche o de un conjunto compartido. Si el conjunto está en otro directorio, las rutas se dan relativas al directorio de la noche.
+        calibracion = calibraciones[entrada["calibracion"]] if "calibracion" in entrada else entrada
+        raw_calibracion = calibracion.get("directorio_imagenes_originales", raw)
+        for tipo in ("bias", "darks", "flats"):
+            imagenes = _resolver_imagenes(calibracion.get(tipo, []), raw_calibracion)
+            noche[tipo] = [os.path.relpath("{}/{}".format(raw_calibracion, im), raw) for im in imagenes] if raw_calibracion != raw else imagenes
+        noche["ciencia"] = _resolver_imagenes(entrada["ciencia"], raw)
+        if len(noche["ciencia"]) == 0:
+            raise ValueError("La noche {} no tiene imagenes de ciencia.".format(nombre))
+
+        #Coordenadas del objeto, para los tiempos baricéntricos del resumen.
+        objeto = objetos.get(entrada.get("objeto"), {})
+        noche["objeto"] = entrada.get("objeto")
+        noche["ra"] = entrada.get("ra", objeto.get("ra"))
+        noche["dec"] = entrada.get("dec", objeto.get("dec"))
+
+        noche["opciones"] = {clave: entrada.get(clave, opciones.get(clave)) for clave in opciones_noche if clave in entrada or clave in opciones}
+        noches.append(noche)
+
+    return noches
+
+def _resolver_imagenes(imagenes, directorio):
+    if isinstance(imagenes, str):
+        return sorted(os.path.basename(f) for f in glob.glob("{}/{}".format(directorio, imagenes)))
+    return list(imagenes)
+
+def estimar_memoria(noche, n_hilos=1, memoria_combinacion_mb=512, imagenes_por_etapa=8, memoria_base_mb=200):
+    """
+    Estima la memoria en bytes que usa una noche, a partir del tamaño de sus imagenes. La combinación de las imagenes de calibración lee las imagenes por franjas, así que usa a lo más memoria_combinacion_mb para las franjas (menos si el conjunto completo cabe en ese espacio) más unas pocas imagenes completas para el núcleo de calibración y el resultado. La reducción, el alineamiento, la búsqueda y la fotometría tienen en memoria unas pocas copias de una sola imagen como float64, y el pipeline ejecuta hasta n_hilos de esas etapas a la vez. La estimación es la mayor de las dos, más la memoria base del proceso.
+
+    Parámetros
+    ----------
+
+    noche: diccionario
+        Noche, como las que entrega leer_manifiesto. Si tiene la clave memoria, se usa ese valor.
+
+    n_hilos: int, opcional
+        Número de etapas de la noche que se ejecutan al mismo tiempo. Ver procesar_noche.
+
+    memoria_combinacion_mb: float, opcional
+        Memoria para las franjas al combinar las imagenes de calibración, igual a memoria_mb de combinar_imagenes.
+
+    imagenes_por_etapa: float, opcional
+        Número de imagenes completas en float64 que usa cada etapa que trabaja sobre una imagen.
+
+    memoria_base_mb: float, opcional
+        Memoria del proceso sin contar las imagenes (Python, numpy, astropy).
+
+    """
+
+    if noche.get("memoria") is not None:
+        return int(noche["memoria"])
+
+    #Número de pixeles de una imagen, del encabezado de la primera imagen de ciencia. Si no se puede leer, se supone una imagen de 16 bits.
+    raw = noche["directorio_imagenes_originales"]
+    fname = "{}/{}".format(raw, noche["ciencia"][0])
+    try:
+        header = fits.getheader(fname)
+        n_pixeles = header['NAXIS1']*header['NAXIS2']
+    except (OSError, KeyError):
+        n_pixeles = os.path.getsize(fname)//2 if os.path.exists(fname) else 2048*2048
+    bytes_imagen = 8*n_pixeles
+
+    #Combinación: las franjas de todas las imagenes del conjunto más grande (con los arreglos auxiliares del rechazo sigma, el que más usa), hasta la memoria de la combinación, más los temporales de combinar cada franja, que son del mismo orden.
+    n_calibracion = max(len(noche["bias"]), len(noche["darks"]), len(noche["flats"]), 1)
+    franjas = min((1 + max(rechazos.values()))*(n_calibracion + 1)*bytes_imagen, memoria_combinacion_mb*2**20)
+    combinacion = 2*franjas + 4*bytes_imagen
+
+    #Etapas por imagen, hasta n_hilos a la vez.
+    por_imagen = max(n_hilos, 1)*imagenes_por_etapa*bytes_imagen
+
+    return int(max(combinacion, por_imagen) + memoria_base_mb*2**20)
+
+def memoria_disponible():
+    """
+    Devuelve la memoria disponible del sistema en bytes, o None si no se puede saber.
+
+    """
+
+    try:
+        with open("/proc/meminfo") as f:
+            for linea in f:
+                if linea.startswith("MemAvailable:"):
+                    return int(linea.split()[1])*1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_PAGE_SIZE")*os.sysconf("SC_AVPHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def procesar_noche(noche, n_hilos=1, forzar=False):
+    """
+    Ejecuta el pipeline completo de una noche (pipeline_noche) y escribe su resumen en resumen_noche.json, en el directorio de imagenes reducidas de la noche. Como el pipeline guarda su estado, una noche que ya se procesó solo recalcula las etapas que cambiaron.
+
+    Devuelve el resumen: nombre, resultado de cada etapa y número de etapas por resultado, tiempo de ejecución, número de imagenes de cada tipo, número de fuentes encontradas, y rango de tiempos (mjd y bjd_tdb) y de masa de aire de las imagenes de ciencia.
+
+    Parámetros
+    ----------
+
+    noche: diccionario
+        Noche, como las que entrega leer_manifiesto.
+
+    n_hilos: int, opcional
+        Número de etapas de la noche que se ejecutan al mismo tiempo.
+
+    forzar: bool, opcional
+        Si es True, se recalculan todas las etapas.
+
+    """
+
+    inicio = time.time()
+    red = noche["directorio_imagenes_reducidas"]
+    fot = noche["directorio_fotometria"]
+    os.makedirs(red, exist_ok=True)
+    os.makedirs(fot, exist_ok=True)
+
+    pipeline = pipeline_noche(noche["bias"], noche["darks"], noche["flats"], noche["ciencia"],
+                              directorio_imagenes_originales=noche["directorio_imagenes_originales"],
+                              directorio_imagenes_reducidas=red, directorio_fotometria=fot, **noche["opciones"])
+    etapas = pipeline.ejecutar(n_hilos=n_hilos, forzar=forzar)
+
+    resumen = {"nombre": noche["nombre"], "objeto": noche.get("objeto"), "etapas": etapas,
+               "n_etapas": {resultado: sum(1 for r in etapas.values() if r == resultado) for resultado in ("ejecutada", "al_dia", "fallida", "omitida")},
+               "n_imagenes": {tipo: len(noche[tipo]) for tipo in ("bias", "darks", "flats", "ciencia")}}
+
+    #Número de fuentes en la imagen de referencia.
+    posiciones = [pipeline.etapas["busqueda"]["salidas"][0]] if "busqueda" in pipeline.etapas else []
+    resumen["n_fuentes"] = int(len(np.loadtxt(posiciones[0], ndmin=2))) if len(posiciones) > 0 and os.path.exists(posiciones[0]) else None
+
+    #Tiempos y masa de aire, solo de los encabezados de las imagenes de ciencia.
+    try:
+        indice = indice_imagenes(noche["ciencia"], noche["directorio_imagenes_originales"], archivo="{}/indice_originales.ecsv".format(red),
+                                 ra=noche.get("ra"), dec=noche.get("dec"))
+        for columna in ("mjd", "bjd_tdb", "AIRMASS"):
+            valores = np.asarray(indice[columna], dtype=np.float64) if columna in indice.colnames and indice[columna].dtype.kind == 'f' else np.array([np.nan])
+            resumen[columna.lower()] = [float(np.nanmin(valores)), float(np.nanmax(valores))] if np.any(np.isfinite(valores)) else None
+    except Exception as e:
+        print("No se pudo leer los encabezados de la noche", noche["nombre"], ":", repr(e))
+
+    resumen["segundos"] = time.time() - inicio
+    _escribir_json("{}/resumen_noche.json".format(red), resumen)
+    return resumen
+
+def ejecutar_lote(noches, n_procesos=None, memoria_maxima=None, n_hilos=1, forzar=False, archivo_resumen=None):
+    """
+    Procesa un lote de noches, por ejemplo una temporada completa, repartiendo las noches entre procesos. Una noche solo se lanza si la suma de la memoria estimada de las noches en curso (ver estimar_memoria) no supera memoria_maxima, así que se pueden procesar muchas noches en una sola máquina sin quedarse sin memoria; si una sola noche no cabe, se procesa sola. Las noches que fallan no detienen el lote.
+
+    Al terminar cada noche se actualiza el resumen del lote, con el resumen de cada noche (ver procesar_noche) o el error que la detuvo. Como cada noche guarda el estado de su pipeline, al volver a ejecutar el lote solo se recalcula lo que cambió.
+
+    Devuelve el resumen del lote, un diccionario con el resumen de cada noche.
+
+    Parámetros
+    ----------
+
+    noches: str o lista
+        Archivo del manifiesto, o lista de noches como la que entrega leer_manifiesto.
+
+    n_procesos: int, opcional
+        Número máximo de noches que se procesan al mismo tiempo. Por defecto es el número de CPUs dividido por n_hilos.
+
+    memoria_maxima: float, opcional
+        Memoria en bytes que pueden usar las noches en curso. Por defecto es el 80% de la memoria disponible al comenzar.
+
+    n_hilos: int, opcional
+        Número de etapas de cada noche que se ejecutan al mismo tiempo.
+
+    forzar: bool, opcional
+        Si es True, se recalculan todas las etapas de todas las noches.
+
+    archivo_resumen: str, opcional
+        Archivo JSON donde se guarda el resumen del lote. Por defecto es resumen_lote.json, en el directorio del manifiesto o en el directorio actual.
+
+    """
+
+    if isinstance(noches, str):
+        if archivo_resumen is None:
+            archivo_resumen = "{}/resumen_lote.json".format(os.path.dirname(os.path.abspath(noches)))
+        noches = leer_manifiesto(noches)
+    if archivo_resumen is None:
+        archivo_resumen = "resumen_lote.json"
+    if n_procesos is None:
+        n_procesos = max((os.cpu_count() or 1) // max(n_hilos, 1), 1)
+    if memoria_maxima is None:
+        disponible = memoria_disponible()
+        memoria_maxima = np.inf if disponible is None else 0.8*disponible
+
+    memoria = {noche["nombre"]: estimar_memoria(noche, n_hilos) for noche in noches}
+    resumen = {"noches": {}, "n_procesos": n_procesos, "memoria_maxima": None if not np.isfinite(memoria_maxima) else float(memoria_maxima)}
+    pendientes = list(noches)
+    en_curso = {}
+
+    with ProcessPoolExecutor(max_workers=n_procesos) as ejecutor:
+        while len(pendientes) > 0 or len(en_curso) > 0:
+
+            #Lanzar, en orden, las noches que caben en la memoria libre. Si no hay ninguna en curso, la siguiente se lanza aunque no quepa.
+            usada = sum(memoria[nombre] for nombre in en_curso.values())
+            for noche in list(pendientes):
+                if len(en_curso) >= n_procesos:
+                    break
+                if len(en_curso) > 0 and usada + memoria[noche["nombre"]] > memoria_maxima:
+                    continue
+                print("Procesando la noche", noche["nombre"])
+                en_curso[ejecutor.submit(procesar_noche, noche, n_hilos, forzar)] = noche["nombre"]
+                usada += memoria[noche["nombre"]]
+                pendientes.remove(noche)
+
+            #Esperar a que termine alguna noche y actualizar el resumen del lote.
+            terminados, _ = wait(en_curso, return_when=FIRST_COMPLETED)
+            for futuro in terminados:
+                nombre = en_curso.pop(futuro)
+                try:
+                    resumen["noches"][nombre] = futuro.result()
+                    print("Terminó la noche", nombre)
+                except Exception as e:
+                    print("La noche", nombre, "falló:", repr(e))
+                    resumen["noches"][nombre] = {"nombre": nombre, "error": repr(e)}
+            _escribir_json(archivo_resumen, resumen)
+
+    return resumen
+
+def _escribir_json(fname, datos):
+    #Escribir primero a un archivo temporal, igual que el estado del pipeline.
+    temporal = fname + ".tmp"
+    with open(temporal, "w") as f:
+        json.dump(datos, f, indent=1, default=_serializar)
+    os.replace(temporal, fname)
@@ -0,0 +1,390 @@
+import numpy as np
+import hashlib
+import inspect
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .reduccion.master_bias import crear_masterbias
+from .reduccion.master_dark import crear_masterdark
+from .reduccion.master_flat import crear_masterflat
+from .reduccion.science import reducir_imagenes_ciencia
+from .reduccion.alinear import alinear_imagenes_ciencia
+from .fotometria.dao import dao_busqueda, dao_recentrar, filtrar_posiciones
+from .fotometria.phot import medir_fotometria
+
+class Pipeline:
+    """
+    Pipeline de etapas con dependencias. Cada etapa es una función con sus parámetros, los archivos que lee (entradas) y los archivos que escribe (salidas). Cada vez que una etapa termina se guarda en el archivo de estado el hash del contenido de sus entradas y salidas y de sus parámetros, de modo que al volver a ejecutar el pipeline solo se recalculan las etapas cuyas entradas o parámetros cambiaron, o cuyas salidas no existen. Como el estado se guarda después de cada etapa, una noche interrumpida se retoma desde la última etapa terminada.
+
+    Parámetros
+    ----------
+
+    archivo_estado: str, opcional
+        Archivo JSON donde se guarda el estado de las etapas.
+
+    """
+
+    def __init__(self, archivo_estado="pipeline_estado.json"):
+        self.archivo_estado = archivo_estado
+        self.etapas = {}
+        self._candado = threading.Lock()
+
+        #Leer el estado de ejecuciones anteriores.
+        try:
+            with open(archivo_estado) as f:
+                self.estado = json.load(f)
+        except FileNotFoundError:
+            self.estado = {"etapas": {}, "hashes": {}}
+
+    def agregar(self, nombre, funcion, parametros=None, entradas=(), salidas=(), depende_de=()):
+        """
+        Agrega una etapa al pipeline.
+
+        Parámetros
+        ----------
+
+        nombre: str
+            Nombre único de la etapa.
+
+        funcion: función
+            Función que ejecuta la etapa. Se llama como funcion(**parametros). Si la función tiene un parámetro recalcular, se le entrega recalcular=True, pues es el pipeline el que decide si hay que recalcular. La etapa se considera fallida si la función lanza una excepción o si al terminar falta alguna de sus salidas.
+
+        parametros: diccionario, opcional
+            Parámetros de la función. Si cambian, la etapa se recalcula.
+
+        entradas: lista, opcional
+            Archivos que lee la etapa. Si su contenido cambia, la etapa se recalcula.
+
+        salidas: lista, opcional
+            Archivos que escribe la etapa. Si alguno no existe o fue modificado, la etapa se recalcula. Una etapa que lee la salida de otra depende automáticamente de ella.
+
+        depende_de: lista, opcional
+            Nombres de otras etapas que deben terminar antes que esta, además de las que se deducen de las entradas.
+
+        """
+
+        if nombre in self.etapas:
+            raise ValueError("Ya existe una etapa llamada {}.".format(nombre))
+        self.etapas[nombre] = {"funcion": funcion,
+                               "parametros": {} if parametros is None else dict(parametros),
+                               "entradas": list(entradas),
+                               "salidas": list(salidas),
+                               "depende_de": list(depende_de)}
+
+    def dependencias(self, nombre):
+        """
+        Devuelve los nombres de las etapas de las que depende una etapa.
+
+        """
+
+        productores = {fname: otro for otro, otra_etapa in self.etapas.items() for fname in otra_etapa["salidas"]}
+        etapa = self.etapas[nombre]
+        deps = set(etapa["depende_de"])
+        for fname in etapa["entradas"]:
+            if fname in productores and productores[fname] != nombre:
+                deps.add(productores[fname])
+        return deps
+
+    def obsoleta(self, nombre):
+        """
+        Devuelve True si la etapa tiene que recalcularse: si nunca se ha ejecutado, si cambiaron sus parámetros o el contenido de sus entradas, o si falta o fue modificada alguna de sus salidas.
+
+        """
+
+        etapa = self.etapas[nombre]
+        registro = self.estado["etapas"].get(nombre)
+        if registro is None:
+            return True
+        if registro["parametros"] != self._hash_parametros(etapa):
+            return True
+        for fname in etapa["salidas"]:
+            if not os.path.exists(fname) or registro["salidas"].get(fname) != self._hash_archivo(fname):
+                return True
+        for fname in etapa["entradas"]:
+            if registro["entradas"].get(fname) != self._hash_archivo(fname):
+                return True
+        return False
+
+    def ejecutar(self, n_hilos=1, forzar=False):
+        """
+        Ejecuta las etapas obsoletas en orden de dependencias. Las etapas que no dependen entre sí se ejecutan en paralelo en n_hilos hilos. Si una etapa falla, las que dependen de ella no se ejecutan, pero el resto del pipeline continúa.
+
+        Devuelve un diccionario con el resultado de cada etapa: "ejecutada", "al_dia", "fallida" u "omitida".
+
+        Parámetros
+        ----------
+
+        n_hilos: int, opcional
+            Número máximo de etapas que se ejecutan al mismo tiempo.
+
+        forzar: bool, opcional
+            Si es True, se recalculan todas las etapas.
+
+        """
+
+        deps = {nombre: self.dependencias(nombre) for nombre in self.etapas}
+        for nombre in deps:
+            for dep in deps[nombre]:
+                if dep not in self.etapas:
+                    raise ValueError("La etapa {} depende de {}, que no existe.".format(nombre, dep))
+
+        resultados = {}
+        pendientes = list(self.etapas)
+        en_curso = {}
+
+        with ThreadPoolExecutor(max_workers=n_hilos) as ejecutor:
+            while len(pendientes) > 0 or len(en_curso) > 0:
+
+                #Marcar como omitidas las etapas que dependen de una etapa fallida.
+                for nombre in list(pendientes):
+                    if any(resultados.get(dep) in ("fallida", "omitida") for dep in deps[nombre]):
+                        print("Omitiendo la etapa", nombre)
+                        resultados[nombre] = "omitida"
+                        pendientes.remove(nombre)
+
+                #Lanzar las etapas cuyas dependencias ya terminaron. La obsolescencia se revisa recién aquí, cuando las entradas ya fueron recalculadas.
+                for nombre in list(pendientes):
+                    if all(dep in resultados for dep in deps[nombre]):
+                        pendientes.remove(nombre)
+                        if not forzar and not self.obsoleta(nombre):
+                            resultados[nombre] = "al_dia"
+                            continue
+                        print("Ejecutando la etapa", nombre)
+                        en_curso[ejecutor.submit(self._ejecutar_etapa, nombre)] = nombre
+
+                if len(en_curso) == 0:
+                    if len(pendientes) > 0 and not any(all(dep in resultados for dep in deps[n]) for n in pendientes):
+                        raise ValueError("Hay dependencias circulares entre las etapas: {}".format(", ".join(pendientes)))
+                    continue
+
+                #Esperar a que termine alguna etapa.
+                terminados, _ = wait(en_curso, return_when=FIRST_COMPLETED)
+                for futuro in terminados:
+                    nombre = en_curso.pop(futuro)
+                    try:
+                        futuro.result()
+                        resultados[nombre] = "ejecutada"
+                    except Exception as e:
+                        print("La etapa", nombre, "falló:", repr(e))
+                        resultados[nombre] = "fallida"
+
+        return resultados
+
+    def _ejecutar_etapa(self, nombre):
+        etapa = self.etapas[nombre]
+
+        #Ejecutar la función. Si acepta recalcular, forzar el cálculo, pues ya sabemos que la etapa está obsoleta.
+        parametros = dict(etapa["parametros"])
+        if "recalcular" in inspect.signature(etapa["funcion"]).parameters:
+            parametros["recalcular"] = True
+        etapa["funcion"](**parametros)
+
+        #Las funciones que solo imprimen un mensaje cuando fallan no escriben sus salidas. En ese caso la etapa falló y no se registra.
+        faltantes = [fname for fname in etapa["salidas"] if not os.path.exists(fname)]
+        if len(faltantes) > 0:
+            raise RuntimeError("La etapa {} no escribió {}.".format(nombre, ", ".join(faltantes)))
+
+        #Registrar los hashes y guardar el estado. Esto marca el punto desde el cual se puede retomar el pipeline.
+        registro = {"parametros": self._hash_parametros(etapa),
+                    "entradas": {fname: self._hash_archivo(fname) for fname in etapa["entradas"]},
+                    "salidas": {fname: self._hash_archivo(fname) for fname in etapa["salidas"]}}
+        with self._candado:
+            self.estado["etapas"][nombre] = registro
+            self._guardar_estado()
+
+    def _guardar_estado(self):
+        #Escribir primero a un archivo temporal para que una interrupción no deje el estado corrupto.
+        temporal = self.archivo_estado + ".tmp"
+        with open(temporal, "w") as f:
+            json.dump(self.estado, f, indent=1, sort_keys=True)
+        os.replace(temporal, self.archivo_estado)
+
+    def _hash_parametros(self, etapa):
+        funcion = etapa["funcion"]
+        texto = json.dumps([funcion.__module__, funcion.__qualname__, etapa["parametros"]], sort_keys=True, default=_serializar)
+        return hashlib.sha1(texto.encode()).hexdigest()
+
+    def _hash_archivo(self, fname):
+        #El hash del contenido se guarda junto al tamaño y la fecha de modificación del archivo, y solo se recalcula si estos cambian.
+        try:
+            info = os.stat(fname)
+        except FileNotFoundError:
+            return None
+        clave = [info.st_size, info.st_mtime_ns]
+        with self._candado:
+            guardado = self.estado["hashes"].get(fname)
+        if guardado is not None and guardado[:2] == clave:
+            return guardado[2]
+
+        sha = hashlib.sha1()
+        with open(fname, "rb") as f:
+            for bloque in iter(lambda: f.read(2**20), b""):
+                sha.update(bloque)
+        valor = sha.hexdigest()
+        with self._candado:
+            self.estado["hashes"][fname] = clave + [valor]
+        return valor
+
+
+def _serializar(objeto):
+    if isinstance(objeto, np.ndarray):
+        return objeto.tolist()
+    return repr(objeto)
+
+
+def pipeline_noche(bias, darks, flats, ciencia,
+                   directorio_imagenes_originales="raw", directorio_imagenes_reducidas="red", directorio_fotometria="fot",
+                   r_ap=7.0, bkg_type='global', zonas_a_filtrar=None, caja_busqueda=21,
+                   metodo_alineamiento="astroalign", solo_transformacion=False,
+                   cubo=None, archivo_estado=None):
+    """
+    Arma el pipeline completo de una noche: master bias, master dark, master flat, reducción y alineamiento de las imagenes de ciencia, búsqueda de fuentes en la primera imagen alineada, recentrado de las fuentes y fotometría en cada imagen. El recentrado y la fotometría son una etapa por imagen, así que se pueden ejecutar en paralelo y solo se recalculan las imagenes que cambiaron.
+
+    Parámetros
+    ----------
+
+    bias, darks, flats, ciencia: listas
+        Imagenes originales de cada tipo.
+
+    directorio_imagenes_originales: str, opcional
+        Directorio donde están las imágenes tomadas por el telescopio.
+
+    directorio_imagenes_reducidas: str, opcional
+        Directorio donde se guardan las imagenes reducidas.
+
+    directorio_fotometria: str, opcional
+        Directorio donde se guardan los archivos de la fotometría.
+
+    r_ap: float, opcional
+        Radio de la apertura en segundos de arco.
+
+    bkg_type: str, opcional
+        Tipo de estimación del cielo. Ver medir_fotometria.
+
+    zonas_a_filtrar: lista, opcional
+        Zonas de la imagen de referencia donde se eliminan las fuentes. Ver filtrar_posiciones.
+
+    caja_busqueda: int, opcional
+        Tamaño de la caja de búsqueda usada al recentrar las fuentes.
+
+    metodo_alineamiento: str, opcional
+        Método usado para alinear las imagenes. Ver alinear_imagenes_ciencia.
+
+    solo_transformacion: bool, opcional
+        Si es True, el alineamiento solo guarda la transformación de cada imagen, y la búsqueda, el recentrado y la fotometría se hacen en las imagenes reducidas sin alinear.
+
+    cubo: str, opcional
+        Si se indica, las imagenes reducidas se guardan en un cubo con este nombre, y las alineadas en un cubo con el prefijo "ali_", en vez de un archivo por imagen. Ver AccesoImagenes.
+
+    archivo_estado: str, opcional
+        Archivo donde se guarda el estado del pipeline. Por defecto es pipeline_estado.json en el directorio de imagenes reducidas.
+
+    """
+
+    raw = directorio_imagenes_originales
+    red = directorio_imagenes_reducidas
+    fot = directorio_fotometria
+    if archivo_estado is None:
+        os.makedirs(red, exist_ok=True)
+        archivo_estado = "{}/pipeline_estado.json".format(red)
+
+    pipeline = Pipeline(archivo_estado)
+    directorios = dict(directorio_imagenes_originales=raw, directorio_imagenes_reducidas=red)
+
+    #Cuadros de calibración.
+    pipeline.agregar("masterbias", crear_masterbias,
+                     dict(imagenes=bias, nombre_bias="MasterBias.fits", **directorios),
+                     entradas=["{}/{}".format(raw, im) for im in bias],
+                     salidas=["{}/MasterBias.fits".format(red)])
+    pipeline.agregar("masterdark", crear_masterdark,
+                     dict(imagenes=darks, nombre_dark="MasterDark.fits", nombre_bias="MasterBias.fits", **directorios),
+                     entradas=["{}/{}".format(raw, im) for im in darks] + ["{}/MasterBias.fits".format(red)],
+                     salidas=["{}/MasterDark.fits".format(red)])
+    pipeline.agregar("masterflat", crear_masterflat,
+                     dict(imagenes=flats, nombre_flat="MasterFlat.fits", nombre_dark="MasterDark.fits", nombre_bias="MasterBias.fits", **directorios),
+                     entradas=["{}/{}".format(raw, im) for im in flats] + ["{}/MasterBias.fits".format(red), "{}/MasterDark.fits".format(red)],
+                     salidas=["{}/MasterFlat.fits".format(red)])
+
+    #Reducción y alineamiento de las imagenes de ciencia.
+    masters = ["{}/{}".format(red, nombre) for nombre in ("MasterBias.fits", "MasterDark.fits", "MasterFlat.fits")]
+    reducidas = ["ciencia_{}".format(im) for im in ciencia]
+    alineadas = ["ali_{}".format(im) for im in reducidas]
+    tabla_transformaciones = "{}/transformaciones.ecsv".format(red)
+
+    #Archivos donde queda guardada cada imagen: su propio archivo, o el cubo completo si se usa un cubo.
+    cubo_alineado = None if cubo is None else "ali_{}".format(cubo)
+    def archivos(imagenes, nombre_cubo):
+        if nombre_cubo is None:
+            return ["{}/{}".format(red, im) for im in imagenes]
+        return ["{}/{}.npy".format(red, nombre_cubo), "{}/{}.ecsv".format(red, nombre_cubo)]
+
+    pipeline.agregar("reduccion", _reducir_ciencia,
+                     dict(imagenes=ciencia, prefijo="ciencia", cubo=cubo, **directorios),
+                     entradas=["{}/{}".format(raw, im) for im in ciencia] + masters,
+                     salidas=archivos(reducidas, cubo))
+    pipeline.agregar("alineamiento", alinear_imagenes_ciencia,
+                     dict(imagenes=reducidas, prefijo="ali", directorio_imagenes_reducidas=red, metodo=metodo_alineamiento,
+                          solo_transformacion=solo_transformacion, archivo_transformaciones="transformaciones.ecsv", cubo=cubo),
+                     entradas=archivos(reducidas, cubo),
+                     salidas=[tabla_transformaciones] if solo_transformacion else archivos(alineadas, cubo_alineado))
+
+    #Si solo se guardan las transformaciones, el resto del pipeline trabaja sobre las imagenes reducidas sin alinear.
+    if solo_transformacion:
+        alineadas = reducidas
+        cubo_alineado = cubo
+        transformaciones = tabla_transformaciones
+    else:
+        transformaciones = None
+
+    #Búsqueda de fuentes en la imagen de referencia.
+    referencia = alineadas[0]
+    pos_referencia = "{}/{}".format(fot, re.sub(".fits?", ".pos.dat", referencia))
+    pipeline.agregar("busqueda", _buscar_fuentes,
+                     dict(imagen=referencia, zonas_a_filtrar=zonas_a_filtrar,
+                          directorio_imagenes_reducidas=red, directorio_fotometria=fot, cubo=cubo_alineado),
+                     entradas=archivos([referencia], cubo_alineado),
+                     salidas=[pos_referencia])
+
+    #Recentrado y fotometría, una etapa por imagen.
+    for imagen in alineadas:
+        pos_fname = "{}/{}".format(fot, re.sub(".fits?", ".pos.dat", imagen))
+        if imagen != referencia:
+            pipeline.agregar("recentrar_{}".format(imagen), _recentrar_fuentes,
+                             dict(imagen=imagen, imagen_referencia=referencia, caja_busqueda=caja_busqueda,
+                                  directorio_imagenes_reducidas=red, directorio_fotometria=fot,
+                                  transformaciones=transformaciones, cubo=cubo_alineado),
+                             entradas=archivos([imagen], cubo_alineado) + [pos_referencia] + ([] if transformaciones is None else [transformaciones]),
+                             salidas=[pos_fname])
+        salidas = ["{}/{}".format(fot, re.sub(".fits?", ".phot.dat", imagen))]
+        if bkg_type == 'global':
+            salidas.append("{}/{}".format(red, re.sub(".fits?", ".bkgmesh.fits", imagen)))
+        pipeline.agregar("fotometria_{}".format(imagen), medir_fotometria,
+                         dict(imagen=imagen, r_ap=r_ap, bkg_type=bkg_type,
+                              directorio_imagenes_reducidas=red, directorio_fotometria=fot, cubo=cubo_alineado),
+                         entradas=archivos([imagen], cubo_alineado) + [pos_fname],
+                         salidas=salidas)
+
+    return pipeline
+
+
+def _reducir_ciencia(imagenes, prefijo, cubo, directorio_imagenes_originales, directorio_imagenes_reducidas, recalcular=True):
+    fallidas = reducir_imagenes_ciencia(imagenes, prefijo=prefijo, cubo=cubo, recalcular=recalcular,
+                                        directorio_imagenes_originales=directorio_imagenes_originales,
+                                        directorio_imagenes_reducidas=directorio_imagenes_reducidas)
+    if len(fallidas) > 0:
+        raise RuntimeError("No se pudieron reducir {} imagenes: {}".format(len(fallidas), ", ".join(f[0] for f in fallidas)))
+
+def _buscar_fuentes(imagen, zonas_a_filtrar, directorio_imagenes_reducidas, directorio_fotometria, cubo=None, recalcular=True):
+    dao_busqueda(imagen, directorio_imagenes_reducidas=directorio_imagenes_reducidas, directorio_fotometria=directorio_fotometria, recalcular=recalcular, cubo=cubo)
+    if zonas_a_filtrar is not None:
+        filtrar_posiciones(imagen, zonas_a_filtrar, directorio_fotometria=directorio_fotometria)
+
+def _recentrar_fuentes(imagen, imagen_referencia, caja_busqueda, directorio_imagenes_reducidas, directorio_fotometria, transformaciones=None, cubo=None, recalcular=True):
+    pos_fname = re.sub(".fits?", ".pos.dat", imagen_referencia)
+    posiciones_referencia = np.loadtxt("{}/{}".format(directorio_fotometria, pos_fname))
+    dao_recentrar(imagen, posiciones_referencia, directorio_imagenes_reducidas=directorio_imagenes_reducidas,
+                  directorio_fotometria=directorio_fotometria, caja_busqueda=caja_busqueda, recalcular=recalcular,
+                  transformaciones=transformaciones, cubo=cubo)
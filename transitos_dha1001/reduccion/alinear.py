@@ -1,13 +1,25 @@
 import numpy as np
 import astroalign as aa
 from astropy.io import fits
+from astropy.stats import sigma_clipped_stats
+from astropy.table import Table
+from photutils import DAOStarFinder
+from scipy import fft
+from skimage.transform import AffineTransform
 import os
 import re
 
+from .cubo import abrir_imagenes, crear_cubo, guardar_encabezados
+
 def alinear_imagenes_ciencia(imagenes,
                     prefijo="ali",
                     directorio_imagenes_reducidas="red",
-                    recalcular=True):
+                    recalcular=True,
+                    metodo="astroalign",
+                    tolerancia=0.5,
+                    solo_transformacion=False,
+                    archivo_transformaciones="transformaciones.ecsv",
+                    cubo=None):
 
     """
     Rutina para alinear las imagenes de ciencia. La primera imagen de la lista siempre se va a usar como referencia para alinear el resto.
@@ -27,30 +39,325 @@ def alinear_imagenes_ciencia(imagenes,
     recalcular: bool, opcional
         Si es True, se recalculará el alineamiento aún cuando una versión de la imagen alineada ya exista en el directorio de imagenes reducidas.
 
+    metodo: string, opcional
+        "astroalign" para alinear cada imagen con astroalign, o "fft" para estimar un desplazamiento con correlación de fase contra la imagen de referencia (ver AlineadorFFT). El método "fft" usa astroalign solo en las imagenes que además del desplazamiento tienen rotación o cambio de escala.
+
+    tolerancia: float, opcional
+        Diferencia máxima, en pixeles, entre los desplazamientos medidos en cada cuadrante de la imagen para considerar que la imagen solo está desplazada. Solo se usa si metodo es "fft".
+
+    solo_transformacion: bool, opcional
+        Si es True, no se escriben imagenes alineadas. Solo se calcula la transformación afín de cada imagen respecto a la referencia y se guardan todas en una tabla en archivo_transformaciones. Las posiciones de referencia se pueden llevar luego a cada imagen original con transformar_posiciones (dao_recentrar y medir_fotometria lo hacen si se les entregan las transformaciones).
+
+    archivo_transformaciones: string, opcional
+        Nombre de la tabla con las transformaciones, dentro del directorio de imagenes reducidas. Solo se usa si solo_transformacion es True.
+
+    cubo: string, opcional
+        Nombre del cubo (sin extensión) donde están las imagenes reducidas, si se guardaron en un cubo. En ese caso las imagenes alineadas se guardan también en un cubo, llamado como el de entrada con el prefijo antepuesto.
+
     """
 
-    #La primera imagen será utilizada como la referencia, y el resto se va a linear para calzar con esta.
-    referencia = fits.open("{}/{}".format(directorio_imagenes_reducidas, imagenes[0]))
+    #Las imagenes se leen de archivos separados o del cubo.
+    acceso = abrir_imagenes(directorio_imagenes_reducidas, cubo)
+
+    #La primera imagen será utilizada como la referencia, y el resto se va a linear para calzar con esta. Para evitar un error de compatibilidad de pyfits con las nuevas versiones de astroalign, necesitamos asegurarnos que el arreglo de la imagen sea de tipo float64.
+    referencia = np.float64(acceso.datos(imagenes[0]))
+
+    #Si se usa la correlación de fase, preparar el espectro de la referencia una sola vez.
+    if metodo == "fft":
+        alineador = AlineadorFFT(referencia, tolerancia=tolerancia)
+
+    #Si solo se piden las transformaciones, calcularlas y guardarlas en la tabla sin escribir imagenes.
+    if solo_transformacion:
+        fname_tabla = "{}/{}".format(directorio_imagenes_reducidas, archivo_transformaciones)
+        transformaciones = {}
+        if not recalcular and os.path.exists(fname_tabla):
+            transformaciones = leer_transformaciones(fname_tabla)
+
+        #Con astroalign, buscar las fuentes de la referencia una sola vez y usarlas como destino para todas las imagenes, como en AlineadorFFT.transformacion.
+        if metodo != "fft":
+            puntos_ref = _puntos_control(referencia, 50)
+            destino = puntos_ref if len(puntos_ref) >= 3 else referencia
+
+        for imagen in imagenes:
+            if imagen in transformaciones:
+                continue
+            datos = np.float64(acceso.datos(imagen))
+            if metodo == "fft":
+                transformaciones[imagen] = alineador.transformacion(datos)
+            else:
+                transf, (fuentes, destinos) = aa.find_transform(datos, destino)
+                transformaciones[imagen] = transf.params
 
-    #Para evitar un error de compatibilidad de pyfits con las nuevas versiones de astroalign, necesitamos asegurarnos que el arreglo de la imagen sea de tipo float64.
-    referencia[0].data = np.float64(referencia[0].data)
+        guardar_transformaciones(fname_tabla, transformaciones)
+        return transformaciones
+
+    #Con un cubo, las imagenes alineadas van a un cubo nuevo del mismo tamaño. Se escribe completo salvo que ya exista con todas las imagenes.
+    if cubo is not None:
+        cubo_salida = prefijo + "_" + cubo
+        nombres = [prefijo + "_" + imagen for imagen in imagenes]
+        if not recalcular and os.path.exists("{}/{}.ecsv".format(directorio_imagenes_reducidas, cubo_salida)):
+            if set(nombres) <= set(abrir_imagenes(directorio_imagenes_reducidas, cubo_salida).imagenes):
+                return
+        salida = crear_cubo(cubo_salida, len(imagenes), referencia.shape[0], referencia.shape[1], acceso.dtype, directorio_imagenes_reducidas)
+        encabezados = []
 
     #Pasar por cada imagen alineandola a la de referencia. Si no se pide recalcular, y la imagen ya existe, saltarse el alineamiento.
-    for imagen in imagenes:
+    for k, imagen in enumerate(imagenes):
 
         #Ver si la imagen alineada ya existe.
         imagen_salida = prefijo + "_" + imagen
-        if not recalcular and os.path.exists("{}/{}".format(directorio_imagenes_reducidas, imagen_salida)):
+        if cubo is None and not recalcular and os.path.exists("{}/{}".format(directorio_imagenes_reducidas, imagen_salida)):
             continue
 
         #Alinear la imagen.
-        im = fits.open("{}/{}".format(directorio_imagenes_reducidas, imagen))
-        im[0].data = np.float64(im[0].data)
-        im_alineada, footprint = aa.register(im[0].data, referencia[0].data)
+        datos = np.float64(acceso.datos(imagen))
+        if metodo == "fft":
+            im_alineada = alineador.alinear(datos)
+        else:
+            im_alineada, footprint = aa.register(datos, referencia)
 
         #Guardar la imagen alineada.
-        im[0].data = im_alineada
-        im.writeto("{}/{}".format(directorio_imagenes_reducidas, imagen_salida), overwrite=True)
-        im.close()
+        if cubo is None:
+            fits.writeto("{}/{}".format(directorio_imagenes_reducidas, imagen_salida), im_alineada, acceso.encabezado(imagen), overwrite=True)
+        else:
+            salida[k] = im_alineada
+            encabezados.append(acceso.encabezado(imagen))
+
+    if cubo is not None:
+        salida.flush()
+        guardar_encabezados(cubo_salida, nombres, list(range(len(imagenes))), encabezados, directorio_imagenes_reducidas)
 
     return
+
+
+def guardar_transformaciones(fname, transformaciones):
+    """
+    Guarda las transformaciones afines de varias imagenes en una tabla, con una fila por imagen y los seis coeficientes de la matriz.
+
+    Parametros
+    ----------
+
+    fname: str
+        Archivo donde se guardará la tabla.
+
+    transformaciones: diccionario
+        Matriz (3x3) de la transformación que lleva las coordenadas de cada imagen a las de la referencia, con el nombre de la imagen como llave.
+
+    """
+
+    imagenes = list(transformaciones)
+    matrices = np.array([transformaciones[imagen] for imagen in imagenes]).reshape(len(imagenes), 3, 3)
+    tabla = Table()
+    tabla['imagen'] = imagenes
+    for i in range(2):
+        for j in range(3):
+            tabla['a{}{}'.format(i, j)] = matrices[:, i, j]
+    tabla.write(fname, format='ascii.ecsv', overwrite=True)
+
+def leer_transformaciones(fname):
+    """
+    Lee la tabla escrita por guardar_transformaciones y devuelve un diccionario con la matriz (3x3) de cada imagen.
+
+    Parametros
+    ----------
+
+    fname: str
+        Archivo con la tabla de transformaciones.
+
+    """
+
+    tabla = Table.read(fname, format='ascii.ecsv')
+    transformaciones = {}
+    for fila in tabla:
+        matriz = np.eye(3)
+        for i in range(2):
+            for j in range(3):
+                matriz[i, j] = fila['a{}{}'.format(i, j)]
+        transformaciones[str(fila['imagen'])] = matriz
+    return transformaciones
+
+def transformar_posiciones(posiciones_referencia, matriz):
+    """
+    Lleva posiciones medidas en la imagen de referencia a una imagen sin alinear, usando la matriz de la transformación que lleva las coordenadas de esa imagen a las de la referencia.
+
+    Parametros
+    ----------
+
+    posiciones_referencia: numpy array
+        Arreglo de N x 2 con las posiciones (x, y) en la imagen de referencia.
+
+    matriz: numpy array
+        Matriz (3x3) de la transformación de la imagen, como las que devuelve alinear_imagenes_ciencia con solo_transformacion=True.
+
+    """
+
+    inversa = np.linalg.inv(matriz)
+    posiciones_referencia = np.asarray(posiciones_referencia, dtype=np.float64)
+    return posiciones_referencia @ inversa[:2, :2].T + inversa[:2, 2]
+
+
+class AlineadorFFT:
+    """
+    Objeto para alinear imagenes que solo están desplazadas respecto a una imagen de referencia, como las que toma una montura ecuatorial que deriva unos pocos pixeles durante la noche. El desplazamiento se mide con correlación de fase usando la transformada de Fourier de la referencia, que se calcula una sola vez, y la imagen se desplaza con interpolación bilineal.
+
+    Para detectar rotaciones o cambios de escala, el desplazamiento se mide también en cada cuadrante de una copia de la imagen agrupada en bloques de agrupar x agrupar pixeles, lo que cuesta una fracción de la correlación de la imagen completa. Si los cuadrantes no coinciden, la imagen se alinea con astroalign, usando las fuentes de la referencia que también se buscan una sola vez.
+
+    Parámetros
+    ----------
+
+    referencia: numpy array
+        Imagen de referencia.
+
+    tolerancia: float, opcional
+        Diferencia máxima, en pixeles, entre el desplazamiento de cada cuadrante y el de la imagen completa para considerar que la imagen solo está desplazada.
+
+    max_control_points: int, opcional
+        Número máximo de fuentes usadas por astroalign.
+
+    agrupar: int, opcional
+        Tamaño de los bloques de pixeles con que se agrupa la imagen para comparar los cuadrantes.
+
+    """
+
+    def __init__(self, referencia, tolerancia=0.5, max_control_points=50, agrupar=2):
+        self.referencia = np.float64(referencia)
+        self.tolerancia = tolerancia
+        self.max_control_points = max_control_points
+        self.agrupar = agrupar
+
+        #Espectros de la referencia completa y de los cuatro cuadrantes de la referencia agrupada.
+        ny, nx = _agrupar(self.referencia, agrupar).shape
+        self._cuadrantes = [(slice(0, ny//2), slice(0, nx//2)), (slice(0, ny//2), slice(nx//2, None)),
+                            (slice(ny//2, None), slice(0, nx//2)), (slice(ny//2, None), slice(nx//2, None))]
+        self._espectro_ref = _espectro_conjugado(self.referencia)
+        agrupada = _agrupar(self.referencia, agrupar)
+        self._espectros_cuadrantes = [_espectro_conjugado(agrupada[c]) for c in self._cuadrantes]
+
+        #Las fuentes de la referencia para astroalign se buscan solo si se necesitan.
+        self._puntos_ref = None
+
+    def desplazamiento(self, imagen):
+        """
+        Devuelve el desplazamiento (dx, dy) de la imagen respecto a la referencia, de forma que una fuente en (x, y) en la referencia está en (x+dx, y+dy) en la imagen, y un booleano que es True si todos los cuadrantes tienen el mismo desplazamiento.
+
+        """
+
+        dy, dx = _correlacion_fase(imagen, self._espectro_ref)
+
+        #Los cuadrantes se comparan con su promedio y no con el desplazamiento de la imagen completa, así el error que introduce agrupar los pixeles, que es el mismo en todos los cuadrantes, se cancela.
+        agrupada = _agrupar(imagen, self.agrupar)
+        desp_cuadrantes = self.agrupar * np.array([_correlacion_fase(agrupada[c], espectro) for c, espectro in zip(self._cuadrantes, self._espectros_cuadrantes)])
+        solo_desplazamiento = bool(np.all(np.abs(desp_cuadrantes - desp_cuadrantes.mean(axis=0)) <= self.tolerancia))
+        return dx, dy, solo_desplazamiento
+
+    def transformacion(self, imagen):
+        """
+        Devuelve la matriz de la transformación afín (3x3) que lleva las coordenadas de la imagen a las de la referencia. Si la imagen solo está desplazada es una traslación medida con correlación de fase; si no, se calcula con astroalign.
+
+        """
+
+        dx, dy, solo_desplazamiento = self.desplazamiento(imagen)
+        if solo_desplazamiento:
+            return np.array([[1., 0., -dx], [0., 1., -dy], [0., 0., 1.]])
+
+        if self._puntos_ref is None:
+            self._puntos_ref = _puntos_control(self.referencia, self.max_control_points)
+
+        #Si la referencia tiene muy pocas fuentes para usarlas como puntos de control, astroalign las busca en la imagen de referencia completa.
+        destino = self._puntos_ref if len(self._puntos_ref) >= 3 else self.referencia
+        transf, (fuentes, destinos) = aa.find_transform(np.float64(imagen), destino, max_control_points=self.max_control_points)
+        return transf.params
+
+    def alinear(self, imagen):
+        """
+        Devuelve la imagen alineada con la referencia. Los pixeles que quedan fuera de la imagen original toman el valor de la mediana de la imagen, igual que en astroalign.
+
+        """
+
+        imagen = np.float64(imagen)
+        matriz = self.transformacion(imagen)
+
+        #Si es solo una traslación, desplazar la imagen con interpolación bilineal.
+        if np.allclose(matriz[:2, :2], np.eye(2)):
+            return _desplazar(imagen, matriz[0, 2], matriz[1, 2], np.median(imagen))
+
+        transf = AffineTransform(matrix=matriz)
+        im_alineada, footprint = aa.apply_transform(transf, imagen, self.referencia)
+        return im_alineada
+
+
+def _puntos_control(imagen, n_max):
+
+    #Fuentes más brillantes de la imagen, buscadas con DAOStarFinder como en dao_busqueda, ordenadas de mayor a menor flujo como las ordena astroalign.
+    mean, median, std = sigma_clipped_stats(imagen, sigma=3.0)
+    fuentes = DAOStarFinder(fwhm=3.0, threshold=5.*std)(imagen - median)
+    if fuentes is None:
+        return np.zeros((0, 2))
+    orden = np.argsort(-np.asarray(fuentes['flux']))[:n_max]
+    return np.column_stack([np.asarray(fuentes['xcentroid'])[orden], np.asarray(fuentes['ycentroid'])[orden]])
+
+def _desplazar(imagen, dx, dy, relleno):
+
+    #Igual que ndimage.shift con order=1 y mode='constant', pero con cortes de la imagen en vez de interpolar pixel por pixel: el pixel (y, x) de la salida toma el valor de la imagen en (y - dy, x - dx), interpolando entre los cuatro pixeles vecinos, y los que caen fuera de la imagen toman el valor de relleno.
+    salida = np.full(imagen.shape, relleno, dtype=np.float64)
+    limites = []
+    for d, n in [(dy, imagen.shape[0]), (dx, imagen.shape[1])]:
+        i = int(np.floor(-d))
+        f = -d - i
+        limites.append((i, f, max(0, -i), min(n, n - i - (f > 0))))
+    (iy, fy, y0, y1), (ix, fx, x0, x1) = limites
+    if y1 <= y0 or x1 <= x0:
+        return salida
+
+    filas = [slice(y0+iy, y1+iy), slice(y0+iy+1, y1+iy+1)]
+    columnas = [slice(x0+ix, x1+ix), slice(x0+ix+1, x1+ix+1)]
+    region = salida[y0:y1, x0:x1]
+    np.multiply(imagen[filas[0], columnas[0]], (1-fx)*(1-fy), out=region)
+    if fx > 0:
+        region += fx*(1-fy) * imagen[filas[0], columnas[1]]
+    if fy > 0:
+        region += (1-fx)*fy * imagen[filas[1], columnas[0]]
+    if fx > 0 and fy > 0:
+        region += fx*fy * imagen[filas[1], columnas[1]]
+    return salida
+
+def _agrupar(imagen, n):
+
+    #Suma de los pixeles en bloques de n x n. Las filas y columnas que sobran en el borde se descartan.
+    ny, nx = imagen.shape[0]//n * n, imagen.shape[1]//n * n
+    agrupada = np.zeros((ny//n, nx//n), dtype=np.float32)
+    for i in range(n):
+        for j in range(n):
+            agrupada += imagen[i:ny:n, j:nx:n]
+    return agrupada
+
+def _espectro_conjugado(imagen):
+    return np.conj(fft.rfft2(np.float32(imagen)))
+
+def _correlacion_fase(imagen, espectro_ref_conj):
+
+    #Espectro de potencia cruzado normalizado. Su transformada inversa tiene un máximo en el desplazamiento entre las dos imagenes. Para la posición del máximo basta precisión simple. El término de frecuencia cero se anula, lo que equivale a restar el nivel de fondo de las imagenes sin tener que calcularlo.
+    cruzado = fft.rfft2(np.float32(imagen)) * espectro_ref_conj
+    cruzado /= np.abs(cruzado) + 1e-12
+    cruzado[0, 0] = 0.
+    correlacion = fft.irfft2(cruzado, s=imagen.shape)
+
+    #Posición del máximo, refinada con una parábola en cada eje.
+    ny, nx = correlacion.shape
+    iy, ix = np.unravel_index(np.argmax(correlacion), correlacion.shape)
+    desp = []
+    for i, n, eje in [(iy, ny, 0), (ix, nx, 1)]:
+        if eje == 0:
+            c_menos, c_0, c_mas = correlacion[(i-1) % n, ix], correlacion[i, ix], correlacion[(i+1) % n, ix]
+        else:
+            c_menos, c_0, c_mas = correlacion[iy, (i-1) % n], correlacion[iy, i], correlacion[iy, (i+1) % n]
+        denominador = c_menos - 2*c_0 + c_mas
+        fraccion = 0.5 * (c_menos - c_mas) / denominador if denominador != 0 else 0.
+        d = i + fraccion
+
+        #Los desplazamientos de más de media imagen son en realidad negativos.
+        if d > n/2:
+            d -= n
+        desp.append(d)
+
+    return desp[0], desp[1]
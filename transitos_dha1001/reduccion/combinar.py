@@ -0,0 +1,255 @@
+import numpy as np
+from astropy.io import fits
+import os
+
+#Métodos de reyección disponibles, y cuántos arreglos del tamaño de la franja necesita cada uno además de la franja misma.
+rechazos = {"mediana": 0, "minmax": 0, "percentil": 0, "sigma": 2, "mad": 1}
+
+def combinar_imagenes(fnames, fname_salida=None, nucleo=None, rechazo="mediana", normalizar=False,
+                      sigma=3.0, maxiters=5, n_bajo=1, n_alto=1, percentiles=(10., 90.), memoria_mb=512,
+                      encabezado=None):
+    """
+    Rutina para combinar imagenes tomando la mediana en cada pixel sin cargar todas las imagenes en memoria. Las imagenes se leen por franjas de filas (usando memory mapping), se combina cada franja, y el resultado se va escribiendo en el archivo de salida a medida que se calcula.
+
+    Antes de tomar la mediana se pueden rechazar valores en cada pixel. Para esto los valores de cada pixel se ordenan una sola vez, con lo que los valores que sobreviven a cualquiera de las reyecciones forman siempre un intervalo contiguo del arreglo ordenado, y todas las operaciones se hacen sobre la franja completa sin ciclos por pixel.
+
+    Parámetros
+    ----------
+
+    fnames: lista
+        Lista con las rutas de las imagenes que vamos a combinar.
+
+    fname_salida: string, opcional
+        Ruta de la imagen de salida con el cuadro combinado. Si es None, no se escribe ningún archivo y se devuelve el arreglo combinado.
+
+    nucleo: NucleoCalibracion, opcional
+        Núcleo de calibración (por ejemplo con el master bias) que se le aplica a cada franja antes de combinarla. Si se indica, las imagenes se convierten a la precisión del núcleo.
+
+    rechazo: string, opcional
+        Reyección que se aplica en cada pixel antes de tomar la mediana. Puede ser "mediana" (sin reyección), "sigma" (reyección iterativa de sigma veces la desviación estándar en torno a la mediana, igual que sigma_clipped_stats), "mad" (igual que "sigma" pero usando la desviación absoluta mediana), "minmax" (se eliminan los n_bajo valores más bajos y los n_alto más altos) o "percentil" (se eliminan los valores fuera de los percentiles indicados).
+
+    normalizar: boolean, opcional
+        Si es True, cada imagen se divide por su mediana (después de aplicarle el nucleo) antes de combinarlas.
+
+    sigma: float, opcional
+        Número de desviaciones estándar usadas en las reyecciones "sigma" y "mad".
+
+    maxiters: int, opcional
+        Número máximo de iteraciones de las reyecciones "sigma" y "mad".
+
+    n_bajo, n_alto: int, opcional
+        Número de valores más bajos y más altos que se eliminan en la reyección "minmax".
+
+    percentiles: tupla, opcional
+        Percentiles inferior y superior usados en la reyección "percentil".
+
+    memoria_mb: float, opcional
+        Memoria máxima, en MB, que se usará para guardar las franjas de todas las imagenes. Define el número de filas de cada franja.
+
+    encabezado: diccionario, opcional
+        Palabras clave que se agregarán al encabezado de la imagen de salida.
+
+    """
+
+    if rechazo not in rechazos:
+        raise ValueError("El rechazo debe ser uno de: {}".format(", ".join(rechazos)))
+
+    #Abrir todas las imagenes sin leer los datos. Con memmap=True solo se leen las filas que se piden. Astropy no permite usar memory mapping en imagenes con BZERO/BSCALE, así que leemos los datos sin escalar y aplicamos la escala nosotros.
+    hdus = [fits.open(fname, memmap=True, do_not_scale_image_data=True) for fname in fnames]
+
+    try:
+        n_imagenes = len(hdus)
+        ny, nx = hdus[0][0].shape
+
+        #El tipo de dato del resultado tiene que ser el mismo que daría np.median sobre la lista de imagenes completa: si los datos son enteros el resultado es float64, si son float se mantiene su precisión. Si hay que calibrar las imagenes se usa la precisión del núcleo, y si hay que normalizar se pasan a float64.
+        tipo_datos = hdus[0][0].section[0:1].dtype
+        if nucleo is not None:
+            tipo = nucleo.tipo
+        elif normalizar or tipo_datos.kind != 'f' or _escalada(hdus[0][0]):
+            tipo = np.dtype(np.float64)
+        else:
+            tipo = tipo_datos.newbyteorder('=')
+
+        #Número de filas por franja según la memoria disponible. Cada rechazo necesita distinto número de arreglos auxiliares del tamaño de la franja.
+        bytes_por_fila = (1 + rechazos[rechazo]) * (n_imagenes + 1) * nx * 8
+        n_filas = int(max(1, min(ny, memoria_mb * 2**20 // bytes_por_fila)))
+
+        #Arreglos donde vamos a guardar la franja de todas las imagenes y los arreglos auxiliares. Los reutilizamos en cada franja.
+        franjas = np.empty((n_imagenes, n_filas, nx), dtype=tipo)
+        auxiliares = [np.empty((n_imagenes + 1, n_filas, nx)) for k in range(rechazos[rechazo])]
+
+        #Si hay que normalizar, calcular la mediana de cada imagen ya sin bias ni dark. La mediana de una imagen necesita la imagen completa, así que la armamos franja por franja en un solo arreglo que se reutiliza para todas las imagenes.
+        normas = np.ones(n_imagenes)
+        if normalizar:
+            imagen_completa = np.empty((ny, nx), dtype=tipo)
+            for k, h in enumerate(hdus):
+                for fila_ini in range(0, ny, n_filas):
+                    fila_fin = min(fila_ini + n_filas, ny)
+                    _leer_franja(h[0], fila_ini, fila_fin, imagen_completa[fila_ini:fila_fin], nucleo)
+                normas[k] = np.median(imagen_completa, overwrite_input=True)
+            del imagen_completa
+
+        #Preparar la salida. StreamingHDU agrega una extensión si el archivo existe, así que hay que borrarlo primero.
+        if fname_salida is None:
+            master = np.empty((ny, nx), dtype=tipo)
+        else:
+            if os.path.exists(fname_salida):
+                os.remove(fname_salida)
+            salida = fits.StreamingHDU(fname_salida, _encabezado_salida(nx, ny, tipo, encabezado))
+
+        #Pasar por cada franja de filas.
+        for fila_ini in range(0, ny, n_filas):
+            fila_fin = min(fila_ini + n_filas, ny)
+            n = fila_fin - fila_ini
+
+            #Leer la franja de cada imagen, calibrarla y normalizarla.
+            for k, h in enumerate(hdus):
+                _leer_franja(h[0], fila_ini, fila_fin, franjas[k, :n], nucleo)
+                if normalizar:
+                    franjas[k, :n] /= normas[k]
+
+            #Combinar la franja y escribirla en la salida.
+            combinada = _combinar_franja(franjas[:, :n], [a[:, :n] for a in auxiliares], rechazo,
+                                         sigma, maxiters, n_bajo, n_alto, percentiles)
+            if fname_salida is None:
+                master[fila_ini:fila_fin] = combinada
+            else:
+                salida.write(combinada.astype(tipo, copy=False))
+
+        if fname_salida is None:
+            return master
+        salida.close()
+
+    finally:
+        for h in hdus:
+            h.close()
+
+    return
+
+
+def _combinar_franja(franja, auxiliares, rechazo, sigma, maxiters, n_bajo, n_alto, percentiles):
+
+    n = franja.shape[0]
+
+    #Sin reyección es solo la mediana.
+    if rechazo == "mediana":
+        return np.median(franja, axis=0, overwrite_input=True)
+
+    #Ordenar los valores de cada pixel. Desde aquí, los valores que se mantienen en cada pixel son los que están entre los índices ini (incluido) y fin (excluido).
+    franja.sort(axis=0)
+
+    #Las reyecciones por posición eliminan el mismo número de valores en todos los pixeles.
+    if rechazo == "minmax":
+        if n_bajo + n_alto >= n:
+            raise ValueError("No quedan imagenes después de eliminar n_bajo y n_alto valores.")
+        return np.median(franja[n_bajo:n-n_alto], axis=0)
+    if rechazo == "percentil":
+        ini = int(np.ceil(percentiles[0]/100. * (n-1)))
+        fin = int(np.floor(percentiles[1]/100. * (n-1))) + 1
+        return np.median(franja[ini:fin], axis=0)
+
+    #Las reyecciones iterativas mueven los índices en cada pixel.
+    ini = np.zeros(franja.shape[1:], dtype=np.intp)
+    fin = np.full(franja.shape[1:], n, dtype=np.intp)
+
+    #Para la desviación estándar usamos sumas acumuladas de los valores (centrados en la mediana inicial para no perder precisión) y de sus cuadrados, de forma que la suma de cualquier intervalo sale de una resta.
+    if rechazo == "sigma":
+        suma, suma2 = auxiliares
+        centro_ini = mediana_intervalo(franja, ini, fin)
+        suma[0] = 0.
+        suma2[0] = 0.
+        np.subtract(franja, centro_ini, out=suma[1:])
+        np.multiply(suma[1:], suma[1:], out=suma2[1:])
+        np.cumsum(suma[1:], axis=0, out=suma[1:])
+        np.cumsum(suma2[1:], axis=0, out=suma2[1:])
+
+    for k in range(maxiters):
+
+        #Calcular el centro y la dispersión de los valores que quedan en cada pixel.
+        centro = mediana_intervalo(franja, ini, fin)
+        if rechazo == "sigma":
+            n_val = fin - ini
+            s1 = tomar_indices(suma, fin) - tomar_indices(suma, ini)
+            s2 = tomar_indices(suma2, fin) - tomar_indices(suma2, ini)
+            dispersion = np.sqrt(np.maximum(s2/n_val - (s1/n_val)**2, 0.))
+        else:
+            desviaciones = auxiliares[0][:n]
+            np.subtract(franja, centro, out=desviaciones)
+            np.abs(desviaciones, out=desviaciones)
+            fuera = (np.arange(n)[:, None, None] < ini) | (np.arange(n)[:, None, None] >= fin)
+            desviaciones[fuera] = np.inf
+            desviaciones.sort(axis=0)
+            dispersion = 1.482602218505602 * mediana_intervalo(desviaciones, np.zeros_like(ini), fin - ini)
+
+        #Como los valores están ordenados, los que quedan dentro de los límites empiezan en el número de valores bajo el límite inferior y terminan en el número de valores bajo o igual al límite superior.
+        limite_inf = centro - sigma*dispersion
+        limite_sup = centro + sigma*dispersion
+        ini_nuevo = np.maximum(ini, np.sum(franja < limite_inf, axis=0))
+        fin_nuevo = np.minimum(fin, np.sum(franja <= limite_sup, axis=0))
+
+        #Terminar si ya no se rechazan más valores.
+        if np.array_equal(ini_nuevo, ini) and np.array_equal(fin_nuevo, fin):
+            break
+        ini, fin = ini_nuevo, fin_nuevo
+
+    #Igual que sigma_clip de astropy, el rechazo final se hace sobre todos los valores usando los últimos límites calculados, así que un valor rechazado en una iteración anterior puede volver a entrar.
+    ini = np.sum(franja < limite_inf, axis=0)
+    fin = np.sum(franja <= limite_sup, axis=0)
+
+    #Nunca dejar un pixel sin valores. Esto solo puede pasar si la dispersión es 0, y en ese caso no hay nada que rechazar.
+    vacio = fin <= ini
+    ini[vacio] = 0
+    fin[vacio] = n
+
+    return mediana_intervalo(franja, ini, fin)
+
+
+def tomar_indices(arreglo, indices):
+    """
+    Devuelve, en cada posición, el valor del arreglo en el índice indicado a lo largo del primer eje. indices tiene la forma del arreglo sin su primer eje.
+
+    """
+
+    return np.take_along_axis(arreglo, indices[None], axis=0)[0]
+
+def mediana_intervalo(ordenado, ini, fin):
+    """
+    Devuelve la mediana, en cada posición, de los valores entre los índices ini (incluido) y fin (excluido) de un arreglo ordenado a lo largo del primer eje. Así la mediana de los valores que sobreviven a una reyección sale sin volver a ordenar.
+
+    Parámetros
+    ----------
+
+    ordenado: numpy array
+        Arreglo ordenado a lo largo del primer eje.
+
+    ini, fin: numpy array de enteros
+        Límites del intervalo en cada posición, con la forma del arreglo sin su primer eje.
+
+    """
+
+    n_val = fin - ini
+    return 0.5 * (tomar_indices(ordenado, ini + (n_val-1)//2) + tomar_indices(ordenado, ini + n_val//2))
+
+def _escalada(hdu):
+    return hdu.header.get('BSCALE', 1) != 1 or hdu.header.get('BZERO', 0) != 0
+
+def _leer_franja(hdu, fila_ini, fila_fin, salida, nucleo=None):
+    franja = hdu.section[fila_ini:fila_fin]
+    if _escalada(hdu):
+        franja = franja * np.float64(hdu.header.get('BSCALE', 1)) + np.float64(hdu.header.get('BZERO', 0))
+    salida[...] = franja
+    if nucleo is not None:
+        nucleo.aplicar(salida, filas=slice(fila_ini, fila_fin))
+
+def _encabezado_salida(nx, ny, tipo, encabezado=None):
+    header = fits.Header()
+    header['SIMPLE'] = True
+    header['BITPIX'] = -64 if tipo.itemsize == 8 else -32
+    header['NAXIS'] = 2
+    header['NAXIS1'] = nx
+    header['NAXIS2'] = ny
+    header['EXTEND'] = True
+    if encabezado is not None:
+        for clave, valor in encabezado.items():
+            header[clave] = valor
+    return header
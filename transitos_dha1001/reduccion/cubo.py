@@ -0,0 +1,165 @@
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+import os
+
+#Cubos ya abiertos, para no volver a leer la tabla de encabezados en cada llamada.
+_abiertos = {}
+
+def escribir_cubo(imagenes, nombre_cubo="cubo", directorio_imagenes_reducidas="red", tipo=None):
+    """
+    Rutina para juntar imagenes guardadas en archivos separados en un solo cubo. El cubo se guarda como un arreglo .npy de (imagenes x filas x columnas) que se puede leer con memory mapping, junto con una tabla .ecsv con el nombre y el encabezado de cada imagen.
+
+    Parámetros
+    ----------
+
+    imagenes: lista
+        Lista de las imagenes que se guardarán en el cubo, todas del mismo tamaño.
+
+    nombre_cubo: str, opcional
+        Nombre del cubo, sin extensión.
+
+    directorio_imagenes_reducidas: str, opcional
+        Directorio donde están las imagenes y donde se guardará el cubo.
+
+    tipo: tipo de numpy, opcional
+        Tipo de dato de los pixeles en el cubo. Si es None, se usa el de la primera imagen, así que las imagenes no pierden precisión.
+
+    """
+
+    #Crear el cubo con el tamaño, y si no se indica otro, con el tipo de la primera imagen (en el orden de bytes de la máquina).
+    h = fits.open("{}/{}".format(directorio_imagenes_reducidas, imagenes[0]))
+    ny, nx = h[0].data.shape
+    tipo = h[0].data.dtype.newbyteorder("=") if tipo is None else tipo
+    h.close()
+    cubo = crear_cubo(nombre_cubo, len(imagenes), ny, nx, tipo, directorio_imagenes_reducidas)
+
+    #Copiar cada imagen al cubo.
+    encabezados = []
+    for k, imagen in enumerate(imagenes):
+        h = fits.open("{}/{}".format(directorio_imagenes_reducidas, imagen))
+        cubo[k] = h[0].data
+        encabezados.append(h[0].header)
+        h.close()
+    cubo.flush()
+
+    guardar_encabezados(nombre_cubo, imagenes, list(range(len(imagenes))), encabezados, directorio_imagenes_reducidas)
+    return
+
+def crear_cubo(nombre_cubo, n_imagenes, ny, nx, tipo, directorio_imagenes_reducidas="red"):
+    """
+    Crea un cubo vacío de n_imagenes x ny x nx en disco, con pixeles del tipo indicado (el de las imagenes que se guardarán en él), y lo devuelve abierto con memory mapping para escribir en él.
+
+    """
+
+    fname = "{}/{}.npy".format(directorio_imagenes_reducidas, nombre_cubo)
+    _abiertos.pop(fname, None)
+    return np.lib.format.open_memmap(fname, mode='w+', dtype=tipo, shape=(n_imagenes, ny, nx))
+
+def guardar_encabezados(nombre_cubo, imagenes, indices, encabezados, directorio_imagenes_reducidas="red"):
+    """
+    Guarda la tabla que indica en qué posición del cubo está cada imagen y cuál es su encabezado.
+
+    """
+
+    tabla = Table()
+    tabla['imagen'] = list(imagenes)
+    tabla['indice'] = list(indices)
+    tabla['encabezado'] = [h.tostring() for h in encabezados]
+    tabla.write("{}/{}.ecsv".format(directorio_imagenes_reducidas, nombre_cubo), format='ascii.ecsv', overwrite=True)
+
+
+class AccesoImagenes:
+    """
+    Acceso a las imagenes de una noche, ya sea guardadas en archivos FITS separados o en un cubo escrito por escribir_cubo o por reducir_imagenes_ciencia. Con el cubo, leer una imagen o un recorte es solo tomar una parte de un arreglo con memory mapping, sin abrir ni interpretar archivos.
+
+    Parámetros
+    ----------
+
+    directorio_imagenes_reducidas: str, opcional
+        Directorio donde están las imagenes o el cubo.
+
+    cubo: str, opcional
+        Nombre del cubo, sin extensión. Si es None, las imagenes se leen de archivos separados.
+
+    """
+
+    def __init__(self, directorio_imagenes_reducidas="red", cubo=None):
+        self.directorio = directorio_imagenes_reducidas
+        self.cubo = cubo
+        if cubo is not None:
+            tabla = Table.read("{}/{}.ecsv".format(self.directorio, cubo), format='ascii.ecsv')
+            self._datos = np.load("{}/{}.npy".format(self.directorio, cubo), mmap_mode='r')
+            self._indices = {str(fila['imagen']): int(fila['indice']) for fila in tabla}
+            self._encabezados = {str(fila['imagen']): str(fila['encabezado']) for fila in tabla}
+
+    @property
+    def imagenes(self):
+        """
+        Imagenes guardadas en el cubo, en el orden del cubo. Solo está definido si se usa un cubo.
+
+        """
+
+        return sorted(self._indices, key=self._indices.get)
+
+    @property
+    def dtype(self):
+        """
+        Tipo de dato de los pixeles del cubo. Solo está definido si se usa un cubo.
+
+        """
+
+        return self._datos.dtype
+
+    def datos(self, imagen):
+        """
+        Devuelve el arreglo con los pixeles de una imagen.
+
+        """
+
+        if self.cubo is None:
+            return fits.getdata("{}/{}".format(self.directorio, imagen))
+        return self._datos[self._indices[imagen]]
+
+    def encabezado(self, imagen):
+        """
+        Devuelve el encabezado de una imagen.
+
+        """
+
+        if self.cubo is None:
+            return fits.getheader("{}/{}".format(self.directorio, imagen))
+        return fits.Header.fromstring(self._encabezados[imagen])
+
+    def recortes(self, imagen, x, y, caja):
+        """
+        Devuelve un arreglo de N x caja x caja con recortes de la imagen centrados en los pixeles más cercanos a las posiciones (x, y). Los pixeles fuera de la imagen valen NaN.
+
+        """
+
+        datos = self.datos(imagen)
+        ny, nx = datos.shape
+        mitad = caja // 2
+        ix = np.round(np.asarray(x)).astype(int)[:, None] + np.arange(-mitad, caja - mitad)
+        iy = np.round(np.asarray(y)).astype(int)[:, None] + np.arange(-mitad, caja - mitad)
+        dentro = ((iy >= 0) & (iy < ny))[:, :, None] & ((ix >= 0) & (ix < nx))[:, None, :]
+        recortes = np.asarray(datos[np.clip(iy, 0, ny-1)[:, :, None], np.clip(ix, 0, nx-1)[:, None, :]], dtype=np.float64)
+        recortes[~dentro] = np.nan
+        return recortes
+
+
+def abrir_imagenes(directorio_imagenes_reducidas="red", cubo=None):
+    """
+    Devuelve un AccesoImagenes para el directorio y cubo indicados. Los cubos se abren una sola vez y se reutilizan mientras sus archivos no cambien.
+
+    """
+
+    if cubo is None:
+        return AccesoImagenes(directorio_imagenes_reducidas)
+
+    fname = "{}/{}.npy".format(directorio_imagenes_reducidas, cubo)
+    fname_tabla = "{}/{}.ecsv".format(directorio_imagenes_reducidas, cubo)
+    clave = (os.stat(fname).st_mtime_ns, os.stat(fname_tabla).st_mtime_ns)
+    if fname not in _abiertos or _abiertos[fname][0] != clave:
+        _abiertos[fname] = (clave, AccesoImagenes(directorio_imagenes_reducidas, cubo))
+    return _abiertos[fname][1]
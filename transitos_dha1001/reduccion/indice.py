@@ -0,0 +1,149 @@
+import numpy as np
+import glob
+import os
+
+from astropy.io import fits
+from astropy.table import Table
+
+from .cubo import abrir_imagenes
+from ..fotometria.tiempos import tiempos_imagenes
+
+#Claves del encabezado que se guardan en el índice.
+claves_indice = ("DATE-OBS", "EXPTIME", "AIRMASS", "FILTER", "OBJECT", "RA", "DEC", "FWHM")
+
+def indice_imagenes(imagenes=None, directorio_imagenes_reducidas="red", cubo=None, patron="*.fits", claves=claves_indice, archivo=None, recalcular=False, desfase=4.0, mitad_exposicion=True, ra=None, dec=None):
+    """
+    Construye una tabla con los datos del encabezado de cada imagen (tiempo, exposición, masa de aire, filtro, etc.), leyendo solo los bloques del encabezado de cada archivo y no los datos. La tabla se guarda en un archivo .ecsv junto con la fecha de modificación y el tamaño de cada archivo, así que en las llamadas siguientes solo se leen los encabezados de las imagenes nuevas o que cambiaron.
+
+    La tabla tiene una fila por imagen, en el orden de imagenes, con las columnas imagen, las claves pedidas (NaN o vacío si la imagen no la tiene), mjd (dia Juliano modificado en UTC) y bjd_tdb (dia Juliano baricéntrico), calculados con tiempos_imagenes para todas las imagenes a la vez. Los tiempos también se guardan en el índice, y solo se vuelven a calcular para las imagenes nuevas o si cambian los parámetros de la conversión.
+
+    Parámetros
+    ----------
+
+    imagenes: lista, opcional
+        Imagenes a incluir. Si es None, se usan todas las del cubo, o todas las del directorio que coinciden con patron.
+
+    directorio_imagenes_reducidas: str, opcional
+        Directorio donde están las imagenes, y donde se guarda el índice.
+
+    cubo: str, opcional
+        Nombre del cubo (sin extensión) donde están las imagenes, si se guardaron en un cubo. Los encabezados se leen de la tabla del cubo.
+
+    patron: str, opcional
+        Patrón (como en glob) de las imagenes del directorio, si no se entregan imagenes.
+
+    claves: lista, opcional
+        Claves del encabezado que se guardan en la tabla.
+
+    archivo: str, opcional
+        Archivo donde se guarda el índice. Si es None, es indice_imagenes.ecsv (o nombre_cubo.indice.ecsv) en el directorio de imagenes reducidas.
+
+    recalcular: bool, opcional
+        Si es True, se leen todos los encabezados aunque ya estén en el índice.
+
+    desfase, mitad_exposicion: opcionales
+        Igual que en tiempos_imagenes.
+
+    ra, dec: float o str, opcional
+        Coordenadas del objeto para calcular bjd_tdb. Si son None, se usan RA y DEC del encabezado de cada imagen, si están entre las claves. Si no hay coordenadas, bjd_tdb es NaN.
+
+    """
+
+    if archivo is None:
+        archivo = "{}/{}".format(directorio_imagenes_reducidas, "indice_imagenes.ecsv" if cubo is None else cubo + ".indice.ecsv")
+    acceso = abrir_imagenes(directorio_imagenes_reducidas, cubo)
+    if imagenes is None:
+        if cubo is None:
+            imagenes = sorted(os.path.basename(f) for f in glob.glob("{}/{}".format(directorio_imagenes_reducidas, patron)))
+        else:
+            imagenes = acceso.imagenes
+    imagenes = list(imagenes)
+
+    #Leer el índice guardado, si existe y tiene las mismas claves. Si los tiempos guardados se calcularon con otros parámetros, se descartan.
+    parametros_tiempos = {'desfase': float(desfase), 'mitad_exposicion': bool(mitad_exposicion),
+                          'ra': None if ra is None else str(ra), 'dec': None if dec is None else str(dec)}
+    filas = {}
+    if not recalcular and os.path.exists(archivo):
+        guardado = Table.read(archivo, format='ascii.ecsv')
+        if all(clave in guardado.colnames for clave in claves):
+            mismos_tiempos = guardado.meta.get('tiempos') == parametros_tiempos
+            for fila in guardado:
+                filas[str(fila['imagen'])] = {c: fila[c] for c in guardado.colnames if mismos_tiempos or c not in ('mjd', 'bjd_tdb')}
+
+    #Leer solo los encabezados de las imagenes nuevas o que cambiaron desde que se guardó el índice.
+    nuevas = 0
+    for imagen in imagenes:
+        fname = "{}/{}".format(directorio_imagenes_reducidas, imagen) if cubo is None else "{}/{}.ecsv".format(directorio_imagenes_reducidas, cubo)
+        estado = os.stat(fname)
+        fila = filas.get(imagen)
+        if fila is not None and fila['mtime_ns'] == estado.st_mtime_ns and fila['bytes'] == estado.st_size:
+            continue
+        if cubo is None:
+            with open(fname, "rb") as f:
+                header = fits.Header.fromfile(f)
+        else:
+            header = acceso.encabezado(imagen)
+        fila = {'imagen': imagen, 'mtime_ns': estado.st_mtime_ns, 'bytes': estado.st_size}
+        for clave in claves:
+            fila[clave] = header.get(clave)
+        filas[imagen] = fila
+        nuevas += 1
+
+    #Calcular los tiempos de las imagenes que no los tienen, todas a la vez.
+    sin_tiempos = [f for f in filas.values() if 'mjd' not in f]
+    if len(sin_tiempos) > 0:
+        _calcular_tiempos(_tabla_indice(sin_tiempos, claves), sin_tiempos, desfase, mitad_exposicion, ra, dec)
+
+    #Guardar el índice con todas las imagenes que tenga, no solo las pedidas.
+    if nuevas > 0 or len(sin_tiempos) > 0 or not os.path.exists(archivo):
+        guardado = _tabla_indice(list(filas.values()), claves)
+        guardado.meta['tiempos'] = parametros_tiempos
+        guardado.write(archivo, format='ascii.ecsv', overwrite=True)
+
+    return _tabla_indice([filas[imagen] for imagen in imagenes], claves)
+
+def _calcular_tiempos(tabla, filas, desfase, mitad_exposicion, ra, dec):
+    mjd = np.full(len(tabla), np.nan)
+    bjd_tdb = np.full(len(tabla), np.nan)
+
+    #Solo las imagenes con fecha tienen tiempos, y solo las que además tienen coordenadas tienen bjd_tdb.
+    con_fecha = np.array([len(str(fecha)) > 0 for fecha in tabla['DATE-OBS']], dtype=bool) if 'DATE-OBS' in tabla.colnames else np.zeros(len(tabla), dtype=bool)
+    exptime = np.nan_to_num(np.asarray(tabla['EXPTIME'], dtype=np.float64)) if 'EXPTIME' in tabla.colnames and tabla['EXPTIME'].dtype.kind == 'f' else np.zeros(len(tabla))
+    if ra is not None and dec is not None:
+        ra, dec = np.broadcast_to(np.asarray(ra), len(tabla)), np.broadcast_to(np.asarray(dec), len(tabla))
+        con_coordenadas = con_fecha
+    elif 'RA' in tabla.colnames and 'DEC' in tabla.colnames:
+        ra, dec = np.asarray(tabla['RA']), np.asarray(tabla['DEC'])
+        con_coordenadas = con_fecha & np.array([str(r) not in ("", "nan") for r in ra], dtype=bool)
+    else:
+        con_coordenadas = np.zeros(len(tabla), dtype=bool)
+
+    sin_coordenadas = con_fecha & ~con_coordenadas
+    if np.any(sin_coordenadas):
+        mjd[sin_coordenadas], bjd_tdb[sin_coordenadas] = tiempos_imagenes(tabla['DATE-OBS'][sin_coordenadas], exptime[sin_coordenadas],
+                                                                          desfase=desfase, mitad_exposicion=mitad_exposicion)
+    if np.any(con_coordenadas):
+        mjd[con_coordenadas], bjd_tdb[con_coordenadas] = tiempos_imagenes(tabla['DATE-OBS'][con_coordenadas], exptime[con_coordenadas], ra[con_coordenadas], dec[con_coordenadas],
+                                                                          desfase=desfase, mitad_exposicion=mitad_exposicion)
+    for k, fila in enumerate(filas):
+        fila['mjd'] = mjd[k]
+        fila['bjd_tdb'] = bjd_tdb[k]
+
+def _tabla_indice(filas, claves):
+    tabla = Table()
+    tabla['imagen'] = [str(f['imagen']) for f in filas]
+    tabla['mtime_ns'] = np.array([f['mtime_ns'] for f in filas], dtype=np.int64)
+    tabla['bytes'] = np.array([f['bytes'] for f in filas], dtype=np.int64)
+    for clave in claves:
+
+        #Las claves numéricas que faltan quedan como NaN, y las de texto como un texto vacío.
+        valores = [f[clave] for f in filas]
+        presentes = [v for v in valores if v is not None and not np.ma.is_masked(v)]
+        if len(presentes) > 0 and all(isinstance(v, (int, float, np.number)) and not isinstance(v, bool) for v in presentes):
+            tabla[clave] = np.array([np.nan if v is None or np.ma.is_masked(v) else v for v in valores], dtype=np.float64)
+        else:
+            tabla[clave] = np.array(["" if v is None or np.ma.is_masked(v) else str(v) for v in valores], dtype=str)
+    for columna in ('mjd', 'bjd_tdb'):
+        if all(columna in f for f in filas):
+            tabla[columna] = np.array([f[columna] for f in filas], dtype=np.float64)
+    return tabla
@@ -1,10 +1,12 @@
-import numpy as np
 from astropy.io import fits
 import subprocess
 
+from .combinar import combinar_imagenes
+
 
 def crear_masterbias(imagenes, nombre_bias="MasterBias.fits",
-                    directorio_imagenes_originales="raw", directorio_imagenes_reducidas="red", recalcular=True):
+                    directorio_imagenes_originales="raw", directorio_imagenes_reducidas="red", recalcular=True,
+                    rechazo="mediana", memoria_mb=512):
     """
     Rutina para crear el Master Bias. Esta rutina combina las imagenes de bias tomadas por la camara del telescopio MAS de 50cm en El Sauce y genera el cuadro de bias que vamos a usar en la reducción de las otras imágenes.
 
@@ -26,6 +28,12 @@ def crear_masterbias(imagenes, nombre_bias="MasterBias.fits",
     recalcular: boolean, opcional
         Debe ser True para que la imagen sea recalculada si ya existe.
 
+    rechazo: string, opcional
+        Reyección que se aplica en cada pixel antes de tomar la mediana. Ver combinar_imagenes para las opciones disponibles.
+
+    memoria_mb: float, opcional
+        Memoria máxima, en MB, que se usará para combinar las imagenes. Las imagenes se combinan por franjas de filas, así que no es necesario que quepan todas en memoria.
+
     """
 
     #Tratemos de abrir la imagen. Si no existe, o si se ha pedido recalcularla, proseguir con la combinación.
@@ -38,21 +46,9 @@ def crear_masterbias(imagenes, nombre_bias="MasterBias.fits",
     except FileNotFoundError:
         pass
 
-    #Lista donde vamos a guardar los arrays de todas las imágenes.
-    all_biases = []
-
-    #Leemos todas las imagenes de bias.
-    for imagen in imagenes:
-        fname = "{}/{}".format(directorio_imagenes_originales, imagen)
-        h = fits.open(fname)
-        all_biases.append(h[0].data)
-        h.close()
-
-    #Combinamos las imagenes de bias. Específicamente, tomamos la mediana en cada pixel.
-    master_bias = np.median(all_biases, axis=0)
-
-    #Guardamos la imagen combinada.
+    #Combinamos las imagenes de bias. Específicamente, tomamos la mediana en cada pixel, opcionalmente después de rechazar valores anómalos. La combinación se hace por franjas de filas para no tener que cargar todas las imagenes en memoria, y se va escribiendo directamente en la imagen de salida.
+    fnames = ["{}/{}".format(directorio_imagenes_originales, imagen) for imagen in imagenes]
     subprocess.call(["mkdir",directorio_imagenes_reducidas], stderr=subprocess.DEVNULL)
-    fits.writeto("{}/{}".format(directorio_imagenes_reducidas, nombre_bias), master_bias, overwrite=True)
+    combinar_imagenes(fnames, "{}/{}".format(directorio_imagenes_reducidas, nombre_bias), rechazo=rechazo, memoria_mb=memoria_mb)
 
     return
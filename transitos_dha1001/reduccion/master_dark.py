@@ -2,10 +2,13 @@ import numpy as np
 from astropy.io import fits
 import subprocess
 
+from .combinar import combinar_imagenes
+from .calibracion import NucleoCalibracion
+
 def crear_masterdark(imagenes, nombre_dark="MasterDark.fits",
                      nombre_bias="MasterBias.fits",
                      directorio_imagenes_originales="raw", directorio_imagenes_reducidas="red",
-                     recalcular=True):
+                     recalcular=True, rechazo="mediana", memoria_mb=512):
     """
     Rutina para crear el Master Dark. Esta rutina usa las imagenes de dark, después de sustraer el bias, tomadas por la camara del telescopio MAS de 50cm en El Sauce y genera el cuadro de dark que vamos a usar en la reducción de las otras imágenes.
 
@@ -30,6 +33,12 @@ def crear_masterdark(imagenes, nombre_dark="MasterDark.fits",
     recalcular: boolean, opcional
         Debe ser True para que la imagen sea recalculada si ya existe.
 
+    rechazo: string, opcional
+        Reyección que se aplica en cada pixel antes de tomar la mediana. Ver combinar_imagenes para las opciones disponibles.
+
+    memoria_mb: float, opcional
+        Memoria máxima, en MB, que se usará para combinar las imagenes. Las imagenes se combinan por franjas de filas, así que no es necesario que quepan todas en memoria.
+
     """
 
     #Tratemos de abrir la imagen. Si no existe, o si se ha pedido recalcularla, proseguir con la combinación.
@@ -42,31 +51,20 @@ def crear_masterdark(imagenes, nombre_dark="MasterDark.fits",
     except FileNotFoundError:
         pass
 
-    #Abrir el bias.
+    #Las imagenes de dark se combinan después de sustraerles el bias.
+    nucleo = None
     if nombre_bias is not None:
-        master_bias = fits.open("{}/{}".format(directorio_imagenes_reducidas,nombre_bias))
-
-    #Lista donde vamos a guardar los arrays de todas las imágenes.
-    all_darks = []
-
-    #Leemos todas las imagenes de darks.
-    for imagen in imagenes:
-        fname = "{}/{}".format(directorio_imagenes_originales, imagen)
-        h = fits.open(fname)
-
-        #Sustraemos el bias.
-        h[0].data = np.float64(h[0].data)
-        if nombre_bias is not None:
-            h[0].data -= master_bias[0].data
-
-        all_darks.append(h[0].data)
-        h.close()
+        nucleo = NucleoCalibracion.desde_archivos(nombre_bias, None, None, directorio_imagenes_reducidas)
 
-    #Combinamos las imagenes de dark. Específicamente, tomamos la mediana en cada pixel.
-    master_dark = np.median(all_darks, axis=0)
+    #Guardar el tiempo de exposición de los darks en el master dark, para poder escalarlo al reducir imagenes con otro tiempo de exposición.
+    fnames = ["{}/{}".format(directorio_imagenes_originales, imagen) for imagen in imagenes]
+    exptimes = [fits.getheader(fname).get('EXPTIME') for fname in fnames]
+    encabezado = None
+    if None not in exptimes:
+        encabezado = {'EXPTIME': float(np.median(exptimes))}
 
-    #Guardamos la imagen combinada.
+    #Combinamos las imagenes de dark. Específicamente, tomamos la mediana en cada pixel, opcionalmente después de rechazar valores anómalos. La combinación se hace por franjas de filas para no tener que cargar todas las imagenes en memoria, y se va escribiendo directamente en la imagen de salida.
     subprocess.call(["mkdir",directorio_imagenes_reducidas], stderr=subprocess.DEVNULL)
-    fits.writeto("{}/{}".format(directorio_imagenes_reducidas, nombre_dark), master_dark, overwrite=True)
+    combinar_imagenes(fnames, "{}/{}".format(directorio_imagenes_reducidas, nombre_dark), nucleo=nucleo, rechazo=rechazo, memoria_mb=memoria_mb, encabezado=encabezado)
 
     return
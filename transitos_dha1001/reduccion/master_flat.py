@@ -1,13 +1,14 @@
 import numpy as np
 from astropy.io import fits
 
-from astropy.stats import sigma_clipped_stats
+from .combinar import combinar_imagenes
+from .calibracion import NucleoCalibracion
 
 def crear_masterflat(imagenes, nombre_flat="MasterFlat.fits",
                      nombre_dark="MasterDark.fits",
                      nombre_bias="MasterBias.fits",
                      directorio_imagenes_originales="raw", directorio_imagenes_reducidas="red",
-                     recalcular=True):
+                     recalcular=True, rechazo="sigma", memoria_mb=512):
     """
     Rutina para crear el Master Flat. Esta rutina combina las imagenes de flat, después de sustraer el bias y dark, tomadas por la camara del telescopio MAS de 50cm en El Sauce y genera el cuadro de dark que vamos a usar en la reducción de las otras imágenes.
 
@@ -35,6 +36,12 @@ def crear_masterflat(imagenes, nombre_flat="MasterFlat.fits",
     recalcular: boolean, opcional
         Debe ser True para que la imagen sea recalculada si ya existe.
 
+    rechazo: string, opcional
+        Reyección que se aplica en cada pixel antes de tomar la mediana. El valor predeterminado, "sigma", es una reyección de 3 sigma igual a la de sigma_clipped_stats. Ver combinar_imagenes para las otras opciones.
+
+    memoria_mb: float, opcional
+        Memoria máxima, en MB, que se usará para combinar las imagenes. Las imagenes se combinan por franjas de filas, así que no es necesario que quepan todas en memoria.
+
     """
 
     #Tratemos de abrir la imagen. Si no existe, o si se ha pedido recalcularla, proseguir con la combinación.
@@ -47,38 +54,14 @@ def crear_masterflat(imagenes, nombre_flat="MasterFlat.fits",
     except FileNotFoundError:
         pass
 
-    #Abrir el master dark y el master bias.
-    if nombre_bias is not None:
-        master_bias = fits.open("{}/{}".format(directorio_imagenes_reducidas, nombre_bias))
-    if nombre_dark is not None:
-        master_dark = fits.open("{}/{}".format(directorio_imagenes_reducidas, nombre_dark))
-
-    #Lista donde vamos a guardar los arrays con las imagenes de flats sin dark y sin bias.
-    all_flats = []
-
-    #Iteramos por todas las imagenes sustrayendo el dark y el bias.
-    for imagen in imagenes:
-        fname = "{}/{}".format(directorio_imagenes_originales, imagen)
-        h = fits.open(fname)
-
-        #Sustrer el bias y el dark.
-        h[0].data = np.float64(h[0].data)
-        if nombre_bias is not None:
-            h[0].data -= master_bias[0].data
-        if nombre_dark is not None:
-            h[0].data -= master_dark[0].data
-
-        #Normalizamos las imagenes para que todas tengan la misma mediana.
-        norm = np.median(h[0].data)
-        h[0].data /= norm
-
-        #Guardamos la imagen de flat normalizada.
-        all_flats.append(h[0].data)
-
+    #Las imagenes de flat se combinan después de sustraerles el bias y el dark, que se restan juntos en una sola pasada.
+    nucleo = None
+    if nombre_bias is not None or nombre_dark is not None:
+        nucleo = NucleoCalibracion.desde_archivos(nombre_bias, nombre_dark, None, directorio_imagenes_reducidas)
 
-    #Vamos a calcular la mediana haciendo una reyección estadística de 3 sigma en cada pixel.
-    flat_promedio, flat_mediana, flat_dispersion = sigma_clipped_stats(all_flats, axis=0)
-    master_flat = flat_mediana
+    #Normalizamos las imagenes para que todas tengan la misma mediana, y vamos a calcular la mediana haciendo una reyección estadística de 3 sigma en cada pixel. La combinación se hace por franjas de filas para no tener que cargar todas las imagenes en memoria.
+    fnames = ["{}/{}".format(directorio_imagenes_originales, imagen) for imagen in imagenes]
+    master_flat = combinar_imagenes(fnames, nucleo=nucleo, rechazo=rechazo, normalizar=True, memoria_mb=memoria_mb)
 
     #Finalmente, si hay algun pixel con flujo 0 o negativo (lo que es solo debido a fluctuaciones estadísticas), lo vamos a reemplazar por el menor valor positivo en la imagen. Esto no tiene un impacto medible, pues deberían ser muy poco pixeles, pero evita errores en los cálculos.
     min_val = np.min(master_flat[master_flat>0])
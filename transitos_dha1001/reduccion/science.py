@@ -1,6 +1,14 @@
 import numpy as np
 from astropy.io import fits
 from astroscrappy import detect_cosmics
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+from .calibracion import NucleoCalibracion
+from .cubo import crear_cubo, guardar_encabezados, abrir_imagenes
+
+#Núcleo de calibración usado por el proceso actual. Se crea una sola vez por proceso en _abrir_masters.
+_nucleo = None
 
 def reducir_imagenes_ciencia(imagenes, prefijo="ciencia",
                      reyeccion_rayos_cosmicos=True,
@@ -8,7 +16,8 @@ def reducir_imagenes_ciencia(imagenes, prefijo="ciencia",
                      nombre_dark="MasterDark.fits",
                      nombre_bias="MasterBias.fits",
                      directorio_imagenes_originales="raw", directorio_imagenes_reducidas="red",
-                     recalcular=True):
+                     recalcular=True, n_procesos=1,
+                     precision="float64", escalar_dark=False, cubo=None):
     """
     Rutina para reducir las imagenes de ciencia. Esta rutina sustrae el bias y dark, y corrige las diferencias de sensibilidad entre pixeles usando el flat en imagenes tomadas por la camara del telescopio MAS de 50cm en El Sauce.
 
@@ -42,48 +51,147 @@ def reducir_imagenes_ciencia(imagenes, prefijo="ciencia",
     recalcular: bool, opcional
         Si es True, se reducirá la imagen aún cuando una versión de la imagen reducida ya exista en el directorio de imagenes reducidas. 
 
-    """
+    n_procesos: int, opcional
+        Número de procesos en que se repartirán las imagenes. Cada proceso abre los cuadros maestros una sola vez usando memory mapping y precalcula su núcleo de calibración, así que no se copian para cada imagen. Si es None, se usa un proceso por cada CPU.
 
-    #Abrir el master dark y el master bias.
-    if nombre_bias is not None:
-        master_bias = fits.open("{}/{}".format(directorio_imagenes_reducidas, nombre_bias))
-    if nombre_dark is not None:
-        master_dark = fits.open("{}/{}".format(directorio_imagenes_reducidas, nombre_dark))
-    if nombre_flat is not None:
-        master_flat = fits.open("{}/{}".format(directorio_imagenes_reducidas, nombre_flat))
+    precision: string, opcional
+        Precisión de la calibración, "float64" o "float32". En float32 las imagenes reducidas ocupan la mitad de espacio. Se puede usar NucleoCalibracion.diferencia_maxima para ver la diferencia con float64.
 
+    escalar_dark: bool, opcional
+        Si es True, el dark se escala por el tiempo de exposición de cada imagen (EXPTIME) respecto al del master dark.
 
-    #Pasar por cada imagen removiendo bias y dark, corrigiendo por el flat, y removiendo los rayos cósmicos.
-    for imagen in imagenes:
+    cubo: string, opcional
+        Nombre de un cubo (sin extensión) donde se guardarán todas las imagenes reducidas, en vez de guardar un archivo por imagen. Dentro del cubo cada imagen se llama igual que su archivo reducido. Ver AccesoImagenes para leerlo.
+
+    La rutina devuelve una lista con las imagenes que no se pudieron reducir y el error correspondiente. Un error en una imagen no detiene la reducción del resto.
 
-        #Tratemos de abrir la imagen. Si no existe, o si se ha pedido recalcularla, proseguir con la combinación.
-        try:
-            if recalcular:
-                raise FileNotFoundError
-            imagen_red = fits.open("{}/{}_{}".format(directorio_imagenes_reducidas, prefijo, imagen))
-            imagen_red.close()
+    """
+
+    #Ver cuáles imagenes hay que reducir. Si no se ha pedido recalcular, saltarse las que ya existen.
+    por_reducir = []
+    for imagen in imagenes:
+        if not recalcular and cubo is None and os.path.exists("{}/{}_{}".format(directorio_imagenes_reducidas, prefijo, imagen)):
             continue
-        except FileNotFoundError:
-            pass
+        por_reducir.append(imagen)
+
+    #Con un cubo, el cubo se escribe completo de nuevo salvo que ya tenga todas las imagenes.
+    destinos = [(None, None)] * len(por_reducir)
+    if cubo is not None:
+        nombres = ["{}_{}".format(prefijo, imagen) for imagen in imagenes]
+        if not recalcular and os.path.exists("{}/{}.ecsv".format(directorio_imagenes_reducidas, cubo)):
+            if set(nombres) <= set(abrir_imagenes(directorio_imagenes_reducidas, cubo).imagenes):
+                return []
+        header = fits.getheader("{}/{}".format(directorio_imagenes_originales, imagenes[0]))
+        crear_cubo(cubo, len(imagenes), header['NAXIS2'], header['NAXIS1'], precision, directorio_imagenes_reducidas)
+        fname_cubo = "{}/{}.npy".format(directorio_imagenes_reducidas, cubo)
+        destinos = [(fname_cubo, k) for k in range(len(imagenes))]
+
+    #Argumentos para abrir los cuadros maestros y para reducir cada imagen.
+    args_masters = (nombre_bias, nombre_dark, nombre_flat, directorio_imagenes_reducidas, escalar_dark, precision)
+    args_imagen = (prefijo, reyeccion_rayos_cosmicos, directorio_imagenes_originales, directorio_imagenes_reducidas)
+
+    #Reducir las imagenes, en este mismo proceso o repartiéndolas en varios. Los resultados se recogen siempre en el orden de la lista de imagenes.
+    errores = []
+    encabezados = []
+    if n_procesos == 1:
+        _abrir_masters(*args_masters)
+        for imagen, destino in zip(por_reducir, destinos):
+            try:
+                encabezados.append(_reducir_imagen(imagen, *args_imagen, *destino))
+                errores.append(None)
+            except Exception as e:
+                encabezados.append(None)
+                errores.append(repr(e))
+    else:
+        with ProcessPoolExecutor(max_workers=n_procesos, initializer=_abrir_masters, initargs=args_masters) as ejecutor:
+            futuros = [ejecutor.submit(_reducir_imagen, imagen, *args_imagen, *destino) for imagen, destino in zip(por_reducir, destinos)]
+            for futuro in futuros:
+                try:
+                    encabezados.append(futuro.result())
+                    errores.append(None)
+                except Exception as e:
+                    encabezados.append(None)
+                    errores.append(repr(e))
+
+    #Guardar la tabla de encabezados del cubo, solo con las imagenes que se pudieron reducir.
+    if cubo is not None:
+        listas = [(nombre, k, header) for k, (nombre, header) in enumerate(zip(nombres, encabezados)) if header is not None]
+        guardar_encabezados(cubo, [l[0] for l in listas], [l[1] for l in listas], [l[2] for l in listas], directorio_imagenes_reducidas)
+
+    #Informar las imagenes que no se pudieron reducir.
+    fallidas = []
+    for imagen, error in zip(por_reducir, errores):
+        if error is not None:
+            print("No se pudo reducir la imagen", imagen, ":", error)
+            fallidas.append((imagen, error))
+
+    return fallidas
+
+
+def _abrir_masters(nombre_bias, nombre_dark, nombre_flat, directorio_imagenes_reducidas, escalar_dark, precision):
+
+    #Abrir los cuadros maestros con memory mapping y precalcular el offset y el inverso del flat.
+    global _nucleo
+    _nucleo = NucleoCalibracion.desde_archivos(nombre_bias, nombre_dark, nombre_flat, directorio_imagenes_reducidas,
+                                               escalar_dark=escalar_dark, precision=precision)
+
+
+def _reducir_imagen(imagen, prefijo, reyeccion_rayos_cosmicos, directorio_imagenes_originales, directorio_imagenes_reducidas,
+                    fname_cubo=None, indice=None):
+
+    #Reducir con el núcleo que _abrir_masters dejó en este proceso.
+    return reducir_imagen(imagen, _nucleo, prefijo, reyeccion_rayos_cosmicos, directorio_imagenes_originales, directorio_imagenes_reducidas,
+                          fname_cubo, indice)
+
+
+def reducir_imagen(imagen, nucleo, prefijo="ciencia", reyeccion_rayos_cosmicos=True,
+                   directorio_imagenes_originales="raw", directorio_imagenes_reducidas="red", fname_cubo=None, indice=None):
+    """
+    Reduce una sola imagen de ciencia con un núcleo de calibración ya calculado, y la guarda en su propio archivo o en su lugar dentro de un cubo. Es la reducción que reducir_imagenes_ciencia aplica a cada imagen, para quien procesa las imagenes de a una, como curva_de_luz_en_vivo.
+
+    Devuelve el encabezado de la imagen.
 
+    Parámetros
+    ----------
+
+    imagen: string
+        Nombre de la imagen original.
+
+    nucleo: NucleoCalibracion
+        Núcleo de calibración con los cuadros maestros, por ejemplo creado con NucleoCalibracion.desde_archivos.
+
+    prefijo, reyeccion_rayos_cosmicos, directorio_imagenes_originales, directorio_imagenes_reducidas: opcionales
+        Igual que en reducir_imagenes_ciencia.
+
+    fname_cubo: string, opcional
+        Archivo .npy del cubo donde se guarda la imagen reducida. Si es None, se guarda en un archivo FITS con el prefijo.
+
+    indice: int, opcional
+        Posición de la imagen dentro del cubo.
+
+    """
 
-        #Abrir la imagen.
-        fname = "{}/{}".format(directorio_imagenes_originales, imagen)
-        h = fits.open(fname)
+    #Abrir la imagen.
+    fname = "{}/{}".format(directorio_imagenes_originales, imagen)
+    h = fits.open(fname)
 
-        #Sustraer el bias y el dark, y corregir por el flat.
-        h[0].data = np.float64(h[0].data)
-        if nombre_bias is not None:
-            h[0].data -= master_bias[0].data
-        if nombre_dark is not None:
-            h[0].data -= master_dark[0].data
-        if nombre_flat is not None:
-            h[0].data /= master_flat[0].data
+    #Sustraer el bias y el dark, y corregir por el flat, todo en una sola pasada.
+    h[0].data = nucleo.aplicar(h[0].data, exptime=h[0].header.get('EXPTIME'))
 
-        #Limpiar los rayos cosmicos.
-        if reyeccion_rayos_cosmicos:
-            crmask, clean_image = detect_cosmics(h[0].data)
-            h[0].data = clean_image
+    #Limpiar los rayos cosmicos.
+    if reyeccion_rayos_cosmicos:
+        crmask, clean_image = detect_cosmics(h[0].data)
+        h[0].data = clean_image
 
-        #Guardar la imagen reducida.
+    #Guardar la imagen reducida, en su propio archivo o en su lugar dentro del cubo. Cada proceso escribe solo su imagen, así que no se pisan.
+    if fname_cubo is None:
         h[0].writeto("{}/{}_{}".format(directorio_imagenes_reducidas, prefijo, imagen), overwrite=True)
+    else:
+        datos = np.load(fname_cubo, mmap_mode='r+')
+        datos[indice] = h[0].data
+        datos.flush()
+        del datos
+    header = h[0].header.copy()
+    h.close()
+
+    return header
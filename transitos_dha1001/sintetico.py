@@ -0,0 +1,242 @@
+import numpy as np
+import os
+
+from astropy.io import fits
+from astropy.time import Time
+import astropy.units as u
+
+from .fotometria.tiempos import tiempos_imagenes
+
+def generar_noche(directorio_imagenes_originales="raw", tamano=2048, n_bias=10, n_darks=10, n_flats=10, n_ciencia=60,
+                  n_estrellas=300, exptime=30., exptime_flat=5., cadencia=None, fecha="2023-05-01T22:00:00",
+                  nivel_bias=1000., ruido_lectura=15., ganancia=1.33, corriente_oscura=0.5, cielo=20., nivel_flat=25000.,
+                  vineteo=0.3, fwhm=4., perfil="gaussiana", beta=3., deriva=(0.05, 0.03), rayos_cosmicos=30,
+                  profundidad=0.01, inicio_transito=0.3, fin_transito=0.7, ingreso=0.1, extincion=0.15,
+                  objeto="SINTETICO", ra="16:37:15.5", dec="+07:11:00", semilla=None):
+    """
+    Genera una noche sintética de imagenes originales, como las de la cámara del telescopio, para probar y medir el rendimiento del pipeline sin datos reales: bias, darks, flats e imagenes de ciencia, guardadas como enteros de 16 bits con los encabezados DATE-OBS (hora local), EXPTIME, AIRMASS, RA, DEC, OBJECT, FILTER e IMAGETYP.
+
+    Las imagenes tienen un nivel de bias con una estructura fija por columnas, corriente oscura, ruido de lectura y ruido de Poisson, un vineteo radial y diferencias de sensibilidad entre pixeles (que aparecen en los flats y en las imagenes de ciencia), y rayos cósmicos en los darks y en las imagenes de ciencia. Las estrellas tienen un perfil gaussiano o de Moffat, se desplazan un poco en cada imagen, y su brillo cambia con la masa de aire. La estrella objetivo, la más brillante, está en el centro de la primera imagen y tiene un tránsito trapezoidal de profundidad conocida.
+
+    Devuelve un diccionario con los nombres de las imagenes de cada tipo (bias, darks, flats, ciencia), las posiciones de las estrellas en la primera imagen, su flujo en ADU por exposición, el índice de la estrella objetivo, el desplazamiento de cada imagen, el flujo relativo inyectado en la estrella objetivo en cada imagen (curva), la masa de aire y los tiempos mjd (mitad de la exposición, en UTC) de cada imagen, y el comienzo y el final del tránsito en mjd.
+
+    Parámetros
+    ----------
+
+    directorio_imagenes_originales: str, opcional
+        Directorio donde se guardan las imagenes.
+
+    tamano: int, opcional
+        Número de pixeles de cada lado de las imagenes.
+
+    n_bias, n_darks, n_flats, n_ciencia: int, opcional
+        Número de imagenes de cada tipo.
+
+    n_estrellas: int, opcional
+        Número de estrellas del campo.
+
+    exptime, exptime_flat: float, opcional
+        Tiempo de exposición, en segundos, de las imagenes de ciencia (y de los darks), y de los flats.
+
+    cadencia: float, opcional
+        Segundos entre el comienzo de dos imagenes de ciencia consecutivas. Por defecto es exptime más 10 segundos de lectura.
+
+    fecha: str, opcional
+        DATE-OBS de la primera imagen de ciencia, en hora local.
+
+    nivel_bias, ruido_lectura: float, opcional
+        Nivel del bias y ruido de lectura, en ADU.
+
+    ganancia: float, opcional
+        Ganancia, en electrones por ADU.
+
+    corriente_oscura, cielo: float, opcional
+        Corriente oscura y brillo del cielo, en electrones por segundo por pixel.
+
+    nivel_flat: float, opcional
+        Nivel de los flats, en ADU, en el centro de la imagen.
+
+    vineteo: float, opcional
+        Pérdida relativa de sensibilidad en las esquinas de la imagen.
+
+    fwhm: float, opcional
+        FWHM de las estrellas, en pixeles.
+
+    perfil: str, opcional
+        Perfil de las estrellas: "gaussiana" o "moffat".
+
+    beta: float, opcional
+        Exponente del perfil de Moffat.
+
+    deriva: tupla, opcional
+        Desplazamiento, en pixeles por imagen, de las estrellas en x e y. A la deriva se le suma un pequeño desplazamiento aleatorio.
+
+    rayos_cosmicos: int, opcional
+        Número de rayos cósmicos en cada imagen de ciencia y cada dark.
+
+    profundidad: float, opcional
+        Profundidad del tránsito, como fracción del flujo.
+
+    inicio_transito, fin_transito: float, opcional
+        Comienzo y final del tránsito, como fracción de la duración de la secuencia de ciencia.
+
+    ingreso: float, opcional
+        Duración del ingreso y del egreso, como fracción de la duración del tránsito.
+
+    extincion: float, opcional
+        Coeficiente de extinción, en magnitudes por masa de aire.
+
+    objeto, ra, dec: str, opcional
+        Nombre y coordenadas que se escriben en los encabezados.
+
+    semilla: int, opcional
+        Semilla de los números aleatorios.
+
+    """
+
+    rng = np.random.default_rng(semilla)
+    raw = directorio_imagenes_originales
+    os.makedirs(raw, exist_ok=True)
+    forma = (tamano, tamano)
+
+    #Estructuras fijas del detector: bias por columnas, vineteo radial y sensibilidad de cada pixel.
+    bias = nivel_bias + 3.*np.sin(np.arange(tamano)/37.)[None,:] + np.zeros(forma)
+    yy, xx = np.indices(forma, dtype=np.float64)
+    centro = 0.5*(tamano - 1)
+    sensibilidad = (1. - vineteo*((xx - centro)**2 + (yy - centro)**2)/(2.*centro**2)) * rng.normal(1., 0.01, forma)
+    del xx, yy
+
+    #Campo de estrellas: la primera es el objetivo, la más brillante, en el centro.
+    margen = 0.05*tamano
+    posiciones = rng.uniform(margen, tamano - margen, (n_estrellas, 2))
+    posiciones[0] = centro
+    flujos = 10**rng.uniform(3., 5.5, n_estrellas)
+    flujos[0] = 10**5.7
+
+    #Tiempos, masa de aire y desplazamiento de cada imagen de ciencia.
+    cadencia = exptime + 10. if cadencia is None else cadencia
+    inicio = Time(fecha, format='isot', scale='utc')
+    fechas = [(inicio + k*cadencia*u.s).isot for k in range(n_ciencia)]
+    mjd = tiempos_imagenes(fechas, np.full(n_ciencia, exptime))[0]
+    fraccion = np.arange(n_ciencia)/max(n_ciencia - 1, 1)
+    airmass = 1.05 + 0.6*(fraccion - 0.2)**2
+    desplazamientos = np.arange(n_ciencia)[:,None]*np.asarray(deriva, dtype=np.float64)[None] + rng.normal(0., 0.3, (n_ciencia, 2))
+    desplazamientos[0] = 0.
+    curva = _curva_transito(fraccion, profundidad, inicio_transito, fin_transito, ingreso)
+    duracion = mjd[-1] - mjd[0]
+    t_inicio, t_fin = mjd[0] + inicio_transito*duracion, mjd[0] + fin_transito*duracion
+
+    nombres = {"bias": [], "darks": [], "flats": [], "ciencia": []}
+    encabezado = {"OBJECT": objeto, "RA": ra, "DEC": dec, "FILTER": "R"}
+
+    for k in range(n_bias):
+        datos = bias + rng.normal(0., ruido_lectura, forma)
+        nombres["bias"].append(_escribir("bias_{:04d}.fits".format(k), raw, datos, fechas[0], 0., "BIAS", encabezado))
+
+    for k in range(n_darks):
+        electrones = rng.poisson(corriente_oscura*exptime, forma).astype(np.float64)
+        datos = bias + electrones/ganancia + rng.normal(0., ruido_lectura, forma)
+        _rayos_cosmicos(datos, rayos_cosmicos, rng)
+        nombres["darks"].append(_escribir("dark_{:04d}.fits".format(k), raw, datos, fechas[0], exptime, "DARK", encabezado))
+
+    for k in range(n_flats):
+        electrones = rng.poisson(nivel_flat*ganancia*sensibilidad + corriente_oscura*exptime_flat).astype(np.float64)
+        datos = bias + electrones/ganancia + rng.normal(0., ruido_lectura, forma)
+        nombres["flats"].append(_escribir("flat_{:04d}.fits".format(k), raw, datos, fechas[0], exptime_flat, "FLAT", encabezado))
+
+    for k in range(n_ciencia):
+
+        #Estrellas con la extinción de la masa de aire de la imagen, y el tránsito en la estrella objetivo.
+        flujos_imagen = flujos*10**(-0.4*extincion*airmass[k])
+        flujos_imagen[0] *= curva[k]
+        estrellas = estrellas_imagen(forma, posiciones + desplazamientos[k], flujos_imagen*ganancia, fwhm, perfil, beta)
+        electrones = rng.poisson(np.maximum(sensibilidad*(estrellas + cielo*exptime) + corriente_oscura*exptime, 0.)).astype(np.float64)
+        datos = bias + electrones/ganancia + rng.normal(0., ruido_lectura, forma)
+        _rayos_cosmicos(datos, rayos_cosmicos, rng)
+        nombres["ciencia"].append(_escribir("ciencia_{:04d}.fits".format(k), raw, datos, fechas[k], exptime, "LIGHT", dict(encabezado, AIRMASS=float(airmass[k]))))
+
+    return {"bias": nombres["bias"], "darks": nombres["darks"], "flats": nombres["flats"], "ciencia": nombres["ciencia"],
+            "posiciones": posiciones, "flujos": flujos, "objetivo": 0, "desplazamientos": desplazamientos,
+            "curva": curva, "airmass": airmass, "mjd": mjd, "t_inicio": t_inicio, "t_fin": t_fin, "profundidad": profundidad}
+
+def estrellas_imagen(forma, posiciones, flujos, fwhm=4., perfil="gaussiana", beta=3.):
+    """
+    Dibuja estrellas en una imagen vacía de tamaño forma, cada una en un recuadro alrededor de su posición, con un perfil gaussiano o de Moffat normalizado a su flujo.
+
+    Parámetros
+    ----------
+
+    forma: tupla
+        Tamaño (ny, nx) de la imagen.
+
+    posiciones: numpy array
+        Posiciones (x, y) de las estrellas.
+
+    flujos: numpy array
+        Flujo total de cada estrella.
+
+    fwhm: float, opcional
+        FWHM de las estrellas, en pixeles.
+
+    perfil: str, opcional
+        "gaussiana" o "moffat".
+
+    beta: float, opcional
+        Exponente del perfil de Moffat.
+
+    """
+
+    imagen = np.zeros(forma)
+    if perfil == "gaussiana":
+        sigma = fwhm/(2.*np.sqrt(2.*np.log(2.)))
+        radio = int(np.ceil(4.*fwhm))
+    elif perfil == "moffat":
+        alfa = fwhm/(2.*np.sqrt(2**(1./beta) - 1.))
+        radio = int(np.ceil(8.*fwhm))
+    else:
+        raise ValueError("El perfil debe ser 'gaussiana' o 'moffat'.")
+
+    desplazamiento = np.arange(-radio, radio + 1)
+    for (x, y), flujo in zip(posiciones, flujos):
+        x0, y0 = int(round(x)), int(round(y))
+        xs, ys = x0 + desplazamiento, y0 + desplazamiento
+        dentro_x, dentro_y = (xs >= 0) & (xs < forma[1]), (ys >= 0) & (ys < forma[0])
+        if not np.any(dentro_x) or not np.any(dentro_y):
+            continue
+        r2 = (xs[dentro_x][None,:] - x)**2 + (ys[dentro_y][:,None] - y)**2
+        if perfil == "gaussiana":
+            recuadro = np.exp(-0.5*r2/sigma**2)/(2.*np.pi*sigma**2)
+        else:
+            recuadro = (beta - 1.)/(np.pi*alfa**2)*(1. + r2/alfa**2)**(-beta)
+        imagen[ys[dentro_y][0]:ys[dentro_y][-1]+1, xs[dentro_x][0]:xs[dentro_x][-1]+1] += flujo*recuadro
+    return imagen
+
+def _curva_transito(fraccion, profundidad, inicio, fin, ingreso):
+
+    #Tránsito trapezoidal: baja linealmente durante el ingreso, se mantiene en 1 - profundidad y sube durante el egreso.
+    largo_ingreso = max(ingreso*(fin - inicio), 1e-9)
+    bajada = np.clip((fraccion - inicio)/largo_ingreso, 0., 1.)
+    subida = np.clip((fin - fraccion)/largo_ingreso, 0., 1.)
+    return 1. - profundidad*np.minimum(bajada, subida)
+
+def _rayos_cosmicos(datos, n, rng):
+
+    #Rayos cósmicos como trazas cortas de uno a cuatro pixeles.
+    ny, nx = datos.shape
+    for k in range(n):
+        x, y = rng.integers(0, nx), rng.integers(0, ny)
+        dx, dy = rng.integers(-1, 2, size=2)
+        for paso in range(rng.integers(1, 5)):
+            xi, yi = x + paso*dx, y + paso*dy
+            if 0 <= xi < nx and 0 <= yi < ny:
+                datos[yi, xi] += rng.uniform(2000., 20000.)
+
+def _escribir(fname, directorio, datos, fecha, exptime, tipo, encabezado):
+    header = fits.Header()
+    header['DATE-OBS'] = fecha
+    header['EXPTIME'] = float(exptime)
+    header['IMAGETYP'] = tipo
+    for clave, valor in encabezado.items():
+        header[clave] = valor
+    fits.writeto("{}/{}".format(directorio, fname), np.clip(np.round(datos), 0, 65535).astype(np.uint16), header, overwrite=True)
+    return fname